@@ -16,15 +16,108 @@
     along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import time
 import redis
+from redis.exceptions import ConnectionError, TimeoutError
+
+class HealthCheckMixin(object):
+    """ Pings connections which have been idle for more than
+        health_check_interval seconds before sending a command, and
+        reconnects them if the ping fails (e.g. the server or a firewall
+        closed them meanwhile). Subscribed (pubsub) connections are not
+        checked, as their replies are messages. """
+    health_check_interval = 0
+    next_health_check = 0
+    subscribed = False
+
+    def pack_command(self, *args):
+        if args[0] in ('SUBSCRIBE', 'PSUBSCRIBE'):
+            self.subscribed = True
+        return super(HealthCheckMixin, self).pack_command(*args)
+
+    def disconnect(self):
+        self.subscribed = False
+        super(HealthCheckMixin, self).disconnect()
+
+    def send_packed_command(self, command):
+        if self._sock is not None and not self.subscribed and time.time() > self.next_health_check:
+            self.check_health()
+        super(HealthCheckMixin, self).send_packed_command(command)
+
+    def read_response(self):
+        r = super(HealthCheckMixin, self).read_response()
+        self.next_health_check = time.time() + self.health_check_interval
+        return r
+
+    def check_health(self):
+        try:
+            super(HealthCheckMixin, self).send_packed_command(self.pack_command('PING'))
+            if super(HealthCheckMixin, self).read_response() != 'PONG':
+                raise ConnectionError('Bad PING reply')
+        except (ConnectionError, TimeoutError):
+            self.disconnect()
+
+_health_check_classes = {}
+
+def _health_checked(cls, interval):
+    k = (cls, interval)
+    checked = _health_check_classes.get(k)
+    if checked is None:
+        checked = type('HealthChecked' + cls.__name__, (HealthCheckMixin, cls),
+                       {'health_check_interval': interval})
+        _health_check_classes[k] = checked
+    return checked
 
 class Client(object):
+    """ Creates redis clients. Settings are redis.Redis arguments (host,
+        port, db, unix_socket_path, socket_keepalive, max_connections...),
+        plus:
+        - health_check_interval: connections idle for more than these
+          seconds are checked with a PING before being used, and
+          reconnected if it fails (default 0, no checks).
+        - blocking: if True, threads wait for a free connection when
+          max_connections (default 50) are in use, instead of failing.
+        - blocking_timeout: seconds to wait for a free connection when
+          blocking (default 20).
+        - cluster: if True, a Redis Cluster client is created (this requires
+          redis-py-cluster), with host and port as startup node, or a list
+          of startup_nodes ({'host': ..., 'port': ...} dicts). Models must
+          use hash tags then (see hash_tag in Model). """
     def __init__(self, **kwargs):
         self.connection_settings = kwargs or {'host': 'localhost',
                 'port': 6379, 'db': 0}
 
     def redis(self):
-        return redis.Redis(**self.connection_settings)
+        settings = dict(self.connection_settings)
+        blocking = settings.pop('blocking', False)
+        blocking_timeout = settings.pop('blocking_timeout', 20)
+        health_check_interval = settings.pop('health_check_interval', 0)
+        if settings.pop('cluster', False):
+            return self.__cluster(settings)
+        conn = redis.Redis(**settings)
+        pool = conn.connection_pool
+        if health_check_interval:
+            pool.connection_class = _health_checked(pool.connection_class, health_check_interval)
+        if blocking:
+            conn.connection_pool = redis.BlockingConnectionPool(
+                    max_connections = settings.get('max_connections') or 50,
+                    timeout = blocking_timeout,
+                    connection_class = pool.connection_class,
+                    **pool.connection_kwargs)
+        return conn
+
+    def __cluster(self, settings):
+        try:
+            from rediscluster import RedisCluster
+        except ImportError:
+            raise ImportError('cluster = True requires redis-py-cluster')
+        nodes = settings.pop('startup_nodes', None)
+        host = settings.pop('host', 'localhost')
+        port = settings.pop('port', 6379)
+        settings.pop('db', None)
+        if nodes is None:
+            nodes = [{'host': host, 'port': port}]
+        return RedisCluster(startup_nodes = nodes, **settings)
 
     def update(self, d):
         self.connection_settings.update(d)
@@ -49,4 +142,4 @@ client = Client()
 connection_real = client.redis()
 connection = ClientProxy()
 
-__all__ = ['connection_setup', 'get_client']
+__all__ = ['Client', 'connection_setup', 'get_client']
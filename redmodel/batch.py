@@ -0,0 +1,308 @@
+"""
+    Copyright (C) 2011 Maximiliano Pin
+
+    Redmodel is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Redmodel is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import threading
+from redis.exceptions import NoScriptError
+from redmodel import connection as ds
+from redmodel.cache import get_cache
+from redmodel.cluster import is_cluster, key_slot
+
+class Script(object):
+    """ Lua script called with EVALSHA. The script is loaded into redis the
+        first time the server reports it does not know it. """
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+
+    def __call__(self, conn, keys, args):
+        try:
+            return conn.evalsha(self.sha, len(keys), *(list(keys) + list(args)))
+        except NoScriptError:
+            conn.script_load(self.source)
+            return conn.evalsha(self.sha, len(keys), *(list(keys) + list(args)))
+
+# KEYS: hashes of unique checks, then the key of every command.
+# ARGV: number of checks, fields of unique checks, then every command as
+# (number of args, command name, args...).
+# ZAPPEND key members... is run as a ZADD scoring members after the last
+# score of key (plus one, two...). RENAME takes its two keys from KEYS.
+# Returns {i} if unique check i failed, or {0, replies...} otherwise.
+_guarded_exec = Script("""
+local n = tonumber(ARGV[1])
+for i = 1, n do
+    if redis.call('HEXISTS', KEYS[i], ARGV[i + 1]) == 1 then
+        return {i}
+    end
+end
+local res = {0}
+local k = n + 1
+local a = n + 2
+while a <= #ARGV do
+    local argc = tonumber(ARGV[a])
+    local cmd = {ARGV[a + 1], KEYS[k]}
+    if cmd[1] == 'RENAME' then
+        k = k + 1
+        cmd[3] = KEYS[k]
+    end
+    for j = 1, argc do
+        cmd[j + 2] = ARGV[a + 1 + j]
+    end
+    local r
+    if cmd[1] == 'ZAPPEND' then
+        local last = redis.call('ZRANGE', cmd[2], -1, -1, 'WITHSCORES')
+        local score = 0
+        if #last > 0 then
+            score = tonumber(last[2])
+        end
+        local zadd = {'ZADD', cmd[2]}
+        for j = 3, #cmd do
+            zadd[#zadd + 1] = score + j - 2
+            zadd[#zadd + 1] = cmd[j]
+        end
+        r = redis.call(unpack(zadd))
+    else
+        r = redis.call(unpack(cmd))
+    end
+    if type(r) == 'table' and r.ok then
+        r = r.ok
+    end
+    res[#res + 1] = r
+    k = k + 1
+    a = a + argc + 2
+end
+return res
+""")
+
+class CommandBatch(object):
+    """ Records write commands, with the same interface as a redis pipeline
+        (for the commands used by writers), and executes them atomically.
+        If unique checks are added, the checks and the commands are run in a
+        single server-side script, so no other client can take a unique value
+        between the check and the write. The script is used too for zappend,
+        which is not a redis command, and on Redis Cluster, which does not
+        support MULTI (all the keys must be in the same hash slot then). """
+    def __init__(self):
+        self.scripted = False
+        self.checks = []
+        self.claimed = set()
+        self.repeated = None
+        self.commands = []
+        self.callbacks = []
+
+    def after(self, func, *args):
+        """ Calls func(*args) after the commands are executed successfully. """
+        self.callbacks.append((func, args))
+
+    def check_unique(self, key, value):
+        """ Makes execute() raise UniqueError if value is a field of hash
+            key, or was already checked in this batch (i.e. it's taken by an
+            earlier write of the batch), without executing any command. """
+        claim = (key, value)
+        if claim in self.claimed:
+            if self.repeated is None:
+                self.repeated = (key, value)
+            return
+        self.claimed.add(claim)
+        self.checks.append((key, value))
+
+    def execute(self, conn = ds):
+        """ Executes all the commands in one round trip. Returns the list of
+            replies. """
+        if self.repeated is not None:
+            from redmodel.containers import UniqueError
+            raise UniqueError(*self.repeated)
+        if len(self.checks) or self.scripted or is_cluster(conn):
+            resp = self._execute_script(conn)
+        else:
+            pl = conn.pipeline(True)
+            for cmd in self.commands:
+                pl.execute_command(*cmd)
+            resp = pl.execute()
+        self._invalidate_cache()
+        for func, args in self.callbacks:
+            func(*args)
+        return resp
+
+    def _invalidate_cache(self):
+        c = get_cache()
+        if c is not None:
+            for cmd in self.commands:
+                c.invalidate(cmd[1])
+                if cmd[0] == 'RENAME':
+                    c.invalidate(cmd[2])
+
+    def _execute_script(self, conn):
+        if len(self.commands) == 0 and len(self.checks) == 0:
+            return []
+        keys = [k for k, v in self.checks]
+        args = [len(self.checks)] + [v for k, v in self.checks]
+        for cmd in self.commands:
+            keys.append(cmd[1])
+            if cmd[0] == 'RENAME':
+                keys.append(cmd[2])
+                args.append(0)
+                args.append(cmd[0])
+                continue
+            args.append(len(cmd) - 2)
+            args.append(cmd[0])
+            args.extend(cmd[2:])
+        if is_cluster(conn):
+            slots = set(key_slot(k) for k in keys)
+            if len(slots) > 1:
+                from redmodel.models.exceptions import BadArgsError
+                raise BadArgsError('Batch keys are in {0} cluster hash slots: {1}'.format(len(slots), ', '.join(sorted(set(keys)))))
+        resp = _guarded_exec(conn, keys, args)
+        if resp[0] != 0:
+            from redmodel.containers import UniqueError
+            k, v = self.checks[resp[0] - 1]
+            raise UniqueError(k, v)
+        return resp[1:]
+
+    def _record(self, *args):
+        self.commands.append(args)
+
+    def hmset(self, name, mapping):
+        args = []
+        for k, v in mapping.iteritems():
+            args.append(k)
+            args.append(v)
+        self._record('HMSET', name, *args)
+
+    def set(self, name, value):
+        self._record('SET', name, value)
+
+    def hset(self, name, key, value):
+        self._record('HSET', name, key, value)
+
+    def hdel(self, name, *keys):
+        self._record('HDEL', name, *keys)
+
+    def sadd(self, name, *values):
+        self._record('SADD', name, *values)
+
+    def srem(self, name, *values):
+        self._record('SREM', name, *values)
+
+    def zadd(self, name, **pairs):
+        args = []
+        for value, score in pairs.iteritems():
+            args.append(score)
+            args.append(value)
+        self._record('ZADD', name, *args)
+
+    def zrem(self, name, *values):
+        self._record('ZREM', name, *values)
+
+    def zappend(self, name, *values):
+        """ Adds values to sorted set name, with scores greater than the
+            scores of all its elements (1 + the last one, and so on), so
+            elements are kept in insertion order. """
+        self.scripted = True
+        self._record('ZAPPEND', name, *values)
+
+    def rpush(self, name, *values):
+        self._record('RPUSH', name, *values)
+
+    def lrem(self, name, value, num = 0):
+        self._record('LREM', name, num, value)
+
+    def delete(self, *names):
+        for name in names:
+            self._record('DEL', name)
+
+    def rename(self, src, dst):
+        self._record('RENAME', src, dst)
+
+    def unlink(self, *names):
+        """ As delete, but memory is reclaimed in the background, so
+            deleting big keys does not block the server (redis >= 4.0). """
+        for name in names:
+            self._record('UNLINK', name)
+
+class SessionBatch(CommandBatch):
+    """ Batch of a Session. Writers record their commands into it, and
+        execute() does nothing, as commands are executed when the session
+        ends. Callbacks are called immediately, so objects written several
+        times in the session keep their state up to date. Writers must use
+        the client of the session (BadArgsError is raised otherwise, and the
+        session is not written if the error propagates out of it). """
+    def __init__(self, conn = ds):
+        CommandBatch.__init__(self)
+        self.conn = conn
+
+    def after(self, func, *args):
+        func(*args)
+
+    def execute(self, conn = ds):
+        if conn is not self.conn:
+            from redmodel.models.exceptions import BadArgsError
+            raise BadArgsError('Writer client is not the client of the session')
+        return None
+
+    def flush(self, conn = ds):
+        return CommandBatch.execute(self, conn)
+
+_local = threading.local()
+
+def current_batch():
+    """ Returns the batch of the session active in this thread, or None. """
+    return getattr(_local, 'batch', None)
+
+def new_batch():
+    """ Returns the batch where writers must record their commands: the
+        batch of the active session, or a new CommandBatch. """
+    batch = current_batch()
+    if batch is None:
+        batch = CommandBatch()
+    return batch
+
+class Session(object):
+    """ Unit of work. Inside a with block, writers in this thread record
+        their commands instead of executing them, and all of them are
+        executed in a single atomic round trip when the block exits (a
+        MULTI/EXEC pipeline, or a script if there are unique checks).
+        Nothing is written if the block raises an exception, or if a unique
+        check fails (UniqueError is raised at the end of the block).
+        Unique checks are done against data before the session and against
+        values taken earlier in the session, so values freed and taken again
+        in the same session are reported as repeated.
+        Object ids are still allocated when create is called, and reads are
+        not affected (they don't see the writes of the session until it
+        ends). If the session fails, objects written in it must be reloaded.
+        Nested sessions are part of the outermost one. Writers used in the
+        session must use its client conn (BadArgsError is raised otherwise). """
+    def __init__(self, conn = ds):
+        self.conn = conn
+        self.batch = None
+        self.outermost = False
+        self.replies = None
+
+    def __enter__(self):
+        self.batch = current_batch()
+        self.outermost = self.batch is None
+        if self.outermost:
+            self.batch = SessionBatch(self.conn)
+            _local.batch = self.batch
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.outermost:
+            _local.batch = None
+            if exc_type is None:
+                self.replies = self.batch.flush(self.conn)
+        return False
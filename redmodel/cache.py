@@ -0,0 +1,186 @@
+"""
+    Copyright (C) 2011 Maximiliano Pin
+
+    Redmodel is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Redmodel is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from redis.exceptions import ConnectionError
+from redmodel import connection as ds
+
+class ObjectCache(object):
+    """ In-process LRU cache of object data (used by Handle.load and
+        Model.load_many) and unique index lookups (used by Model.find).
+        Only models added with add_model are cached. Entries are invalidated
+        by local writers, and by a CacheInvalidator for writes from other
+        processes. Readers take a token() before reading from redis and pass
+        it to put(), so data read before an invalidation is not stored after
+        it. """
+    def __init__(self, maxsize = 10000):
+        self.maxsize = maxsize
+        self.ttls = {}
+        self.entries = OrderedDict()
+        self.subkeys = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+
+    def add_model(self, model, ttl = None):
+        """ Enables caching for model. Entries expire after ttl seconds
+            (None for no expiration). """
+        self.ttls[model._key_name] = ttl
+
+    def caches(self, model):
+        return model._key_name in self.ttls
+
+    def get(self, model, rkey, sub = None):
+        """ Returns the cached value for redis key rkey (and field sub, if
+            any), or None. """
+        k = (rkey, sub)
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(k)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires < time.time():
+                self.__forget(k)
+                self.misses += 1
+                return None
+            self.entries[k] = (expires, value)
+            self.hits += 1
+            return value
+
+    def token(self):
+        """ Returns the number of invalidations so far, to be taken before
+            reading a value from redis and passed to put. """
+        return self.generation
+
+    def put(self, model, rkey, value, sub = None, token = None):
+        """ Stores value, unless token is given and entries were invalidated
+            after it was taken (value may have been read before a write). """
+        ttl = self.ttls[model._key_name]
+        expires = None if ttl is None else time.time() + ttl
+        k = (rkey, sub)
+        with self.lock:
+            if token is not None and token != self.generation:
+                return
+            self.entries.pop(k, None)
+            self.entries[k] = (expires, value)
+            self.subkeys.setdefault(rkey, set()).add(sub)
+            while len(self.entries) > self.maxsize:
+                old, _ = self.entries.popitem(last = False)
+                self.__forget(old)
+                self.evictions += 1
+
+    def invalidate(self, rkey):
+        """ Removes all entries read from redis key rkey. """
+        with self.lock:
+            self.generation += 1
+            subs = self.subkeys.pop(rkey, ())
+            for sub in subs:
+                if self.entries.pop((rkey, sub), None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.subkeys.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
+
+    def __forget(self, k):
+        self.entries.pop(k, None)
+        subs = self.subkeys.get(k[0])
+        if subs is not None:
+            subs.discard(k[1])
+            if len(subs) == 0:
+                del self.subkeys[k[0]]
+
+class CacheInvalidator(threading.Thread):
+    """ Background thread which listens to redis keyspace notifications on
+        the keys of cached models, and invalidates cache entries written by
+        other processes. Keyspace notifications must be enabled in the redis
+        server (notify-keyspace-events); pass configure_server = True to
+        enable them. If the connection is lost, the whole cache is cleared,
+        as notifications may have been missed. """
+    def __init__(self, cache, conn = ds, db = 0, configure_server = False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.cache = cache
+        self.conn = conn
+        self.prefix = '__keyspace@{0}__:'.format(db)
+        self.configure_server = configure_server
+        self.ready = threading.Event()
+        self.stopping = False
+
+    def patterns(self):
+        pats = []
+        for name in self.cache.ttls.iterkeys():
+            pats.append(self.prefix + name + ':*')
+            pats.append(self.prefix + 'u:' + name + ':*')
+        return pats
+
+    def run(self):
+        if self.configure_server:
+            self.conn.config_set('notify-keyspace-events', 'KA')
+        while not self.stopping:
+            try:
+                self.__listen()
+            except ConnectionError:
+                self.cache.clear()
+                time.sleep(1)
+
+    def __listen(self):
+        pubsub = self.conn.pubsub()
+        try:
+            pubsub.psubscribe(*self.patterns())
+            self.ready.set()
+            while not self.stopping:
+                msg = pubsub.get_message(True, 0.1)
+                if msg is not None and msg['type'] == 'pmessage':
+                    self.cache.invalidate(msg['channel'][len(self.prefix):])
+        finally:
+            pubsub.close()
+
+    def stop(self):
+        self.stopping = True
+        self.join()
+
+_cache = None
+
+def cache_setup(maxsize = 10000):
+    """ Enables the object cache, and returns it. Models must be added to the
+        cache with add_model. """
+    global _cache
+    _cache = ObjectCache(maxsize)
+    return _cache
+
+def cache_disable():
+    global _cache
+    _cache = None
+
+def get_cache():
+    return _cache
@@ -0,0 +1,156 @@
+"""
+    Copyright (C) 2011 Maximiliano Pin
+
+    Redmodel is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Redmodel is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Redis Cluster support: hash slots of keys, detection of cluster clients,
+    and rekey, the offline tool which moves the keys of models to the
+    layout of their hash_tag setting:
+
+        python -m redmodel.cluster myapp.models --host redis1 --target-host node1
+"""
+
+import argparse
+import importlib
+import sys
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for j in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+        table.append(crc)
+    return table
+
+_crc16 = _crc16_table()
+
+SLOTS = 16384
+
+def key_slot(key):
+    """ Returns the cluster hash slot of key (CRC16 of the key, or of its
+        hash tag: the part between the first '{' and the next '}', if not
+        empty). """
+    key = str(key)
+    start = key.find('{')
+    if start >= 0:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    crc = 0
+    for c in key:
+        crc = ((crc << 8) & 0xffff) ^ _crc16[((crc >> 8) ^ ord(c)) & 0xff]
+    return crc % SLOTS
+
+def is_cluster(conn):
+    """ True if conn is a Redis Cluster client (redis-py-cluster, or
+        redis-py 4 RedisCluster). """
+    return hasattr(getattr(conn, 'connection_pool', None), 'nodes') or hasattr(conn, 'nodes_manager')
+
+def new_key(model, key):
+    """ Returns the key of model for its hash_tag setting, given a key of
+        the layout without hash tags (which is returned unchanged if it's not
+        a key of model). """
+    name = model.__name__
+    parts = key.split(':')
+    if len(parts) >= 2 and parts[0] in ('u', 'i', 'z', 'l') and parts[1] == name:
+        return ':'.join([parts[0], model._key_name] + parts[2:])
+    if parts[0] != name or len(parts) < 2:
+        return key
+    if len(parts) == 3:
+        f = getattr(model, parts[2], None)
+        if f in model._lists or f in model._sets or f in model._zsets:
+            return model._container_key(parts[1], f)
+    return ':'.join([model._key_name] + parts[1:])
+
+def rekey(models, source, target = None, batch_size = 500, progress = None):
+    """ Moves the keys of models written without hash tags to the layout of
+        their hash_tag setting. Keys are walked with SCAN on source, and
+        renamed in place (target None, only for a single server), or copied
+        to target (e.g. a cluster client) with DUMP and RESTORE and then
+        deleted from source. Writers must be stopped meanwhile. progress(n)
+        is called after every batch with the number of keys moved so far.
+        Returns that number. """
+    n = 0
+    for model in models:
+        if model._hash_tag is None:
+            continue
+        name = model.__name__
+        for pattern in [name + ':*'] + [p + ':' + name + ':*' for p in 'uizl']:
+            keys = []
+            for key in source.scan_iter(pattern, batch_size):
+                keys.append(key)
+                if len(keys) == batch_size:
+                    n = _move(model, keys, source, target, n, progress)
+                    keys = []
+            if len(keys):
+                n = _move(model, keys, source, target, n, progress)
+    return n
+
+def _move(model, keys, source, target, n, progress):
+    if target is None:
+        pl = source.pipeline(False)
+        for key in keys:
+            pl.rename(key, new_key(model, key))
+        pl.execute()
+    else:
+        pl = source.pipeline(False)
+        for key in keys:
+            pl.dump(key)
+            pl.pttl(key)
+        resps = pl.execute()
+        pl = target.pipeline(False)
+        for key, data, ttl in zip(keys, resps[::2], resps[1::2]):
+            if data is not None:
+                pl.restore(new_key(model, key), max(ttl, 0), data)
+        pl.execute()
+        source.delete(*keys)
+    n += len(keys)
+    if progress is not None:
+        progress(n)
+    return n
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Moves the keys of the models '
+            'defined in a module to the layout of their hash_tag setting.')
+    parser.add_argument('module', help = 'python module defining the models')
+    parser.add_argument('--host', default = 'localhost')
+    parser.add_argument('--port', type = int, default = 6379)
+    parser.add_argument('--db', type = int, default = 0)
+    parser.add_argument('--target-host', help = 'a node of the target cluster '
+                        '(by default, keys are renamed in the source server)')
+    parser.add_argument('--target-port', type = int, default = 6379)
+    parser.add_argument('--batch-size', type = int, default = 500)
+    args = parser.parse_args(argv)
+
+    import redis
+    from redmodel.models import Model
+    module = importlib.import_module(args.module)
+    models = [v for v in vars(module).values()
+              if isinstance(v, type) and issubclass(v, Model) and v is not Model]
+    source = redis.Redis(host = args.host, port = args.port, db = args.db)
+    target = None
+    if args.target_host is not None:
+        from rediscluster import RedisCluster
+        target = RedisCluster(startup_nodes = [{'host': args.target_host, 'port': args.target_port}])
+    def progress(n):
+        sys.stderr.write('{0} keys moved\n'.format(n))
+    rekey(models, source, target, args.batch_size, progress)
+
+if __name__ == '__main__':
+    main()
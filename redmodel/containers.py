@@ -15,7 +15,10 @@
     along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from array import array
 from redmodel import connection as ds
+from redmodel.batch import CommandBatch, new_batch, current_batch
+from redmodel.instrument import operation
 
 class Error(Exception):
     pass
@@ -29,14 +32,142 @@ class UniqueError(Error):
 class BadArgsError(Error):
     pass
 
+class HandleList(list):
+    """ List of model handles, as returned by queries. """
+    def load_many(self, fields = None, conn = None, prefetch = None):
+        """ Loads all the referenced objects in a single round trip.
+            See Model.load_many. """
+        return _load_handles(self, fields, conn, prefetch)
+
+class HandleSet(set):
+    """ Set of model handles, as returned by queries. """
+    def load_many(self, fields = None, conn = None, prefetch = None):
+        """ Loads all the referenced objects in a single round trip.
+            See Model.load_many. """
+        return _load_handles(self, fields, conn, prefetch)
+
+class HandleArray(object):
+    """ Compact collection of handles of a model. Object ids are stored in
+        an array of integers, and handles are created only when elements are
+        accessed. Elements are unique and keep their insertion order.
+        Set operations (&, |, -, ^) with other arrays of the same model work
+        on the ids, without creating handles. Membership tests use a set of
+        the ids, built on the first test. """
+    def __init__(self, model, oids = ()):
+        self.model = model
+        self.oids = array('l')
+        self._ids = None
+        seen = set()
+        for oid in oids:
+            oid = int(oid)
+            if oid not in seen:
+                seen.add(oid)
+                self.oids.append(oid)
+
+    @classmethod
+    def _from_array(cls, model, oids):
+        a = cls(model)
+        a.oids = oids
+        return a
+
+    def __repr__(self):
+        return '<HandleArray: {0} {1}>'.format(self.model.__name__, list(self.oids))
+
+    def __len__(self):
+        return len(self.oids)
+
+    def __iter__(self):
+        model = self.model
+        for oid in self.oids:
+            yield model.by_id(oid)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return HandleArray._from_array(self.model, self.oids[i])
+        return self.model.by_id(self.oids[i])
+
+    def __contains__(self, h):
+        oid = h.oid if hasattr(h, 'oid') else h
+        return int(oid) in self._id_set()
+
+    def _id_set(self):
+        """ Returns the set of ids, rebuilt if oids changed (elements are
+            unique, so appending or removing changes the length). """
+        if self._ids is None or len(self._ids) != len(self.oids):
+            self._ids = set(self.oids)
+        return self._ids
+
+    def __eq__(self, other):
+        if isinstance(other, HandleArray):
+            return self.model is other.model and self._id_set() == other._id_set()
+        return set(self) == set(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __and__(self, other):
+        s = self.__other_ids(other)
+        return self.__filter(lambda oid: oid in s)
+
+    def __sub__(self, other):
+        s = self.__other_ids(other)
+        return self.__filter(lambda oid: oid not in s)
+
+    def __or__(self, other):
+        self.__other_ids(other)
+        return HandleArray._from_array(self.model, self.oids + (other - self).oids)
+
+    def __xor__(self, other):
+        return (self - other) | (other - self)
+
+    def __other_ids(self, other):
+        assert isinstance(other, HandleArray) and other.model is self.model
+        return other._id_set()
+
+    def __filter(self, pred):
+        return HandleArray._from_array(self.model, array('l', (oid for oid in self.oids if pred(oid))))
+
+    def load_many(self, fields = None, conn = None, prefetch = None):
+        """ Loads all the referenced objects in a single round trip.
+            See Model.load_many. """
+        return self.model.load_many(self, fields, conn, prefetch)
+
+def _load_handles(handles, fields, conn, prefetch):
+    for h in handles:
+        return h.model.load_many(handles, fields, conn, prefetch)
+    return []
+
+def zrange_bounds(cond, val):
+    """ Returns the (min, max) ZRANGEBYSCORE arguments for a zfind
+        condition. """
+    if cond == 'lte':
+        return ('-inf', val)
+    elif cond == 'lt':
+        return ('-inf', '(' + str(val))
+    elif cond == 'gte':
+        return (val, '+inf')
+    elif cond == 'gt':
+        return ('(' + str(val), '+inf')
+    elif cond == 'in':
+        return (val[0], val[1])
+    elif cond == 'eq':
+        return (val, val)
+    else:
+        raise BadArgsError('Wrong zfind condition: ' + cond)
+
 class ContainerHandle(object):
-    def __init__(self, key, target_type):
+    # elements read by a load with prefetch (objects for model elements)
+    prefetched = None
+
+    def __init__(self, key, target_type, conn = None):
+        """ Reads use conn if given, or the global connection. """
         self.key = key
         self.target_type = target_type
+        self.conn = ds if conn is None else conn
 
     @property
     def owner_id(self):
-        return self.key.split(':')[1]
+        return self.key.split(':')[1].rstrip('}')
 
     def __repr__(self):
         return '<{0}: {1}>'.format(self.__class__.__name__, self.key)
@@ -45,70 +176,159 @@ class ContainerHandle(object):
         try:
             func = getattr(self.target_type, 'by_id')
         except AttributeError:
-            func = self.target_type
-        return map(func, data)
+            return map(self.target_type, data)
+        return HandleList(map(func, data))
+
+    def _generate(self, pages, load):
+        """ Generates the elements of pages (lists of raw elements). If load
+            is True, the objects of every page are loaded with load_many
+            (objects which don't exist are skipped). """
+        assert not load or hasattr(self.target_type, 'load_many')
+        for page in pages:
+            items = self._transform(page)
+            if load:
+                items = [obj for obj in self.target_type.load_many(items, conn = self.conn) if obj is not None]
+            for item in items:
+                yield item
+
+    def _range_pages(self, func, batch):
+        start = 0
+        while True:
+            page = func(self.key, start, start + batch - 1)
+            if len(page):
+                yield page
+            if len(page) < batch:
+                break
+            start += batch
 
 class ListHandle(ContainerHandle):
+    @operation('ListHandle.load')
+    def load(self):
+        d = self.conn.lrange(self.key, 0, -1)
+        return self._transform(d)
+
+    def iter(self, batch = 500, load = False):
+        """ Returns a generator of the list elements, which are read with
+            LRANGE, batch elements at a time. If load is True (model
+            elements), objects are generated instead of handles, loaded with
+            a load_many call per batch. Elements may be skipped or repeated if
+            the list is modified during the iteration. """
+        return self._generate(self._range_pages(self.conn.lrange, batch), load)
+
+class ZListHandle(ListHandle):
+    """ List stored in a sorted set scored by insertion sequence (see
+        ListField backend = 'zset'). Elements are unique (appending an
+        element which is already in the list moves it to the end), and
+        removal, membership test, index and range lookups are O(log N). """
+    @operation('ZListHandle.load')
     def load(self):
-        d = ds.lrange(self.key, 0, -1)
+        d = self.conn.zrange(self.key, 0, -1)
         return self._transform(d)
 
+    def iter(self, batch = 500, load = False):
+        """ See ListHandle.iter (elements are read with ZRANGE). """
+        return self._generate(self._range_pages(self.conn.zrange, batch), load)
+
+    @operation('ZListHandle.range')
+    def range(self, start = 0, end = -1):
+        """ Returns elements start to end (inclusive, as LRANGE). """
+        return self._transform(self.conn.zrange(self.key, start, end))
+
+    @operation('ZListHandle.index')
+    def index(self, value):
+        """ Returns the position of value, or None if it's not in the list. """
+        return self.conn.zrank(self.key, self.__raw(value))
+
+    @operation('ZListHandle.contains')
+    def contains(self, value):
+        return self.conn.zscore(self.key, self.__raw(value)) is not None
+
+    @operation('ZListHandle.count')
+    def count(self):
+        return self.conn.zcard(self.key)
+
+    def __raw(self, value):
+        assert type(value) is self.target_type or (hasattr(value, 'model') and value.model is self.target_type)
+        if hasattr(self.target_type, 'oid'):
+            value = value.oid
+        return value
+
 class SetHandle(ContainerHandle):
+    @operation('SetHandle.load')
     def load(self):
-        d = ds.smembers(self.key)
+        d = self.conn.smembers(self.key)
         return self._transform(d)
 
+    def iter(self, batch = 500, load = False):
+        """ Returns a generator of the set elements, which are read with
+            SSCAN, about batch elements at a time. See ListHandle.iter.
+            Notice SSCAN may return an element more than once if the set is
+            modified during the iteration. """
+        return self._generate(self._sscan_pages(batch), load)
+
+    def _sscan_pages(self, batch):
+        cursor = 0
+        while True:
+            cursor, page = self.conn.sscan(self.key, cursor, count = batch)
+            if len(page):
+                yield page
+            if int(cursor) == 0:
+                break
+
+    @operation('SetHandle.sismember')
     def sismember(self, value):
         assert type(value) is self.target_type or (hasattr(value, 'model') and value.model is self.target_type)
         if hasattr(self.target_type, 'oid'):
             value = value.oid
-        return ds.sismember(self.key, value)
+        return self.conn.sismember(self.key, value)
 
 class SortedSetHandle(ContainerHandle):
+    def iter(self, batch = 500, load = False):
+        """ Returns a generator of the sorted set elements, in order, which
+            are read with ZRANGE, batch elements at a time. See
+            ListHandle.iter. """
+        return self._generate(self._range_pages(self.conn.zrange, batch), load)
+
+    @operation('SortedSetHandle.zfind')
     def zfind(self, **kwargs):
         assert len(kwargs) == 1
         cond, val = kwargs.popitem()
-        if cond == 'lte':
-            return self.zrangebyscore('-inf', val)
-        elif cond == 'lt':
-            return self.zrangebyscore('-inf', '(' + str(val))
-        elif cond == 'gte':
-            return self.zrangebyscore(val, '+inf')
-        elif cond == 'gt':
-            return self.zrangebyscore('(' + str(val), '+inf')
-        elif cond == 'in':
-            return self.zrangebyscore(val[0], val[1])
-        elif cond == 'eq':
-            return self.zrangebyscore(val, val)
-        else:
-            raise BadArgsError('Wrong zfind condition: ' + cond)
+        smin, smax = zrange_bounds(cond, val)
+        return self.zrangebyscore(smin, smax)
 
+    @operation('SortedSetHandle.zrange')
     def zrange(self, start = 0, end = -1):
-        return self._transform(ds.zrange(self.key, start, end))
+        return self._transform(self.conn.zrange(self.key, start, end))
 
+    @operation('SortedSetHandle.zrevrange')
     def zrevrange(self, start = 0, end = -1):
-        return self._transform(ds.zrevrange(self.key, start, end))
+        return self._transform(self.conn.zrevrange(self.key, start, end))
 
+    @operation('SortedSetHandle.zrangebyscore')
     def zrangebyscore(self, smin, smax, start = None, num = None):
-        return self._transform(ds.zrangebyscore(self.key, smin, smax, start, num))
+        return self._transform(self.conn.zrangebyscore(self.key, smin, smax, start, num))
 
+    @operation('SortedSetHandle.zrevrangebyscore')
     def zrevrangebyscore(self, smax, smin, start = None, num = None):
-        return self._transform(ds.zrevrangebyscore(self.key, smax, smin, start, num))
+        return self._transform(self.conn.zrevrangebyscore(self.key, smax, smin, start, num))
 
+    @operation('SortedSetHandle.zcount')
     def zcount(self, smin, smax):
-        return ds.zcount(self.key, smin, smax)
+        return self.conn.zcount(self.key, smin, smax)
 
+    @operation('SortedSetHandle.zrank')
     def zrank(self, value):
         assert type(value) is self.target_type or (hasattr(value, 'model') and value.model is self.target_type)
         if hasattr(self.target_type, 'oid'):
             value = value.oid
-        return ds.zrank(self.key, value)
+        return self.conn.zrank(self.key, value)
 
+    @operation('SortedSetHandle.zrevrank')
     def zrevrank(self, value):
         assert type(value) is self.target_type or (hasattr(value, 'model') and value.model is self.target_type)
         if hasattr(self.target_type, 'oid'):
             value = value.oid
-        return ds.zrevrank(self.key, value)
+        return self.conn.zrevrank(self.key, value)
 
 #class List(list):
 #    def __init__(self, handle):
@@ -116,7 +336,7 @@ class SortedSetHandle(ContainerHandle):
 
 class List(tuple):
     def __new__(cls, handle):
-        assert type(handle) is ListHandle
+        assert isinstance(handle, ListHandle)
         return tuple.__new__(cls, handle.load())
 
 #class Set(set):
@@ -181,12 +401,15 @@ class SortedSet(tuple):
         return handle.zrevrank(value)
 
 class ContainerWriter(object):
-    def __init__(self, target_type, index_key = None, unique_index = False):
+    def __init__(self, target_type, index_key = None, unique_index = False, conn = None):
+        """ Writes use conn if given, or the global connection. """
+        self.conn = ds if conn is None else conn
         self.target_type = target_type
         self.target_has_id = hasattr(target_type, 'oid')
         self.index_key = index_key
         self.unique_index = unique_index
 
+    @operation('ContainerWriter.append')
     def append(self, hcont, value, score = None):
         assert hcont.target_type is self.target_type
         assert type(value) is self.target_type or (hasattr(value, 'model') and value.model is self.target_type)
@@ -194,57 +417,186 @@ class ContainerWriter(object):
             value = value.oid
         assert value is not None
         if not self.index_key:
-            self.raw_append(ds, hcont, value, score)
-        elif self.unique_index:
-            #TODO watch (optimistic lock) to allow multithread?
-            if ds.hexists(self.index_key, value):
-                raise UniqueError(self.index_key, value)
-            else:
-                pl = ds.pipeline(True)
-                self.raw_append(pl, hcont, value, score)
-                pl.hset(self.index_key, value, hcont.owner_id)
-                pl.execute()
+            self.raw_append(self.__conn(), hcont, value, score)
         else:
-            pl = ds.pipeline(True)
-            self.raw_append(pl, hcont, value, score)
-            ikey = self.index_key + ':' + str(value)
-            pl.sadd(ikey, hcont.owner_id)
-            pl.execute()
+            batch = new_batch()
+            self.raw_append(batch, hcont, value, score)
+            if self.unique_index:
+                batch.check_unique(self.index_key, value)
+                batch.hset(self.index_key, value, hcont.owner_id)
+            else:
+                ikey = self.index_key + ':' + str(value)
+                batch.sadd(ikey, hcont.owner_id)
+            batch.execute(self.conn)
 
+    @operation('ContainerWriter.remove')
     def remove(self, hcont, value):
         assert hcont.target_type is self.target_type
         assert type(value) is self.target_type or (hasattr(value, 'model') and value.model is self.target_type)
         if self.target_has_id:
             value = value.oid
         if not self.index_key:
-            return self.raw_remove(ds, hcont, value)
+            return self.raw_remove(self.__conn(), hcont, value)
         else:
-            pl = ds.pipeline(True)
+            batch = new_batch()
             if self.unique_index:
-                pl.hdel(self.index_key, value)
+                batch.hdel(self.index_key, value)
             else:
                 ikey = self.index_key + ':' + str(value)
-                pl.srem(ikey, hcont.owner_id)
-            self.raw_remove(pl, hcont, value)
-            resp = pl.execute()
+                batch.srem(ikey, hcont.owner_id)
+            self.raw_remove(batch, hcont, value)
+            resp = batch.execute(self.conn)
+            if resp is None:
+                return None
             return resp[1]
 
+    @operation('ContainerWriter.extend')
+    def extend(self, hcont, values, scores = None):
+        """ Appends all values atomically, in a single round trip. Elements
+            are added with variadic commands (RPUSH, SADD, ZADD), in chunks
+            of EXTEND_CHUNK elements. For sorted sets, scores is the list of
+            scores of values. For unique indexes, all values are checked
+            before writing anything (UniqueError is raised if a value is
+            already indexed, or repeated in values). """
+        values = [self._raw_value(hcont, v) for v in values]
+        if scores is not None:
+            scores = list(scores)
+            assert len(scores) == len(values)
+        if len(values) == 0:
+            return
+        if not self.index_key:
+            self.raw_extend(self.__conn(), hcont, values, scores)
+        else:
+            batch = new_batch()
+            self._record_extend(batch, hcont, values, scores)
+            batch.execute(self.conn)
+
+    @operation('ContainerWriter.remove_many')
+    def remove_many(self, hcont, values):
+        """ Removes all values atomically, in a single round trip (with
+            variadic commands, except for lists). Returns the number of
+            removed elements, or None in a Session. """
+        values = [self._raw_value(hcont, v) for v in values]
+        if len(values) == 0:
+            return 0
+        batch = new_batch()
+        first = len(batch.commands)
+        n = self._record_remove_many(batch, hcont, values)
+        resp = batch.execute(self.conn)
+        if resp is None:
+            return None
+        return sum(resp[first:first + n])
+
+    def _raw_value(self, hcont, value):
+        assert hcont.target_type is self.target_type
+        assert type(value) is self.target_type or (hasattr(value, 'model') and value.model is self.target_type)
+        if self.target_has_id:
+            value = value.oid
+        assert value is not None
+        return value
+
+    def _record_extend(self, batch, hcont, values, scores):
+        """ Records the addition of raw values (and their index entries and
+            unique checks) into batch. """
+        self.raw_extend(batch, hcont, values, scores)
+        if self.index_key:
+            owner = hcont.owner_id
+            if self.unique_index:
+                for v in values:
+                    batch.check_unique(self.index_key, v)
+                for chunk in _chunks(values):
+                    batch.hmset(self.index_key, dict((v, owner) for v in chunk))
+            else:
+                for v in values:
+                    batch.sadd(self.index_key + ':' + str(v), owner)
+
+    def _record_remove_many(self, batch, hcont, values):
+        """ Records the removal of raw values (and their index entries) into
+            batch. Returns the number of container commands, which are
+            recorded first. """
+        n = len(batch.commands)
+        self.raw_remove_many(batch, hcont, values)
+        n = len(batch.commands) - n
+        if self.index_key:
+            if self.unique_index:
+                for chunk in _chunks(values):
+                    batch.hdel(self.index_key, *chunk)
+            else:
+                owner = hcont.owner_id
+                for v in values:
+                    batch.srem(self.index_key + ':' + str(v), owner)
+        return n
+
+    def __conn(self):
+        """ The active session batch, or the connection. """
+        batch = current_batch()
+        if batch is None:
+            return self.conn
+        return batch
+
+# maximum number of elements per command of extend and remove_many (Lua
+# scripts, used for unique checks, cannot unpack many more arguments)
+EXTEND_CHUNK = 1000
+
+def _chunks(values):
+    for i in range(0, len(values), EXTEND_CHUNK):
+        yield values[i:i + EXTEND_CHUNK]
+
+def _zappend(conn, key, values):
+    """ zappend is not a redis command, so it needs a batch. """
+    if isinstance(conn, CommandBatch):
+        conn.zappend(key, *values)
+    else:
+        batch = CommandBatch()
+        batch.zappend(key, *values)
+        batch.execute(conn)
+
 class ListWriter(ContainerWriter):
-    def __init__(self, target_type, index_key = None, unique_index = False):
-        ContainerWriter.__init__(self, target_type, index_key, unique_index)
+    """ Writes lists, or sorted set lists (ZListHandle). """
+    def __init__(self, target_type, index_key = None, unique_index = False, conn = None):
+        ContainerWriter.__init__(self, target_type, index_key, unique_index, conn)
 
     def raw_append(self, conn, hlist, value, score):
-        assert type(hlist) is ListHandle
+        assert isinstance(hlist, ListHandle)
         assert score is None
-        conn.rpush(hlist.key, value)
+        if type(hlist) is ZListHandle:
+            _zappend(conn, hlist.key, [value])
+        else:
+            conn.rpush(hlist.key, value)
 
     def raw_remove(self, conn, hlist, value):
-        assert type(hlist) is ListHandle
+        assert isinstance(hlist, ListHandle)
+        if type(hlist) is ZListHandle:
+            return conn.zrem(hlist.key, value)
         return conn.lrem(hlist.key, value)
 
+    def raw_extend(self, conn, hlist, values, scores):
+        assert isinstance(hlist, ListHandle)
+        assert scores is None
+        for chunk in _chunks(values):
+            if type(hlist) is ZListHandle:
+                _zappend(conn, hlist.key, chunk)
+            else:
+                conn.rpush(hlist.key, *chunk)
+
+    def raw_remove_many(self, conn, hlist, values):
+        assert isinstance(hlist, ListHandle)
+        if type(hlist) is ZListHandle:
+            for chunk in _chunks(values):
+                conn.zrem(hlist.key, *chunk)
+        else:
+            for v in values:
+                conn.lrem(hlist.key, v)
+
+    def raw_contains(self, conn, hlist, value):
+        assert isinstance(hlist, ListHandle)
+        if type(hlist) is ZListHandle:
+            return conn.zscore(hlist.key, value) is not None
+        return str(value) in conn.lrange(hlist.key, 0, -1)
+
 class SetWriter(ContainerWriter):
-    def __init__(self, target_type, index_key = None, unique_index = False):
-        ContainerWriter.__init__(self, target_type, index_key, unique_index)
+    def __init__(self, target_type, index_key = None, unique_index = False, conn = None):
+        ContainerWriter.__init__(self, target_type, index_key, unique_index, conn)
 
     def raw_append(self, conn, hset, value, score):
         assert type(hset) is SetHandle
@@ -255,9 +607,24 @@ class SetWriter(ContainerWriter):
         assert type(hset) is SetHandle
         return conn.srem(hset.key, value)
 
+    def raw_extend(self, conn, hset, values, scores):
+        assert type(hset) is SetHandle
+        assert scores is None
+        for chunk in _chunks(values):
+            conn.sadd(hset.key, *chunk)
+
+    def raw_remove_many(self, conn, hset, values):
+        assert type(hset) is SetHandle
+        for chunk in _chunks(values):
+            conn.srem(hset.key, *chunk)
+
+    def raw_contains(self, conn, hset, value):
+        assert type(hset) is SetHandle
+        return conn.sismember(hset.key, value)
+
 class SortedSetWriter(ContainerWriter):
-    def __init__(self, target_type, index_key = None, unique_index = False):
-        ContainerWriter.__init__(self, target_type, index_key, unique_index)
+    def __init__(self, target_type, index_key = None, unique_index = False, conn = None):
+        ContainerWriter.__init__(self, target_type, index_key, unique_index, conn)
 
     def raw_append(self, conn, hset, value, score):
         assert type(hset) is SortedSetHandle
@@ -267,3 +634,19 @@ class SortedSetWriter(ContainerWriter):
     def raw_remove(self, conn, hset, value):
         assert type(hset) is SortedSetHandle
         return conn.zrem(hset.key, value)
+
+    def raw_extend(self, conn, hset, values, scores):
+        assert type(hset) is SortedSetHandle
+        assert scores is not None
+        pairs = zip(map(str, values), scores)
+        for chunk in _chunks(pairs):
+            conn.zadd(hset.key, **dict(chunk))
+
+    def raw_remove_many(self, conn, hset, values):
+        assert type(hset) is SortedSetHandle
+        for chunk in _chunks(values):
+            conn.zrem(hset.key, *chunk)
+
+    def raw_contains(self, conn, hset, value):
+        assert type(hset) is SortedSetHandle
+        return conn.zscore(hset.key, value) is not None
@@ -0,0 +1,351 @@
+"""
+    Copyright (C) 2011 Maximiliano Pin
+
+    Redmodel is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Redmodel is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Instrumentation of redmodel operations (loads, queries, writer and
+    container methods). When listeners are registered, every operation is
+    timed and reported to them as an Operation. Commands, round trips,
+    pipelines and bytes are counted on clients passed to enable(). """
+
+import os
+import sys
+import threading
+import timeit
+import warnings
+from functools import wraps
+from redmodel import connection as ds
+
+class Operation(object):
+    """ A finished operation, as reported to listeners. Counts include the
+        nested operations (depth is 0 for operations not called by others).
+        A pipeline (MULTI/EXEC batches included) is sent in one round trip,
+        whatever its number of commands; pipelines counts them. """
+    __slots__ = ('name', 'model', 'depth', 'elapsed', 'commands',
+                 'round_trips', 'pipelines', 'bytes_sent', 'bytes_received',
+                 'error')
+
+    def __init__(self, name, model, depth):
+        self.name = name
+        self.model = model
+        self.depth = depth
+        self.elapsed = 0.0
+        self.commands = 0
+        self.round_trips = 0
+        self.pipelines = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = None
+
+    def __repr__(self):
+        return '<Operation {0} {1}: {2:.6f}s, {3} commands, {4} round trips>'.format(
+               self.name, self.model, self.elapsed, self.commands, self.round_trips)
+
+_listeners = []
+_local = threading.local()
+
+def add_listener(callback):
+    """ Registers callback, which is called with every finished Operation,
+        in the thread which ran it. """
+    _listeners.append(callback)
+
+def remove_listener(callback):
+    _listeners.remove(callback)
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+def _model_name(args):
+    """ Guesses the model of an operation from its arguments: a model class,
+        an object with a model (handles, writers), a container field writer,
+        or a container handle. """
+    obj = args[0]
+    if isinstance(obj, type):
+        return obj.__name__
+    model = getattr(obj, 'model', None)
+    if isinstance(model, type):
+        return model.__name__
+    field = getattr(obj, 'field', None)
+    if field is not None:
+        return field.model.__name__
+    for a in args:
+        key = getattr(a, 'key', None)
+        if isinstance(key, str):
+            return key.split(':')[0].strip('{}')
+    return None
+
+def operation(name):
+    """ Decorator of redmodel operations. """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _listeners:
+                return func(*args, **kwargs)
+            stack = _stack()
+            op = Operation(name, _model_name(args), len(stack))
+            stack.append(op)
+            t = timeit.default_timer()
+            try:
+                return func(*args, **kwargs)
+            except Exception, e:
+                op.error = e.__class__.__name__
+                raise
+            finally:
+                op.elapsed = timeit.default_timer() - t
+                stack.pop()
+                if len(stack):
+                    parent = stack[-1]
+                    parent.commands += op.commands
+                    parent.round_trips += op.round_trips
+                    parent.pipelines += op.pipelines
+                    parent.bytes_sent += op.bytes_sent
+                    parent.bytes_received += op.bytes_received
+                for callback in list(_listeners):
+                    callback(op)
+        return wrapper
+    return decorator
+
+def _reply_size(r):
+    if isinstance(r, (list, tuple)):
+        return sum(_reply_size(x) for x in r)
+    if isinstance(r, str):
+        return len(r)
+    return 8
+
+class CountingConnectionMixin(object):
+    """ Counts the commands, round trips, pipelines and bytes of the
+        operation running in the current thread. """
+    def pack_command(self, *args):
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            stack[-1].commands += 1
+        return super(CountingConnectionMixin, self).pack_command(*args)
+
+    def pack_commands(self, commands):
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            stack[-1].pipelines += 1
+        return super(CountingConnectionMixin, self).pack_commands(commands)
+
+    def send_packed_command(self, command):
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            op = stack[-1]
+            op.round_trips += 1
+            op.bytes_sent += len(command) if isinstance(command, str) else sum(map(len, command))
+        return super(CountingConnectionMixin, self).send_packed_command(command)
+
+    def read_response(self):
+        r = super(CountingConnectionMixin, self).read_response()
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            stack[-1].bytes_received += _reply_size(r)
+        return r
+
+_counting_classes = {}
+
+def enable(conn = ds):
+    """ Makes the connections of client conn count commands, round trips and
+        bytes. Connections already open are closed. """
+    pool = conn.connection_pool
+    cls = pool.connection_class
+    if issubclass(cls, CountingConnectionMixin):
+        return
+    counting = _counting_classes.get(cls)
+    if counting is None:
+        counting = type('Counting' + cls.__name__, (CountingConnectionMixin, cls), {})
+        _counting_classes[cls] = counting
+    pool.disconnect()
+    pool.reset()
+    pool.connection_class = counting
+
+def disable(conn = ds):
+    pool = conn.connection_pool
+    cls = pool.connection_class
+    if issubclass(cls, CountingConnectionMixin):
+        pool.disconnect()
+        pool.reset()
+        pool.connection_class = cls.__bases__[1]
+
+class Histogram(object):
+    """ Histogram with exponential buckets: bucket i counts values up to
+        first * 2 ** i (the last one counts bigger values too). """
+    def __init__(self, first = 1e-6, nbuckets = 24):
+        self.bounds = [first * 2 ** i for i in range(nbuckets)]
+        self.counts = [0] * nbuckets
+        self.total = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        for i, b in enumerate(self.bounds):
+            if value <= b:
+                break
+        self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """ Returns the upper bound of the bucket of percentile p. """
+        if self.total == 0:
+            return None
+        n = p / 100.0 * self.total
+        acc = 0
+        for b, c in zip(self.bounds, self.counts):
+            acc += c
+            if acc >= n:
+                return b
+        return self.bounds[-1]
+
+    def to_dict(self):
+        return {'bounds': self.bounds, 'counts': self.counts,
+                'total': self.total, 'sum': self.sum}
+
+class Aggregator(object):
+    """ Listener which aggregates operations by (name, model): number of
+        calls and errors, totals of commands, round trips, pipelines and
+        bytes, and a histogram of times. Only top level operations are
+        aggregated, unless nested is True. Usage:
+            agg = Aggregator()
+            instrument.add_listener(agg)
+            ...
+            stats = agg.snapshot() """
+    def __init__(self, nested = False):
+        self.nested = nested
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def __call__(self, op):
+        if op.depth and not self.nested:
+            return
+        with self.lock:
+            s = self.stats.get((op.name, op.model))
+            if s is None:
+                s = self.stats[(op.name, op.model)] = {'calls': 0, 'errors': 0,
+                        'commands': 0, 'round_trips': 0, 'pipelines': 0, 'bytes_sent': 0,
+                        'bytes_received': 0, 'time': Histogram()}
+            s['calls'] += 1
+            if op.error is not None:
+                s['errors'] += 1
+            s['commands'] += op.commands
+            s['round_trips'] += op.round_trips
+            s['pipelines'] += op.pipelines
+            s['bytes_sent'] += op.bytes_sent
+            s['bytes_received'] += op.bytes_received
+            s['time'].add(op.elapsed)
+
+    def snapshot(self):
+        """ Returns a dict 'name model' -> stats (p50 and p99 are upper
+            bounds of histogram buckets). """
+        with self.lock:
+            res = {}
+            for (name, model), s in self.stats.iteritems():
+                d = dict(s)
+                h = d.pop('time')
+                d['time'] = h.to_dict()
+                d['p50'] = h.percentile(50)
+                d['p99'] = h.percentile(99)
+                res['{0} {1}'.format(name, model)] = d
+            return res
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+class NPlusOneWarning(UserWarning):
+    pass
+
+class NPlusOneError(Exception):
+    pass
+
+_package_dir = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+def _call_site():
+    """ Returns 'file:line in function' for the innermost frame outside
+        redmodel. """
+    f = sys._getframe(1)
+    while f is not None and os.path.abspath(f.f_code.co_filename).startswith(_package_dir):
+        f = f.f_back
+    if f is None:
+        return None
+    return '{0}:{1} in {2}'.format(f.f_code.co_filename, f.f_lineno, f.f_code.co_name)
+
+# batched alternatives suggested by NPlusOneDetector
+ALTERNATIVES = {
+    'Handle.load': 'Model.load_many(handles), or prefetch when loading the objects which reference them',
+    'ListHandle.load': 'prefetch the container field when loading its owners',
+    'SetHandle.load': 'prefetch the container field when loading its owners',
+    'SetHandle.sismember': 'load the set once (or prefetch it) and test membership in python',
+    'SortedSetHandle.zrange': 'prefetch the container field when loading its owners',
+    'ModelWriter.create': 'ModelWriter.create_many(objs)',
+    'ModelWriter.update': 'a Session, to write all the changes in one round trip',
+    'ModelWriter.delete': 'a Session, to write all the changes in one round trip',
+    'ContainerFieldWriter.append': 'ContainerFieldWriter.extend(hcont, values)',
+    'ContainerFieldWriter.remove': 'ContainerFieldWriter.remove_many(hcont, values)',
+    'Model.find': 'Model.query with several conditions, or a HMGET on the unique index',
+    'Model.multifind': 'Model.query with several conditions'}
+
+class NPlusOneDetector(object):
+    """ Detects operations repeated in a scope (a with block, in the thread
+        which enters it), like loads in a loop. When the same operation on
+        the same model is called more than threshold times, a NPlusOneWarning
+        is issued, naming the call sites and a batched alternative. If
+        action is 'raise', NPlusOneError is raised instead when the block
+        ends. The reports are kept in the reports attribute.
+        Only top level operations are counted (e.g. a load_many counts as
+        one operation, whatever the objects it loads). Usage:
+            with instrument.NPlusOneDetector(threshold = 10):
+                handle_request() """
+    def __init__(self, threshold = 10, action = 'warn'):
+        assert action in ('warn', 'raise')
+        self.threshold = threshold
+        self.action = action
+        self.counts = {}
+        self.sites = {}
+        self.reports = []
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.current_thread()
+        add_listener(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remove_listener(self)
+        if exc_type is None and self.action == 'raise' and len(self.reports):
+            raise NPlusOneError('\n'.join(self.reports))
+        return False
+
+    def __call__(self, op):
+        if op.depth or threading.current_thread() is not self.thread:
+            return
+        k = (op.name, op.model)
+        n = self.counts.get(k, 0) + 1
+        self.counts[k] = n
+        sites = self.sites.setdefault(k, [])
+        if n <= self.threshold + 1 and len(sites) < 3:
+            site = _call_site()
+            if site not in sites:
+                sites.append(site)
+        if n == self.threshold + 1:
+            report = '{0} on {1} called more than {2} times, at {3}. Use {4}.'.format(
+                     op.name, op.model, self.threshold, '; '.join(map(str, sites)),
+                     ALTERNATIVES.get(op.name, 'a batched alternative (load_many, prefetch, create_many or a Session)'))
+            self.reports.append(report)
+            if self.action == 'warn':
+                warnings.warn(report, NPlusOneWarning, stacklevel = 2)
@@ -8,4 +8,4 @@ __all__ = ['Handle', 'ishandle', 'Model',
            'UTCDateTimeField', 'ReferenceField', 'ListField', 'SetField',
            'Recursive',
            'ModelWriter', 'ListFieldWriter', 'SetFieldWriter',
-           'Error', 'NotFoundError', 'UniqueError']
+           'Error', 'NotFoundError', 'UniqueError', 'SchemaError']
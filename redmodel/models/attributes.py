@@ -17,14 +17,37 @@
 
 from datetime import datetime
 import calendar
+from redmodel.containers import ListHandle, ZListHandle
 
 class Attribute(object):
+    # how values are stored by models with storage = 'packed' (see packing)
+    pack_kind = 'str'
+    # python expressions equivalent to typecast_for_read/typecast_for_write,
+    # inlined in the code generated for every model (see codegen). {v} is
+    # the value, and {a} the attribute. Subclasses which don't define them
+    # use the typecast methods.
+    read_expr = '{v}'
+    write_expr = '{v}'
+
     def __init__(self, indexed = False, unique = False, zindexed = False, listed = False):
+        """ listed = True keeps the objects with every value in a redis list,
+            in insertion order. listed = 'zset' keeps them in a sorted set
+            scored by insertion sequence instead, so removal and rank lookup
+            are O(log N) (see Model.getlist and ModelWriter.migrate_listed). """
+        assert listed in (False, True, 'zset')
         self.indexed = indexed or unique
         self.unique = unique
         self.zindexed = zindexed
         self.listed = listed
 
+    def __get__(self, obj, objtype = None):
+        """ Accessed from the class, returns the attribute. Objects store
+            their values in their own dict, so this is only reached for
+            attributes which an object has no value for (not loaded). """
+        if obj is None:
+            return self
+        raise AttributeError('{0} has no value for {1} (partially loaded)'.format(obj.key, self.name))
+
     def typecast_for_read(self, value):
         return value
 
@@ -32,6 +55,10 @@ class Attribute(object):
         return value
 
 class BooleanField(Attribute):
+    pack_kind = 'int'
+    read_expr = 'bool(int({v}))'
+    write_expr = "('1' if {v} else '0')"
+
     def typecast_for_read(self, value):
         return bool(int(value))
 
@@ -39,10 +66,18 @@ class BooleanField(Attribute):
         return '1' if value else '0'
 
 class IntegerField(Attribute):
+    pack_kind = 'int'
+    read_expr = 'int({v})'
+    write_expr = '{v}'
+
     def typecast_for_read(self, value):
         return int(value)
 
 class FloatField(Attribute):
+    pack_kind = 'float'
+    read_expr = 'float({v})'
+    write_expr = '{v}'
+
     def typecast_for_read(self, value):
         return float(value)
 
@@ -50,6 +85,8 @@ class UTCDateTimeField(Attribute):
     """ UTC datetime without microseconds. 'None' is allowed (stored as 0).
         Notice it may be better to store timestamps in IntegerField or
         FloatField to avoid conversions. """
+    pack_kind = 'int'
+
     def typecast_for_read(self, value):
         if value == '0':
             return None
@@ -62,6 +99,10 @@ class UTCDateTimeField(Attribute):
         return calendar.timegm(value.utctimetuple())
 
 class ReferenceField(Attribute):
+    pack_kind = 'int'
+    read_expr = '{a}.target_type.by_id({v})'
+    write_expr = '{v}.oid'
+
     def __init__(self, target_type, indexed = False, unique = False, listed = False):
         self.target_type = target_type
         Attribute.__init__(self, indexed, unique, False, listed)
@@ -80,8 +121,14 @@ class ContainerField(object):
         self.owned = owned
 
 class ListField(ContainerField):
-    def __init__(self, target_type, indexed = False, unique = False, owned = False):
+    def __init__(self, target_type, indexed = False, unique = False, owned = False, backend = 'list'):
+        """ With backend = 'zset', the list is stored in a sorted set scored
+            by insertion sequence (see ZListHandle): elements are unique, and
+            removal, membership, index and range lookups are O(log N). """
+        assert backend in ('list', 'zset')
         ContainerField.__init__(self, target_type, indexed, unique, owned)
+        self.backend = backend
+        self.handle_type = ZListHandle if backend == 'zset' else ListHandle
 
 class SetField(ContainerField):
     def __init__(self, target_type, indexed = False, unique = False, owned = False):
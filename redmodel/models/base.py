@@ -16,11 +16,20 @@
 """
 
 from redmodel import connection as ds
-from redmodel.containers import ListHandle, SetHandle, SortedSetHandle
-from redmodel.models.attributes import Attribute, ReferenceField, ListField, SetField, SortedSetField, Recursive
+from redmodel.cache import get_cache
+from redmodel.batch import Script
+from redmodel.cluster import is_cluster
+from redmodel.instrument import operation
+import uuid
+from redmodel.containers import SetHandle, SortedSetHandle, HandleList, HandleSet, HandleArray, zrange_bounds
+from redmodel.models.attributes import Attribute, ReferenceField, ContainerField, ListField, SetField, SortedSetField, Recursive
 from redmodel.models.exceptions import NotFoundError, BadArgsError
+from redmodel.models import packing
+from redmodel.models.codegen import compile_codecs, slot_name, FieldSlot
 
 class Handle(object):
+    __slots__ = ('model', 'oid')
+
     def __init__(self, model, oid):
         self.model = model
         self.oid = str(oid) if oid else '0'
@@ -29,6 +38,8 @@ class Handle(object):
         return '<{0}: {1}>'.format(self.__class__.__name__, self.key)
 
     def __eq__(self, other):
+        if isinstance(other, Model):
+            return self.model is type(other) and self.oid == other.oid
         return self.model == other.model and self.oid == other.oid
 
     def __ne__(self, other):
@@ -42,35 +53,315 @@ class Handle(object):
 
     @property
     def key(self):
-        return self.model.key_by_id(self.oid)
-
-    def load(self):
-        d = ds.hgetall(self.key)
-        obj = self.model()
-        obj.oid = self.oid
-        obj._indexed_values = {}
-        try:
-            for a in self.model._attributes:
-                v = d[a.name]
-                obj.__dict__[a.name] = a.typecast_for_read(v)
-                if a.indexed or a.zindexed or a.listed:
-                    obj._indexed_values[a.name] = v
-            for l in self.model._lists:
-                obj.__dict__[l.name] = ListHandle(self.key + ':' + l.name,
-                                                  l.target_type)
-            for s in self.model._sets:
-                obj.__dict__[s.name] = SetHandle(self.key + ':' + s.name,
-                                                 s.target_type)
-            for z in self.model._zsets:
-                obj.__dict__[z.name] = SortedSetHandle(self.key + ':' + z.name,
-                                                       z.target_type)
+        return self.model._key_prefix + self.oid
+
+    @operation('Handle.load')
+    def load(self, fields = None, conn = None, prefetch = None):
+        """ If fields (a list of attribute names) is given, only those
+            attributes are read, and a partial object is returned. Partial
+            objects can be updated (only loaded attributes), but not passed
+            to update_all or delete.
+            The object (and its container handles) are read using conn if
+            given, or the global connection.
+            See Model.load_many for prefetch. """
+        if conn is None:
+            conn = ds
+        if prefetch is not None:
+            obj = self.model.load_many([self], fields, conn, prefetch)[0]
+            if obj is None:
+                raise NotFoundError(self.key)
             return obj
+        fields = self.model._check_fields(fields)
+        token = self.model._cache_token()
+        d = self.model._cached(self.key, fields, conn)
+        if d is None:
+            d = self.model._read_result(self.model._read(conn, self.key, fields), fields)
+            self.model._cache_put(self.key, d, fields, token, conn)
+        try:
+            return self.model._build(self.oid, d, fields, conn)
         except KeyError:
-            if len(d) == 0 and not self.model.exists(self.oid):
+            if len(d) == 0 and not conn.exists(self.key):
                 raise NotFoundError(self.key)
             else:
                 raise
 
+# KEYS: temporary key, unique index hashes, index sets, sorted indexes.
+# ARGV: number of index sets, sorted indexes and unique hashes, limit (-1
+# for none), values for unique hashes, (min, max) for every sorted index.
+# Results are sorted by the first sorted index, if any.
+_query_script = Script("""
+local function in_range(score, smin, smax)
+    local s = tonumber(score)
+    if smin ~= '-inf' then
+        if string.sub(smin, 1, 1) == '(' then
+            if s <= tonumber(string.sub(smin, 2)) then return false end
+        elseif s < tonumber(smin) then return false end
+    end
+    if smax ~= '+inf' then
+        if string.sub(smax, 1, 1) == '(' then
+            if s >= tonumber(string.sub(smax, 2)) then return false end
+        elseif s > tonumber(smax) then return false end
+    end
+    return true
+end
+
+local function trim(key, smin, smax)
+    if smin ~= '-inf' then
+        if string.sub(smin, 1, 1) == '(' then
+            redis.call('ZREMRANGEBYSCORE', key, '-inf', string.sub(smin, 2))
+        else
+            redis.call('ZREMRANGEBYSCORE', key, '-inf', '(' .. smin)
+        end
+    end
+    if smax ~= '+inf' then
+        if string.sub(smax, 1, 1) == '(' then
+            redis.call('ZREMRANGEBYSCORE', key, string.sub(smax, 2), '+inf')
+        else
+            redis.call('ZREMRANGEBYSCORE', key, '(' .. smax, '+inf')
+        end
+    end
+end
+
+local nsets = tonumber(ARGV[1])
+local nz = tonumber(ARGV[2])
+local nu = tonumber(ARGV[3])
+local limit = tonumber(ARGV[4])
+local tmp = KEYS[1]
+local k = 2
+local a = 5
+local cand = nil
+for i = 1, nu do
+    local id = redis.call('HGET', KEYS[k], ARGV[a])
+    if not id or (cand and cand ~= id) then
+        return {}
+    end
+    cand = id
+    k = k + 1
+    a = a + 1
+end
+local sets = {}
+for i = 1, nsets do
+    sets[i] = KEYS[k]
+    k = k + 1
+end
+local zsets = {}
+for i = 1, nz do
+    zsets[i] = {KEYS[k], ARGV[a], ARGV[a + 1]}
+    k = k + 1
+    a = a + 2
+end
+
+if cand then
+    for i = 1, nsets do
+        if redis.call('SISMEMBER', sets[i], cand) == 0 then
+            return {}
+        end
+    end
+    for i = 1, nz do
+        local score = redis.call('ZSCORE', zsets[i][1], cand)
+        if not score or not in_range(score, zsets[i][2], zsets[i][3]) then
+            return {}
+        end
+    end
+    return {cand}
+end
+
+if nz == 0 then
+    local r = redis.call('SINTER', unpack(sets))
+    if limit >= 0 and #r > limit then
+        local res = {}
+        for i = 1, limit do
+            res[i] = r[i]
+        end
+        return res
+    end
+    return r
+end
+
+if nsets == 0 and nz == 1 then
+    if limit >= 0 then
+        return redis.call('ZRANGEBYSCORE', zsets[1][1], zsets[1][2], zsets[1][3], 'LIMIT', 0, limit)
+    end
+    return redis.call('ZRANGEBYSCORE', zsets[1][1], zsets[1][2], zsets[1][3])
+end
+
+-- intersect the index sets with the last sorted index, then with the
+-- others, ending with the first one so it gives the final scores
+local args = {'ZINTERSTORE', tmp, nsets + 1, zsets[nz][1]}
+for i = 1, nsets do
+    args[#args + 1] = sets[i]
+end
+args[#args + 1] = 'WEIGHTS'
+args[#args + 1] = 1
+for i = 1, nsets do
+    args[#args + 1] = 0
+end
+redis.call(unpack(args))
+trim(tmp, zsets[nz][2], zsets[nz][3])
+for i = nz - 1, 1, -1 do
+    redis.call('ZINTERSTORE', tmp, 2, tmp, zsets[i][1], 'WEIGHTS', 0, 1)
+    trim(tmp, zsets[i][2], zsets[i][3])
+end
+local r
+if limit >= 0 then
+    r = redis.call('ZRANGE', tmp, 0, limit - 1)
+else
+    r = redis.call('ZRANGE', tmp, 0, -1)
+end
+redis.call('DEL', tmp)
+return r
+""")
+
+# KEYS: sorted index.
+# ARGV: min, max, '1' for reverse order, start and num (or empty strings),
+# object key prefix, '1' for packed storage.
+# Returns {id1, data1, id2, data2...}, data as returned by HGETALL (or GET for
+# packed storage).
+# The object keys are built from ARGV, not declared in KEYS (they are not
+# known before the range is read). Redis allows it on a single server, but
+# on a cluster it only works if they are in the slot of the index, so
+# _zload requires a model with hash_tag there.
+_zload_script = Script("""
+local cmd = {'ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2]}
+if ARGV[3] == '1' then
+    cmd[1] = 'ZREVRANGEBYSCORE'
+end
+if ARGV[4] ~= '' then
+    cmd[5] = 'LIMIT'
+    cmd[6] = ARGV[4]
+    cmd[7] = ARGV[5]
+end
+local res = {}
+for i, id in ipairs(redis.call(unpack(cmd))) do
+    res[#res + 1] = id
+    if ARGV[7] == '1' then
+        res[#res + 1] = redis.call('GET', ARGV[6] .. id)
+    else
+        res[#res + 1] = redis.call('HGETALL', ARGV[6] .. id)
+    end
+end
+return res
+""")
+
+# maximum length of prefetch paths
+PREFETCH_DEPTH = 3
+
+def _read_container(pl, field, key):
+    if isinstance(field, ListField) and field.backend == 'list':
+        return pl.lrange(key, 0, -1)
+    elif isinstance(field, SetField):
+        return pl.smembers(key)
+    else:
+        return pl.zrange(key, 0, -1)
+
+SCAN_PAGE = 1000
+
+def _scan_containers(conn, reads, count = SCAN_PAGE):
+    """ Reads the members of containers, given as (field, key) pairs, in
+        pages of about count members (LRANGE windows, SSCAN or ZSCAN), so big
+        containers don't block redis. Every round trip reads the next page
+        of all the containers which have more. Returns a list of members for
+        every container (members of sets may be repeated). """
+    members = [[] for r in reads]
+    cursors = [0] * len(reads)
+    pending = range(len(reads))
+    while len(pending):
+        pl = conn.pipeline(False)
+        for i in pending:
+            f, key = reads[i]
+            c = cursors[i]
+            if isinstance(f, ListField) and f.backend == 'list':
+                pl.lrange(key, c, c + count - 1)
+            elif isinstance(f, SetField):
+                pl.sscan(key, c, count = count)
+            else:
+                pl.zscan(key, c, count = count)
+        next_pending = []
+        for i, r in zip(pending, pl.execute()):
+            f, key = reads[i]
+            if isinstance(f, ListField) and f.backend == 'list':
+                members[i].extend(r)
+                cursors[i] += count
+                more = len(r) == count
+            else:
+                cursors[i], page = r
+                if isinstance(f, SetField):
+                    members[i].extend(page)
+                else:
+                    members[i].extend(m for m, score in page)
+                more = cursors[i] != 0
+            if more:
+                next_pending.append(i)
+        pending = next_pending
+    return members
+
+def _load_levels(conn, groups):
+    """ Loads groups of objects, given as (model, handles, fields, prefetch
+        tree, callback) tuples, and then the objects in their prefetch trees,
+        breadth first: a pipeline per level. The containers to prefetch are
+        read in the same pipeline as their owners. Every callback is called
+        with the objects of its group, None for objects which don't exist. """
+    while len(groups):
+        pl = conn.pipeline(False)
+        token = Model._cache_token()
+        datas = []
+        for model, handles, fields, tree, callback in groups:
+            containers = [(name, f) for name, f in model._prefetch_fields(tree) if not isinstance(f, Attribute)]
+            gdatas = []
+            for h in handles:
+                assert h.model is model, 'Expected ' + str(model.__name__) + ' handle, not ' + str(h.model.__name__)
+                d = model._cached(h.key, fields, conn)
+                if d is None:
+                    model._read(pl, h.key, fields)
+                gdatas.append(d)
+                for name, f in containers:
+                    _read_container(pl, f, model._container_key(h.oid, f))
+            datas.append((containers, gdatas))
+        resps = iter(pl.execute())
+        next_groups = []
+        for (model, handles, fields, tree, callback), (containers, gdatas) in zip(groups, datas):
+            objs = []
+            contents = dict((name, []) for name, f in containers)
+            for h, d in zip(handles, gdatas):
+                if d is None:
+                    d = model._read_result(resps.next(), fields)
+                    model._cache_put(h.key, d, fields, token, conn)
+                raw = [resps.next() for c in containers]
+                try:
+                    obj = model._build(h.oid, d, fields, conn)
+                except KeyError:
+                    if len(d) == 0:
+                        obj = None
+                    else:
+                        raise
+                if obj is not None:
+                    for (name, f), r in zip(containers, raw):
+                        contents[name].append((getattr(obj, name), r))
+                objs.append(obj)
+            callback(objs)
+            next_groups += model._prefetch_groups(objs, tree, contents)
+        groups = next_groups
+
+def _attach_references(holders, name, oids):
+    def attach(objs):
+        loaded = dict((oid, obj) for oid, obj in zip(oids, objs) if obj is not None)
+        for holder in holders:
+            obj = loaded.get(getattr(holder, name).oid)
+            if obj is not None:
+                setattr(holder, name, obj)
+    return attach
+
+def _attach_elements(contents, oids):
+    def attach(objs):
+        loaded = dict(zip(oids, objs))
+        for hcont, raw in contents:
+            hcont.prefetched = [loaded[oid] for oid in raw]
+    return attach
+
+def _unique(oids):
+    seen = set()
+    return [oid for oid in oids if not (oid in seen or seen.add(oid))]
+
 def ishandle(obj, model):
     return isinstance(obj, Handle) and obj.model is model
 
@@ -81,21 +372,40 @@ class ModelMeta(type):
         lists = []
         sets = []
         zsets = []
+        hash_tag = attrs.get('hash_tag')
+        assert hash_tag in (None, 'model', 'object'), 'Unknown hash_tag: ' + str(hash_tag)
+        key_name = name if hash_tag is None else '{' + name + '}'
         attrs['_owner'] = None
+        attrs['_hash_tag'] = hash_tag
+        attrs['_key_name'] = key_name
+        attrs['_key_prefix'] = key_name + ':'
+        attrs['_packed'] = None
         attrs['_attr_dict'] = attr_dict
         attrs['_attributes'] = attributes
         attrs['_lists'] = lists
         attrs['_sets'] = sets
         attrs['_zsets'] = zsets
+        items = attrs.items()
+        slotted = attrs.get('slots', False)
+        if slotted:
+            fields = [(k, v) for k, v in items if isinstance(v, (Attribute, ContainerField))]
+            attrs['__slots__'] = ('oid', '_loaded_fields', '_indexed_values') + tuple(slot_name(k) for k, v in fields)
+            for k, v in fields:
+                del attrs[k]
+        attrs['_slotted'] = slotted
         new_type = type.__new__(cls, name, bases, attrs)
-        for k, v in attrs.iteritems():
+        for k, v in items:
             if k == 'owner':
                 assert issubclass(v, Model)
                 new_type._owner = v
+            elif k == 'storage':
+                assert v in ('hash', 'packed'), 'Unknown storage: ' + str(v)
+                if v == 'packed':
+                    new_type._packed = attributes
             elif isinstance(v, Attribute):
                 v.name = k
                 if v.zindexed:
-                    zkey = 'z:{0}:{1}'.format(name, k)
+                    zkey = 'z:{0}:{1}'.format(key_name, k)
                     v.zindex = SortedSetHandle(zkey, new_type)
                 attr_dict[k] = v
                 attributes.append(v)
@@ -117,12 +427,19 @@ class ModelMeta(type):
                 if v.target_type == Recursive:
                     v.target_type = new_type
                 zsets.append(v)
+        attributes.sort(key = lambda a: a.name)
+        if slotted:
+            for k, v in fields:
+                setattr(new_type, k, FieldSlot(v, new_type.__dict__[slot_name(k)]))
+        new_type._decode, new_type._encode = map(staticmethod, compile_codecs(new_type, slotted))
         return new_type
 
 class Model(object):
     __metaclass__ = ModelMeta
+    __slots__ = ()
 
     oid = None
+    _loaded_fields = None
 
     @classmethod
     def by_id(cls, oid):
@@ -133,21 +450,209 @@ class Model(object):
         assert type(owner) is cls._owner or (type(owner) is Handle and owner.model is cls._owner)
         return Handle(cls, owner.oid)
 
+    @classmethod
+    @operation('Model.load_many')
+    def load_many(cls, handles, fields = None, conn = None, prefetch = None):
+        """ Loads the objects referenced by handles in a single round trip.
+            Returns a list in the same order as handles, where objects which
+            do not exist are None instead of raising NotFoundError.
+            See Handle.load for the fields and conn arguments.
+            prefetch is a list of reference and container fields whose
+            objects are loaded too: references are replaced by the loaded
+            objects, and container handles get their elements (objects, for
+            model containers) in a 'prefetched' list. Fields of prefetched
+            objects are given as paths, like 'leader__city', up to
+            PREFETCH_DEPTH fields long. Every level of the paths is read in a
+            single round trip. """
+        if conn is None:
+            conn = ds
+        fields = cls._check_fields(fields)
+        tree = cls._prefetch_tree(prefetch, fields)
+        handles = list(handles)
+        if len(handles) == 0:
+            return []
+        objs = []
+        _load_levels(conn, [(cls, handles, fields, tree, objs.extend)])
+        return objs
+
+    @classmethod
+    def _prefetch_tree(cls, prefetch, fields = None):
+        """ Returns the prefetch paths as a tree of dicts. """
+        tree = {}
+        for path in prefetch or ():
+            names = path.split('__')
+            if len(names) > PREFETCH_DEPTH:
+                raise BadArgsError('Prefetch path longer than {0}: {1}'.format(PREFETCH_DEPTH, path))
+            if fields is not None and names[0] in cls._attr_dict and names[0] not in fields:
+                raise BadArgsError('Prefetched field {0} is not loaded'.format(names[0]))
+            model = cls
+            node = tree
+            for name in names:
+                if not (isinstance(model, type) and issubclass(model, Model)):
+                    raise BadArgsError('Cannot prefetch ' + path)
+                f = getattr(model, name, None)
+                if not (isinstance(f, ReferenceField) or f in model._lists or f in model._sets or f in model._zsets):
+                    raise BadArgsError('{0}.{1} is not a reference or container field'.format(model.__name__, name))
+                node = node.setdefault(name, {})
+                model = f.target_type
+        return tree
+
+    @classmethod
+    def _prefetch_fields(cls, tree):
+        return [(name, getattr(cls, name)) for name in tree]
+
+    @classmethod
+    def _prefetch_groups(cls, objs, tree, contents):
+        """ Returns the groups of objects to load (see _load_levels) for the
+            first level of tree, given the loaded objs and the elements read
+            from their containers. """
+        groups = []
+        present = [obj for obj in objs if obj is not None]
+        for name, f in cls._prefetch_fields(tree):
+            target = f.target_type
+            if isinstance(f, Attribute):
+                holders = [obj for obj in present if getattr(obj, name)]
+                oids = _unique(getattr(obj, name).oid for obj in holders)
+                callback = _attach_references(holders, name, oids)
+            elif hasattr(target, 'by_id'):
+                oids = _unique(oid for hcont, raw in contents[name] for oid in raw)
+                callback = _attach_elements(contents[name], oids)
+            else:
+                for hcont, raw in contents[name]:
+                    hcont.prefetched = hcont._transform(raw)
+                continue
+            groups.append((target, [target.by_id(oid) for oid in oids], None, tree[name], callback))
+        return groups
+
+    @classmethod
+    def _check_fields(cls, fields):
+        if fields is None:
+            return None
+        fields = tuple(fields)
+        if len(fields) == 0:
+            raise BadArgsError('No fields to load for {0}'.format(cls.__name__))
+        for f in fields:
+            if not cls._attr_dict.has_key(f):
+                raise BadArgsError('{0} has no attribute {1}'.format(cls.__name__, f))
+        return fields
+
+    @classmethod
+    def _read(cls, conn, key, fields = None):
+        """ Sends the read command for an object to conn (a client or a
+            pipeline). The reply must be passed to _read_result. """
+        if cls._packed is not None:
+            return conn.get(key)
+        if fields is None:
+            return conn.hgetall(key)
+        return conn.hmget(key, fields)
+
+    @classmethod
+    def _read_result(cls, r, fields = None):
+        if cls._packed is not None:
+            d = packing.unpack(cls._packed, r) if r else {}
+            if fields is None:
+                return d
+            return dict((f, d[f]) for f in fields if d.has_key(f))
+        if fields is None:
+            return r
+        return dict((f, v) for f, v in zip(fields, r) if v is not None)
+
+    @classmethod
+    def _cached(cls, key, fields = None, conn = ds):
+        """ Returns the cached data of an object, or None. Only reads
+            through the global connection are cached. """
+        c = get_cache()
+        if c is None or conn is not ds or not c.caches(cls):
+            return None
+        d = c.get(cls, key)
+        if d is not None and fields is not None:
+            d = dict((f, d[f]) for f in fields if d.has_key(f))
+        return d
+
+    @classmethod
+    def _cache_token(cls):
+        """ Returns the cache token to take before reading (see
+            ObjectCache.token), or None. """
+        c = get_cache()
+        return None if c is None else c.token()
+
+    @classmethod
+    def _cache_put(cls, key, d, fields = None, token = None, conn = ds):
+        c = get_cache()
+        if c is not None and conn is ds and fields is None and len(d) and c.caches(cls):
+            c.put(cls, key, d, token = token)
+
+    @classmethod
+    def _find_unique(cls, fld, val):
+        k = 'u:{0}:{1}'.format(cls._key_name, fld)
+        c = get_cache()
+        if c is None or not c.caches(cls):
+            return Handle(cls, ds.hget(k, val))
+        token = c.token()
+        oid = c.get(cls, k, str(val))
+        if oid is None:
+            oid = ds.hget(k, val)
+            if oid is not None:
+                c.put(cls, k, oid, str(val), token)
+        return Handle(cls, oid)
+
+    @classmethod
+    def _build(cls, oid, d, fields = None, conn = None):
+        """ Creates an object from the hash read from redis. Raises KeyError
+            if an attribute is missing. Complete objects are created by the
+            code generated for the model (see codegen). """
+        if fields is None:
+            return cls._decode(oid, d, conn)
+        obj = cls()
+        obj.oid = oid
+        obj._indexed_values = {}
+        obj._loaded_fields = fields
+        for f in fields:
+            a = cls._attr_dict[f]
+            v = d[f]
+            setattr(obj, f, a.typecast_for_read(v))
+            if a.indexed or a.zindexed or a.listed:
+                obj._indexed_values[f] = v
+        for l in cls._lists:
+            setattr(obj, l.name, l.handle_type(cls._container_key(oid, l), l.target_type, conn))
+        for s in cls._sets:
+            setattr(obj, s.name, SetHandle(cls._container_key(oid, s), s.target_type, conn))
+        for z in cls._zsets:
+            setattr(obj, z.name, SortedSetHandle(cls._container_key(oid, z), z.target_type, conn))
+        return obj
+
     @classmethod
     def key_by_id(cls, oid):
-        return cls.__name__ + ':' + str(oid)
+        return cls._key_prefix + str(oid)
+
+    @classmethod
+    def _tmp_key(cls, name):
+        """ Returns a new key for temporary data of the model, in the hash
+            slot of its other keys if the model has a hash_tag. """
+        return 'tmp:{0}:{1}:{2}'.format(cls._key_name, name, uuid.uuid4().hex)
+
+    @classmethod
+    def _container_key(cls, oid, f):
+        """ Returns the key of container field f of object oid. With
+            hash_tag = 'object', containers which are not indexed are tagged
+            by object, so they are spread over the cluster. """
+        if cls._hash_tag == 'object' and not f.indexed:
+            return '{' + cls.__name__ + ':' + str(oid) + '}:' + f.name
+        return cls._key_prefix + str(oid) + ':' + f.name
 
     @classmethod
+    @operation('Model.exists')
     def exists(cls, oid):
         return ds.exists(cls.key_by_id(oid))
 
     @classmethod
+    @operation('Model.find')
     def find(cls, **kwargs):
         assert len(kwargs) == 1
         fldcond = kwargs.keys()[0].split('__')
         fld = fldcond[0]
         val = kwargs.values()[0]
-        f = cls.__dict__[fld]
+        f = getattr(cls, fld)
         if isinstance(val, Handle):
             assert not hasattr(f, 'target_type') or val.model is f.target_type
             val = val.oid
@@ -156,21 +661,60 @@ class Model(object):
             if isinstance(val, Model):
                 val = val.oid
         if len(fldcond) == 1:
-            k = 'u:{0}:{1}'.format(cls.__name__, fld)
-            return Handle(cls, ds.hget(k, val))
+            return cls._find_unique(fld, val)
         else:
             cond = fldcond[1]
             if cond == 'contains':
-                k = 'u:{0}:{1}'.format(cls.__name__, fld)
-                return Handle(cls, ds.hget(k, val))
+                return cls._find_unique(fld, val)
+
+    @classmethod
+    @operation('Model.multifind')
+    def multifind(cls, array_ = False, **kwargs):
+        """ Returns a HandleSet, or a HandleArray if array_ is True, which
+            takes much less memory for big indexes. """
+        k = cls._index_key(kwargs)
+        if array_:
+            return HandleArray(cls, ds.smembers(k))
+        return HandleSet(map(lambda m: Handle(cls, m), ds.smembers(k)))
 
     @classmethod
-    def multifind(cls, **kwargs):
+    def iter_multifind(cls, count_ = 500, load_ = False, **kwargs):
+        """ Like multifind, but returns a generator which walks the index
+            with SSCAN, count_ elements at a time, so big indexes don't use
+            lots of memory or block redis. If load_ is True, objects are
+            generated instead of handles, loaded with a load_many call per
+            SSCAN step (objects which don't exist are skipped).
+            Notice SSCAN may return an element more than once if the index
+            is modified during the iteration. """
+        k = cls._index_key(kwargs)
+        cursor = 0
+        while True:
+            cursor, oids = ds.sscan(k, cursor, count = count_)
+            handles = [Handle(cls, oid) for oid in oids]
+            if load_:
+                for obj in cls.load_many(handles):
+                    if obj is not None:
+                        yield obj
+            else:
+                for h in handles:
+                    yield h
+            if int(cursor) == 0:
+                break
+
+    @classmethod
+    def _index_key(cls, kwargs):
+        """ Returns the key of the index set for a multifind condition. """
         assert len(kwargs) == 1
         fldcond = kwargs.keys()[0].split('__')
         fld = fldcond[0]
-        val = kwargs.values()[0]
-        f = cls.__dict__[fld]
+        f = getattr(cls, fld)
+        val = cls._index_value(f, kwargs.values()[0])
+        if len(fldcond) > 1 and fldcond[1] != 'contains':
+            raise BadArgsError('Wrong multifind condition: ' + fldcond[1])
+        return 'i:{0}:{1}:{2}'.format(cls._key_name, fld, val)
+
+    @classmethod
+    def _index_value(cls, f, val):
         if isinstance(val, Handle):
             assert not hasattr(f, 'target_type') or val.model is f.target_type
             val = val.oid
@@ -178,16 +722,66 @@ class Model(object):
             assert not hasattr(f, 'target_type') or type(val) is f.target_type
             if isinstance(val, Model):
                 val = val.oid
-        if len(fldcond) == 1:
-            k = 'i:{0}:{1}:{2}'.format(cls.__name__, fld, val)
-            return set(map(lambda m: Handle(cls, m), ds.smembers(k)))
-        else:
-            cond = fldcond[1]
-            if cond == 'contains':
-                k = 'i:{0}:{1}:{2}'.format(cls.__name__, fld, val)
-                return set(map(lambda m: Handle(cls, m), ds.smembers(k)))
+        return val
 
     @classmethod
+    @operation('Model.query')
+    def query(cls, limit_ = None, order_ = None, array_ = False, **kwargs):
+        """ Finds the objects matching all the conditions, which are given as
+            in find/multifind (indexed fields, including container fields
+            with __contains) or zfind (zindexed fields). Indexes are
+            intersected in redis by a script, so only the result is
+            transferred. Returns a list of handles, of limit_ elements at
+            most. If there are zfind conditions, the list is sorted by the
+            field named order_ (by default, the first one by name; BadArgsError
+            is raised if order_ is not a zfind condition). If array_
+            is True, a HandleArray is returned instead of a list.
+            Example: Fighter.query(city = hcity, age__lt = 30, limit_ = 10) """
+        if len(kwargs) == 0:
+            raise BadArgsError('No query conditions')
+        if limit_ == 0:
+            return HandleArray(cls) if array_ else HandleList()
+        hashes = []
+        sets = []
+        zsets = []
+        for cond, val in kwargs.iteritems():
+            fldcond = cond.split('__')
+            fld = fldcond[0]
+            op = fldcond[1] if len(fldcond) > 1 else None
+            f = getattr(cls, fld, None)
+            if op in (None, 'contains') and getattr(f, 'indexed', False):
+                val = cls._index_value(f, val)
+                if f.unique:
+                    hashes.append(('u:{0}:{1}'.format(cls._key_name, fld), val))
+                else:
+                    sets.append('i:{0}:{1}:{2}'.format(cls._key_name, fld, val))
+            elif getattr(f, 'zindexed', False):
+                if isinstance(val, tuple):
+                    assert len(val) == 2
+                    val = (f.typecast_for_write(val[0]), f.typecast_for_write(val[1]))
+                else:
+                    val = f.typecast_for_write(val)
+                zsets.append((fld != order_, fld, zrange_bounds(op or 'eq', val)))
+            else:
+                raise BadArgsError('{0}.{1} is not indexed for {2}'.format(cls.__name__, fld, cond))
+        if order_ is not None and order_ not in [zfld for o, zfld, b in zsets]:
+            raise BadArgsError('{0}.{1} is not a zfind condition to order by'.format(cls.__name__, order_))
+        zsets.sort()
+        keys = [cls._tmp_key('query')]
+        keys += [k for k, v in hashes]
+        keys += sets
+        keys += ['z:{0}:{1}'.format(cls._key_name, zfld) for o, zfld, b in zsets]
+        args = [len(sets), len(zsets), len(hashes), -1 if limit_ is None else limit_]
+        args += [v for k, v in hashes]
+        for o, zfld, b in zsets:
+            args += b
+        oids = _query_script(ds, keys, args)
+        if array_:
+            return HandleArray(cls, oids)
+        return HandleList(map(lambda m: Handle(cls, m), oids))
+
+    @classmethod
+    @operation('Model.zfind')
     def zfind(cls, **kwargs):
         """ Calls typecast_for_write, so it can be used with datetime values,
             or other special field types. For other z* methods,
@@ -195,7 +789,7 @@ class Model(object):
         assert len(kwargs) == 1
         fldcond = kwargs.keys()[0].split('__')
         fld = fldcond[0]
-        f = cls.__dict__[fld]
+        f = getattr(cls, fld)
         val = kwargs.values()[0]
         if isinstance(val, tuple):
             assert len(val) == 2
@@ -209,10 +803,35 @@ class Model(object):
             return f.zindex.zfind(**{cond: val})
 
     @classmethod
+    @operation('Model.getlist')
     def getlist(cls, start_ = 0, end_ = -1, **kwargs):
+        """ Returns the handles of the objects with a listed value, in
+            insertion order (elements start_ to end_, inclusive). """
+        f, k = cls._list_key(kwargs)
+        if f.listed == 'zset':
+            oids = ds.zrange(k, start_, end_)
+        else:
+            oids = ds.lrange(k, start_, end_)
+        return HandleList(map(lambda m: Handle(cls, m), oids))
+
+    @classmethod
+    @operation('Model.getlist_rank')
+    def getlist_rank(cls, handle_, **kwargs):
+        """ Returns the position of an object in the getlist result of a
+            field with listed = 'zset', or None if it's not there. """
+        f, k = cls._list_key(kwargs)
+        if f.listed != 'zset':
+            raise BadArgsError('getlist_rank needs a field with listed = \'zset\'')
+        assert handle_.model is cls
+        return ds.zrank(k, handle_.oid)
+
+    @classmethod
+    def _list_key(cls, kwargs):
+        """ Returns the field and the key of the list of a getlist
+            condition. """
         assert len(kwargs) == 1
-        fld, val = kwargs.popitem()
-        f = cls.__dict__[fld]
+        fld, val = kwargs.items()[0]
+        f = getattr(cls, fld)
         if isinstance(val, Handle):
             assert not hasattr(f, 'target_type') or val.model is f.target_type
             val = val.oid
@@ -220,54 +839,105 @@ class Model(object):
             assert not hasattr(f, 'target_type') or type(val) is f.target_type
             if isinstance(val, Model):
                 val = val.oid
-        k = 'l:{0}:{1}:{2}'.format(cls.__name__, fld, val)
-        return map(lambda m: Handle(cls, m), ds.lrange(k, start_, end_))
+        return f, 'l:{0}:{1}:{2}'.format(cls._key_name, fld, val)
 
     @classmethod
+    @operation('Model.zrange')
     def zrange(cls, fld, start = 0, end = -1):
         return cls._zindex(fld).zrange(start, end)
 
     @classmethod
+    @operation('Model.zrevrange')
     def zrevrange(cls, fld, start = 0, end = -1):
         return cls._zindex(fld).zrevrange(start, end)
 
     @classmethod
+    @operation('Model.zrangebyscore')
     def zrangebyscore(cls, fld, smin, smax, start = None, num = None):
         return cls._zindex(fld).zrangebyscore(smin, smax, start, num)
 
     @classmethod
+    @operation('Model.zrevrangebyscore')
     def zrevrangebyscore(cls, fld, smax, smin, start = None, num = None):
         return cls._zindex(fld).zrevrangebyscore(smax, smin, start, num)
 
     @classmethod
+    @operation('Model.zrangebyscore_load')
+    def zrangebyscore_load(cls, fld, smin, smax, start = None, num = None):
+        """ Like zrangebyscore, but returns a list of objects instead of
+            handles. The index range and the objects are read in a single
+            round trip (a script). Objects which don't exist are None. """
+        return cls._zload(fld, smin, smax, False, start, num)
+
+    @classmethod
+    @operation('Model.zrevrangebyscore_load')
+    def zrevrangebyscore_load(cls, fld, smax, smin, start = None, num = None):
+        """ Like zrevrangebyscore, but returns a list of objects. See
+            zrangebyscore_load. """
+        return cls._zload(fld, smax, smin, True, start, num)
+
+    @classmethod
+    def _zload(cls, fld, smin, smax, reverse, start, num):
+        assert (start is None) == (num is None)
+        if cls._hash_tag is None and is_cluster(ds):
+            raise BadArgsError('{0} needs a hash_tag for range loads on a cluster'.format(cls.__name__))
+        zkey = cls._zindex(fld).key
+        args = [smin, smax, '1' if reverse else '0']
+        args += ['', ''] if start is None else [start, num]
+        args.append(cls.key_by_id(''))
+        args.append('1' if cls._packed is not None else '0')
+        token = cls._cache_token()
+        r = _zload_script(ds, [zkey], args)
+        objs = []
+        for i in range(0, len(r), 2):
+            oid = r[i]
+            if cls._packed is not None:
+                d = cls._read_result(r[i + 1])
+            else:
+                flat = r[i + 1]
+                d = dict(zip(flat[::2], flat[1::2]))
+            if len(d) == 0 and len(cls._attributes):
+                objs.append(None)
+            else:
+                cls._cache_put(cls.key_by_id(oid), d, None, token)
+                objs.append(cls._build(oid, d))
+        return objs
+
+    @classmethod
+    @operation('Model.zcount')
     def zcount(cls, fld, smin, smax):
         return cls._zindex(fld).zcount(smin, smax)
 
     @classmethod
+    @operation('Model.zrank')
     def zrank(cls, fld, obj):
         return cls._zindex(fld).zrank(obj)
 
     @classmethod
+    @operation('Model.zrevrank')
     def zrevrank(cls, fld, obj):
         return cls._zindex(fld).zrevrank(obj)
 
     def __new__(cls, *args, **kwargs):
         if len(args) == 0:
+            obj = super(Model, cls).__new__(cls)
+            if cls._slotted:
+                obj.oid = None
+                obj._loaded_fields = None
             if len(kwargs) == 0:
-                return super(Model, cls).__new__(cls)
+                return obj
             atnames = set([a.name for a in cls._attributes])
             if len(set(kwargs.keys()).symmetric_difference(atnames)) != 0:
                 raise BadArgsError(str(sorted(atnames)) + ' expected, not ' + str(sorted(kwargs.keys())))
-            obj = super(Model, cls).__new__(cls)
             obj.update_attributes(**kwargs)
             obj._indexed_values = {}
             for a in obj._attributes:
                 if a.indexed or a.zindexed or a.listed:
                     obj._indexed_values[a.name] = None
             for l in obj._lists:
-                obj.__dict__[l.name] = None
+                setattr(obj, l.name, None)
             for s in obj._sets:
-                obj.__dict__[s.name] = None
+                setattr(obj, s.name, None)
             return obj
         else:
             h = args[0]
@@ -286,6 +956,10 @@ class Model(object):
     def handle(self):
         return Handle(self.__class__, self.oid)
 
+    def is_partial(self):
+        """ True if the object was loaded with only some of its fields. """
+        return self._loaded_fields is not None
+
     def update_attributes(self, **kwargs):
         for k, v in kwargs.iteritems():
             a = self._attr_dict[k]
@@ -296,7 +970,7 @@ class Model(object):
                     assert v.model is a.target_type
                 else:
                     v = a.target_type.by_id(v)
-            self.__dict__[a.name] = v
+            setattr(self, a.name, v)
 
     def update_attributes_dict(self, **kwargs):
         d = {}
@@ -309,17 +983,13 @@ class Model(object):
                     assert v.model is a.target_type
                 else:
                     v = a.target_type.by_id(v)
-            self.__dict__[a.name] = v
+            setattr(self, a.name, v)
             d[k] = a.typecast_for_write(v)
         return d
 
     def make_dict(self):
-        d = {}
-        for a in self._attributes:
-            if self.__dict__.has_key(a.name):
-                d[a.name] = a.typecast_for_write(self.__dict__[a.name])
-        return d
+        return self._encode(self)
 
     @classmethod
     def _zindex(cls, fld):
-        return cls.__dict__[fld].zindex
+        return getattr(cls, fld).zindex
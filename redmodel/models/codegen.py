@@ -0,0 +1,138 @@
+"""
+    Copyright (C) 2011 Maximiliano Pin
+
+    Redmodel is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Redmodel is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Generates the functions which convert objects of a model from and to the
+    dicts read from/written to redis, when the model class is defined. The
+    loops over attributes, and the typecast calls of the basic field types,
+    are unrolled into straight code. """
+
+from redmodel.containers import ListHandle, ZListHandle, SetHandle, SortedSetHandle
+
+def slot_name(name):
+    """ Name of the slot where attribute name is stored, for models with
+        slots = True. """
+    return '_f_' + name
+
+class FieldSlot(object):
+    """ Class attribute of models with slots = True. Accessed from the class,
+        it returns the field (so Model.field keeps working); accessed from an
+        object, it returns the value stored in the slot. """
+    def __init__(self, field, member):
+        self.field = field
+        self.member = member
+
+    def __get__(self, obj, objtype = None):
+        if obj is None:
+            return self.field
+        return self.member.__get__(obj, objtype)
+
+    def __set__(self, obj, value):
+        self.member.__set__(obj, value)
+
+    def __delete__(self, obj):
+        self.member.__delete__(obj)
+
+def _expr(a, which, ns, v):
+    """ Returns the python expression converting v, for attribute a. """
+    an = '_a_' + a.name
+    ns[an] = a
+    expr = type(a).__dict__.get(which + '_expr')
+    if expr is None:
+        return '{0}.typecast_for_{1}({2})'.format(an, which, v)
+    return expr.format(v = v, a = an)
+
+def _load(slotted, name, field = True):
+    """ Returns the python expression for the storage of name in obj. """
+    if slotted:
+        return 'obj.' + (slot_name(name) if field else name)
+    return 'od[{0!r}]'.format(name)
+
+def _store(slotted, name, expr, field = True):
+    return '{0} = {1}'.format(_load(slotted, name, field), expr)
+
+def compile_codecs(model, slotted):
+    """ Returns (decode, encode) functions for model:
+        - decode(oid, d, conn) creates a complete object from the hash d, or
+          raises KeyError if an attribute is missing.
+        - encode(obj) returns the dict of loaded attributes, as make_dict. """
+    ns = {'_new': object.__new__, '_cls': model, '_prefix': model._key_prefix,
+          '_ListHandle': ListHandle, '_ZListHandle': ZListHandle, '_SetHandle': SetHandle,
+          '_SortedSetHandle': SortedSetHandle}
+
+    lines = ['def decode(oid, d, conn):',
+             '    obj = _new(_cls)']
+    if slotted:
+        lines.append('    obj._loaded_fields = None')
+    else:
+        lines.append('    od = obj.__dict__')
+    lines.append('    ' + _store(slotted, 'oid', 'oid', False))
+    indexed = []
+    for i, a in enumerate(model._attributes):
+        v = 'v{0}'.format(i)
+        lines.append('    {0} = d[{1!r}]'.format(v, a.name))
+        lines.append('    ' + _store(slotted, a.name, _expr(a, 'read', ns, v)))
+        if a.indexed or a.zindexed or a.listed:
+            indexed.append('{0!r}: {1}'.format(a.name, v))
+    lines.append('    ' + _store(slotted, '_indexed_values', '{' + ', '.join(indexed) + '}', False))
+    containers = [('_' + l.handle_type.__name__, l) for l in model._lists]
+    containers += [('_SetHandle', s) for s in model._sets]
+    containers += [('_SortedSetHandle', z) for z in model._zsets]
+    if len(containers):
+        lines.append('    key = _prefix + oid')
+    tagged = model._hash_tag == 'object' and any(not c.indexed for h, c in containers)
+    if tagged:
+        lines.append('    tkey = {0!r} + oid'.format('{' + model.__name__ + ':'))
+    for htype, c in containers:
+        tn = '_t_' + c.name
+        ns[tn] = c.target_type
+        if model._hash_tag == 'object' and not c.indexed:
+            expr = '{0}(tkey + {1!r}, {2}, conn)'.format(htype, '}:' + c.name, tn)
+        else:
+            expr = '{0}(key + {1!r}, {2}, conn)'.format(htype, ':' + c.name, tn)
+        lines.append('    ' + _store(slotted, c.name, expr))
+    lines.append('    return obj')
+
+    lines.append('def encode(obj):')
+    if not slotted:
+        lines.append('    od = obj.__dict__')
+    missing = 'AttributeError' if slotted else 'KeyError'
+    items = []
+    for a in model._attributes:
+        items.append('{0!r}: {1}'.format(a.name, _expr(a, 'write', ns, _load(slotted, a.name))))
+    lines.append('    if obj._loaded_fields is None:')
+    lines.append('        try:')
+    lines.append('            return {' + ', '.join(items) + '}')
+    lines.append('        except {0}:'.format(missing))
+    lines.append('            pass')
+    lines.append('    d = {}')
+    for a in model._attributes:
+        if slotted:
+            lines.append('    try:')
+            lines.append('        v = ' + _load(slotted, a.name))
+            lines.append('    except AttributeError:')
+            lines.append('        pass')
+            lines.append('    else:')
+            lines.append('        d[{0!r}] = {1}'.format(a.name, _expr(a, 'write', ns, 'v')))
+        else:
+            lines.append('    if {0!r} in od:'.format(a.name))
+            lines.append('        d[{0!r}] = {1}'.format(a.name, _expr(a, 'write', ns, _load(slotted, a.name))))
+    lines.append('    return d')
+
+    source = '\n'.join(lines) + '\n'
+    code = compile(source, '<{0} codecs>'.format(model.__name__), 'exec')
+    exec code in ns
+    return ns['decode'], ns['encode']
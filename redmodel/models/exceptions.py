@@ -9,4 +9,7 @@ class NotFoundError(Error):
 class BadArgsError(Error):
     pass
 
+class SchemaError(Error):
+    pass
+
 UniqueError = redmodel.containers.UniqueError
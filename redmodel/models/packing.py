@@ -0,0 +1,122 @@
+"""
+    Copyright (C) 2011 Maximiliano Pin
+
+    Redmodel is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Redmodel is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Codec for models with storage = 'packed', which are stored as a single
+    string instead of a hash. The string starts with the format version and
+    a schema id (a hash of the attribute names), and attribute values follow
+    in the order of the attribute names, each one with a type tag:
+    - string: varint length and bytes.
+    - integer: zigzag varint (for fields with pack_kind 'int').
+    - float: 8 byte double (for fields with pack_kind 'float').
+    A value is stored as a string if the compact encoding would not give
+    back exactly the same string, so packing is lossless, and unpacked
+    values are the strings a hash would contain. """
+
+import hashlib
+import struct
+from redmodel.models.exceptions import SchemaError
+
+VERSION = '\x02'
+_STR = '\x00'
+_INT = '\x01'
+_FLOAT = '\x02'
+
+def encode(value):
+    """ Converts a value to the string redis-py would store. """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def pack(attributes, data):
+    """ Packs data (a dict with a value for every attribute in attributes,
+        which must be sorted by name). """
+    out = [VERSION, schema_id(attributes)]
+    for a in attributes:
+        out.append(_pack_value(a.pack_kind, encode(data[a.name])))
+    return ''.join(out)
+
+def unpack(attributes, s):
+    """ Returns a dict of strings, as HGETALL would. Raises SchemaError if
+        s was packed with other attributes. """
+    if s[0] != VERSION:
+        raise SchemaError('Unknown packed format')
+    if s[1:5] != schema_id(attributes):
+        raise SchemaError('Object packed with other attributes than: ' +
+                          ', '.join(a.name for a in attributes))
+    d = {}
+    pos = 5
+    for a in attributes:
+        d[a.name], pos = _unpack_value(s, pos)
+    return d
+
+def schema_id(attributes):
+    """ Returns the 4 byte id of the attribute names, stored in the header
+        of packed objects. """
+    return hashlib.md5(','.join(a.name for a in attributes)).digest()[:4]
+
+def _pack_value(kind, s):
+    if kind == 'int':
+        try:
+            n = int(s)
+            if str(n) == s:
+                return _INT + _varint(n << 1 if n >= 0 else (-n << 1) - 1)
+        except ValueError:
+            pass
+    elif kind == 'float':
+        try:
+            f = float(s)
+            if repr(f) == s:
+                return _FLOAT + struct.pack('<d', f)
+        except ValueError:
+            pass
+    return _STR + _varint(len(s)) + s
+
+def _unpack_value(s, pos):
+    tag = s[pos]
+    pos += 1
+    if tag == _INT:
+        z, pos = _read_varint(s, pos)
+        n = z >> 1 if not z & 1 else -((z + 1) >> 1)
+        return str(n), pos
+    elif tag == _FLOAT:
+        return repr(struct.unpack('<d', s[pos:pos + 8])[0]), pos + 8
+    else:
+        n, pos = _read_varint(s, pos)
+        return s[pos:pos + n], pos + n
+
+def _varint(n):
+    out = []
+    while n >= 0x80:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _read_varint(s, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(s[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
@@ -15,54 +15,65 @@
     along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from redmodel.containers import ListHandle, SetHandle, SortedSetHandle, ContainerWriter, ListWriter, SetWriter, SortedSetWriter
-from redmodel.models.base import Handle, Model
+from redmodel.containers import SetHandle, SortedSetHandle, ContainerWriter, ListWriter, SetWriter, SortedSetWriter, _chunks
+from redmodel.models.base import Handle, Model, _read_container, _scan_containers
 from redmodel.models.attributes import ListField, SetField, SortedSetField
-from redmodel.models.exceptions import UniqueError, NotFoundError
+from redmodel.models.exceptions import UniqueError, NotFoundError, BadArgsError
+from redmodel.models import packing
+from redmodel.batch import CommandBatch, new_batch, current_batch
+from redmodel.cluster import is_cluster
+from redmodel.instrument import operation
 from redmodel import connection as ds
 
 class ModelWriter(object):
-    def __init__(self, model):
+    def __init__(self, model, conn = None):
+        """ Writes use conn if given, or the global connection. """
+        self.conn = ds if conn is None else conn
         self.model = model
         self.modname = model.__name__
+        self.keyname = model._key_name
 
-    def __check_unique(self, fld, val):
-        #TODO watch (optimistic lock) to allow multithread?
-        k = 'u:{0}:{1}'.format(self.modname, fld)
-        if ds.hexists(k, val):
-            raise UniqueError(k, val)
+    def __check_unique(self, batch, fld, val):
+        k = 'u:{0}:{1}'.format(self.keyname, fld)
+        batch.check_unique(k, val)
 
     def __index(self, pl, oid, fld, val, unique):
         if unique:
-            k = 'u:{0}:{1}'.format(self.modname, fld)
+            k = 'u:{0}:{1}'.format(self.keyname, fld)
             pl.hset(k, val, oid)
         else:
-            k = 'i:{0}:{1}:{2}'.format(self.modname, fld, val)
+            k = 'i:{0}:{1}:{2}'.format(self.keyname, fld, val)
             pl.sadd(k, oid)
 
     def __unindex(self, pl, oid, fld, val, unique):
         if unique:
-            k = 'u:{0}:{1}'.format(self.modname, fld)
+            k = 'u:{0}:{1}'.format(self.keyname, fld)
             pl.hdel(k, val)
         else:
-            k = 'i:{0}:{1}:{2}'.format(self.modname, fld, val)
+            k = 'i:{0}:{1}:{2}'.format(self.keyname, fld, val)
             pl.srem(k, oid)
 
     def __zindex(self, pl, oid, fld, val):
-        k = 'z:{0}:{1}'.format(self.modname, fld)
+        k = 'z:{0}:{1}'.format(self.keyname, fld)
         pl.zadd(k, **{oid: val})
 
     def __zunindex(self, pl, oid, fld):
-        k = 'z:{0}:{1}'.format(self.modname, fld)
+        k = 'z:{0}:{1}'.format(self.keyname, fld)
         pl.zrem(k, oid)
 
-    def __list(self, pl, oid, fld, val):
-        k = 'l:{0}:{1}:{2}'.format(self.modname, fld, val)
-        pl.rpush(k, oid)
+    def __list(self, pl, oid, a, val):
+        k = 'l:{0}:{1}:{2}'.format(self.keyname, a.name, val)
+        if a.listed == 'zset':
+            pl.zappend(k, oid)
+        else:
+            pl.rpush(k, oid)
 
-    def __unlist(self, pl, oid, fld, val):
-        k = 'l:{0}:{1}:{2}'.format(self.modname, fld, val)
-        pl.lrem(k, oid)
+    def __unlist(self, pl, oid, a, val):
+        k = 'l:{0}:{1}:{2}'.format(self.keyname, a.name, val)
+        if a.listed == 'zset':
+            pl.zrem(k, oid)
+        else:
+            pl.lrem(k, oid)
 
     def __unindex_all(self, pl, obj):
         for a in obj._attributes:
@@ -75,16 +86,17 @@ class ModelWriter(object):
                     if a.zindexed:
                         self.__zunindex(pl, obj.oid, fld)
                     if a.listed:
-                        self.__unlist(pl, obj.oid, fld, v)
+                        self.__unlist(pl, obj.oid, a, v)
 
     def __update_attrs(self, obj, data):
         if (len(data)):
-            self._check_unique_for_update(obj, data)
-            pl = ds.pipeline(True)
-            self._do_update_attrs(pl, obj, data)
-            pl.execute()
+            batch = new_batch()
+            self._check_unique_for_update(batch, obj, data)
+            self._do_update_attrs(batch, obj, data)
+            batch.after(self._set_indexed_values, obj, data)
+            batch.execute(self.conn)
 
-    def _check_unique_for_update(self, obj, data):
+    def _check_unique_for_update(self, batch, obj, data):
         attr_dict = self.model._attr_dict
         for fld in data.iterkeys():
             a = attr_dict[fld]
@@ -92,11 +104,14 @@ class ModelWriter(object):
                 v = data[fld]
                 oldv = obj._indexed_values[fld]
                 if v != oldv:
-                    self.__check_unique(fld, v)
+                    self.__check_unique(batch, fld, v)
 
     def _do_update_attrs(self, pl, obj, data):
         attr_dict = self.model._attr_dict
-        pl.hmset(obj.key, data)
+        if self.model._packed is not None:
+            pl.set(obj.key, packing.pack(self.model._packed, obj.make_dict()))
+        else:
+            pl.hmset(obj.key, data)
         for fld in data.iterkeys():
             a = attr_dict[fld]
             if a.indexed or a.zindexed or a.listed:
@@ -112,61 +127,326 @@ class ModelWriter(object):
                     self.__zindex(pl, obj.oid, fld, v)
                 if a.listed:
                     if oldv is not None:
-                        self.__unlist(pl, obj.oid, fld, oldv)
-                    self.__list(pl, obj.oid, fld, v)
-                obj._indexed_values[fld] = v
+                        self.__unlist(pl, obj.oid, a, oldv)
+                    self.__list(pl, obj.oid, a, v)
+
+    def _set_indexed_values(self, obj, data):
+        """ Must be called after _do_update_attrs is executed. """
+        attr_dict = self.model._attr_dict
+        for fld in data.iterkeys():
+            a = attr_dict[fld]
+            if a.indexed or a.zindexed or a.listed:
+                obj._indexed_values[fld] = data[fld]
 
+    @operation('ModelWriter.create')
     def create(self, obj, owner = None):
         assert type(obj) is self.model and obj.oid is None
         assert owner is None or owner.oid is not None
         assert (owner is None and self.model._owner is None) or (type(owner) is self.model._owner) or (type(owner) is Handle and owner.model is self.model._owner), 'Wrong owner.'
         if owner is None:
-            obj.oid = str(ds.incr(self.modname + ':id'))
+            obj.oid = str(self.conn.incr(self.keyname + ':id'))
         else:
             obj.oid = owner.oid
         self.__update_attrs(obj, obj.make_dict())
-        key = obj.key
+        self.__set_container_handles(obj)
+
+    @operation('ModelWriter.create_many')
+    def create_many(self, objs, chunk_size = 1000):
+        """ Creates many objects efficiently: ids are reserved with a single
+            INCRBY, unique values are checked in a single round trip, and
+            objects are written in atomic batches of chunk_size objects.
+            UniqueError is raised before writing anything if a unique value
+            already exists or is repeated in objs (unless a concurrent writer
+            takes it meanwhile, in which case the failing batch and the
+            following ones are not written). Owned models are not supported
+            (use create). """
+        assert self.model._owner is None, 'Owned models not supported.'
+        assert chunk_size > 0
+        objs = list(objs)
+        for obj in objs:
+            assert type(obj) is self.model and obj.oid is None
+        if len(objs) == 0:
+            return
+        datas = [obj.make_dict() for obj in objs]
+        self.__check_unique_many(datas)
+        last_id = self.conn.incrby(self.keyname + ':id', len(objs))
+        first_id = last_id - len(objs) + 1
+        for i, obj in enumerate(objs):
+            obj.oid = str(first_id + i)
+        for i in range(0, len(objs), chunk_size):
+            batch = new_batch()
+            for obj, data in zip(objs[i:i + chunk_size], datas[i:i + chunk_size]):
+                if len(data):
+                    self._check_unique_for_update(batch, obj, data)
+                    self._do_update_attrs(batch, obj, data)
+                    batch.after(self._set_indexed_values, obj, data)
+            batch.execute(self.conn)
+        for obj in objs:
+            self.__set_container_handles(obj)
+
+    def _record_create_many(self, batch, objs):
+        """ Reserves ids for objs with a single INCRBY, and records their
+            creation (with unique checks) into batch. """
+        assert self.model._owner is None, 'Owned models not supported.'
+        for obj in objs:
+            assert type(obj) is self.model and obj.oid is None
+        if len(objs) == 0:
+            return
+        last_id = self.conn.incrby(self.keyname + ':id', len(objs))
+        first_id = last_id - len(objs) + 1
+        for i, obj in enumerate(objs):
+            obj.oid = str(first_id + i)
+            data = obj.make_dict()
+            if len(data):
+                self._check_unique_for_update(batch, obj, data)
+                self._do_update_attrs(batch, obj, data)
+                batch.after(self._set_indexed_values, obj, data)
+            batch.after(self.__set_container_handles, obj)
+
+    def __check_unique_many(self, datas):
+        flds = [a.name for a in self.model._attributes if a.unique]
+        if len(flds) == 0:
+            return
+        pl = self.conn.pipeline(False)
+        for fld in flds:
+            k = 'u:{0}:{1}'.format(self.keyname, fld)
+            vals = [data[fld] for data in datas]
+            seen = set()
+            for v in vals:
+                if v in seen:
+                    raise UniqueError(k, v)
+                seen.add(v)
+            pl.hmget(k, vals)
+        for fld, found in zip(flds, pl.execute()):
+            for data, oid in zip(datas, found):
+                if oid is not None:
+                    raise UniqueError('u:{0}:{1}'.format(self.keyname, fld), data[fld])
+
+    def __set_container_handles(self, obj):
+        key = self.model._container_key
         for l in obj._lists:
-            obj.__dict__[l.name] = ListHandle(key + ':' + l.name, l.target_type)
+            setattr(obj, l.name, l.handle_type(key(obj.oid, l), l.target_type, self.conn))
         for s in obj._sets:
-            obj.__dict__[s.name] = SetHandle(key + ':' + s.name, s.target_type)
+            setattr(obj, s.name, SetHandle(key(obj.oid, s), s.target_type, self.conn))
         for z in obj._zsets:
-            obj.__dict__[z.name] = SortedSetHandle(key + ':' + z.name, z.target_type)
+            setattr(obj, z.name, SortedSetHandle(key(obj.oid, z), z.target_type, self.conn))
 
     def _get_update_data(self, obj, **kwargs):
         assert type(obj) is self.model and obj.oid is not None
         assert len(kwargs) > 0
+        self._check_loaded(obj, kwargs.keys())
         return obj.update_attributes_dict(**kwargs)
 
+    def _check_loaded(self, obj, fields = None):
+        """ Raises BadArgsError if obj is a partial object which has not
+            loaded some of fields (None means all fields). Packed objects
+            are written as a whole, so they need all their fields. """
+        if obj.is_partial():
+            if fields is None or self.model._packed is not None:
+                missing = [a.name for a in self.model._attributes]
+            else:
+                missing = fields
+            missing = [f for f in missing if f not in obj._loaded_fields]
+            if len(missing):
+                raise BadArgsError('{0} is partially loaded (missing {1}), cannot write it'.format(obj.key, ', '.join(sorted(missing))))
+
+    @operation('ModelWriter.update')
     def update(self, obj, **kwargs):
         data = self._get_update_data(obj, **kwargs)
         self.__update_attrs(obj, data)
 
+    @operation('ModelWriter.update_all')
     def update_all(self, obj):
         assert type(obj) is self.model and obj.oid is not None
+        self._check_loaded(obj)
         self.__update_attrs(obj, obj.make_dict())
 
-    def delete(self, obj):
+    @operation('ModelWriter.delete')
+    def delete(self, obj, cascade = False):
+        """ Deletes obj and its attribute indexes. If cascade is True, its
+            container fields are deleted too (with UNLINK, so big containers
+            are reclaimed in the background), along with their index entries
+            and the elements of owned containers (recursively), in the same
+            atomic step. """
         assert type(obj) is self.model and obj.oid is not None
-        if not ds.exists(obj.key):
+        self._check_loaded(obj)
+        if not self.conn.exists(obj.key):
             raise NotFoundError(obj.key)
-        pl = ds.pipeline(True)
-        self.__unindex_all(pl, obj)
-        pl.delete(obj.key)
-        pl.execute()
-        obj.oid = None
+        batch = new_batch()
+        if cascade:
+            self._record_cascade(batch, [obj])
+        else:
+            self._record_delete(batch, obj)
+        batch.execute(self.conn)
+
+    @operation('ModelWriter.delete_where')
+    def delete_where(self, batch_size = 500, progress = None, cascade = False, **kwargs):
+        """ Deletes the objects found by a condition on a non unique index,
+            given as in multifind (e.g. city = hcity). The index is walked
+            with SSCAN, and every step (about batch_size objects) is loaded
+            with load_many and deleted in its own atomic batch, so big
+            indexes never block redis. cascade is as in delete.
+            progress(n) is called after every batch with the number of
+            objects deleted so far. Returns that number. Not supported in a
+            Session. """
+        assert current_batch() is None, 'delete_where is not supported in a Session.'
+        fld = kwargs.keys()[0].split('__')[0] if len(kwargs) == 1 else None
+        f = getattr(self.model, fld, None) if fld is not None else None
+        if not getattr(f, 'indexed', False) or getattr(f, 'unique', False):
+            raise BadArgsError('delete_where needs a condition on a non unique index: {0}'.format(kwargs.keys()))
+        k = self.model._index_key(kwargs)
+        n = 0
+        cursor = 0
+        while True:
+            cursor, oids = self.conn.sscan(k, cursor, count = batch_size)
+            objs = self.model.load_many([Handle(self.model, oid) for oid in oids], conn = self.conn)
+            objs = [o for o in objs if o is not None]
+            if len(objs):
+                batch = CommandBatch()
+                if cascade:
+                    self._record_cascade(batch, objs)
+                else:
+                    for obj in objs:
+                        self._record_delete(batch, obj)
+                batch.execute(self.conn)
+                n += len(objs)
+                if progress is not None:
+                    progress(n)
+            if int(cursor) == 0:
+                break
+        return n
+
+    @operation('ModelWriter.truncate')
+    def truncate(self, batch_size = 500, progress = None):
+        """ Deletes all the objects of the model, with their containers and
+            indexes. Keys are walked with SCAN, and deleted with UNLINK in
+            batches of batch_size keys, so it can run on a live server. The
+            id counter is kept, so ids are not reused. Other models are not
+            changed (e.g. the elements of owned containers, or indexes of
+            other models referencing deleted objects). progress(n) is called
+            after every batch with the number of keys deleted so far.
+            Returns that number. """
+        counter = self.keyname + ':id'
+        patterns = [self.keyname + ':*'] + [p + ':' + self.keyname + ':*' for p in 'uizl']
+        if self.model._hash_tag == 'object':
+            patterns.append('{' + self.modname + ':*')
+        n = 0
+        for pattern in patterns:
+            keys = []
+            for key in self.conn.scan_iter(pattern, batch_size):
+                if key != counter:
+                    keys.append(key)
+                if len(keys) == batch_size:
+                    n = self.__unlink(keys, n, progress)
+                    keys = []
+            if len(keys):
+                n = self.__unlink(keys, n, progress)
+        return n
+
+    @operation('ModelWriter.migrate_listed')
+    def migrate_listed(self, fld, batch_size = 1000, progress = None):
+        """ Converts the redis lists of attribute fld, written while it was
+            listed = True, to the sorted sets of listed = 'zset', keeping
+            their order. Run it after changing the model definition, before
+            writing objects of the model. Lists are walked with SCAN, and
+            copied in chunks of batch_size elements to a temporary sorted set,
+            which then replaces the list atomically. progress(n) is called
+            after every converted list. Returns the number of lists. """
+        a = self.model._attr_dict.get(fld)
+        if a is None or a.listed != 'zset':
+            raise BadArgsError('{0}.{1} is not listed = \'zset\''.format(self.modname, fld))
+        n = 0
+        for key in self.conn.scan_iter('l:{0}:{1}:*'.format(self.keyname, fld), batch_size):
+            if self.conn.type(key) != 'list':
+                continue
+            tmp = key + ':migrating'
+            self.conn.delete(tmp)
+            start = 0
+            while True:
+                oids = self.conn.lrange(key, start, start + batch_size - 1)
+                if len(oids) == 0:
+                    break
+                self.conn.zadd(tmp, **dict((oid, start + i + 1) for i, oid in enumerate(oids)))
+                start += len(oids)
+            batch = CommandBatch()
+            batch.unlink(key)
+            batch.rename(tmp, key)
+            batch.execute(self.conn)
+            n += 1
+            if progress is not None:
+                progress(n)
+        return n
+
+    def __unlink(self, keys, n, progress):
+        if is_cluster(self.conn):
+            # keys are in several hash slots, the cluster pipeline splits them
+            pl = self.conn.pipeline(False)
+            for key in keys:
+                pl.unlink(key)
+            pl.execute()
+        else:
+            batch = CommandBatch()
+            batch.unlink(*keys)
+            batch.execute(self.conn)
+        n += len(keys)
+        if progress is not None:
+            progress(n)
+        return n
+
+    def _record_cascade(self, batch, objs):
+        """ Records the deletion of objs with their containers. Only indexed
+            and owned containers are read (paged, see _scan_containers), to
+            clean their index entries and delete their elements; the others
+            are just unlinked. Owned elements are loaded in one more round
+            trip for every owned container field. """
+        fields = self.model._lists + self.model._sets + self.model._zsets
+        if len(fields) and len(objs):
+            container_key = self.model._container_key
+            reads = [(f, container_key(obj.oid, f)) for obj in objs
+                     for f in fields if f.indexed or f.owned]
+            contents = iter(_scan_containers(self.conn, reads))
+            owned = {}
+            for obj in objs:
+                for f in fields:
+                    batch.unlink(container_key(obj.oid, f))
+                    if not (f.indexed or f.owned):
+                        continue
+                    members = next(contents)
+                    if f.indexed and len(members):
+                        index_key = ('u:' if f.unique else 'i:') + self.keyname + ':' + f.name
+                        if f.unique:
+                            for chunk in _chunks(members):
+                                batch.hdel(index_key, *chunk)
+                        else:
+                            for m in members:
+                                batch.srem(index_key + ':' + m, obj.oid)
+                    if f.owned:
+                        owned.setdefault(f, set()).update(members)
+            for f, oids in owned.iteritems():
+                target = f.target_type
+                elements = target.load_many(map(target.by_id, sorted(oids)), conn = self.conn)
+                elements = [e for e in elements if e is not None]
+                ModelWriter(target, self.conn)._record_cascade(batch, elements)
+        for obj in objs:
+            self._record_delete(batch, obj)
+
+    def _record_delete(self, batch, obj):
+        self.__unindex_all(batch, obj)
+        batch.delete(obj.key)
+        batch.after(setattr, obj, 'oid', None)
 
 class ContainerFieldWriter(ContainerWriter):
-    def __init__(self, field, element_writer = None):
+    def __init__(self, field, element_writer = None, conn = None):
         assert (not field.owned and element_writer is None) or (field.owned and element_writer is not None)
         self.field = field
         self.element_writer = element_writer
         index_key = None
         if field.indexed:
             index_key = 'u:' if field.unique else 'i:'
-            index_key += field.model.__name__ + ':' + field.name
-        ContainerWriter.__init__(self, field.target_type, index_key, field.unique)
+            index_key += field.model._key_name + ':' + field.name
+        ContainerWriter.__init__(self, field.target_type, index_key, field.unique, conn)
 
+    @operation('ContainerFieldWriter.append')
     def append(self, hcont, value, score = None):
         if self.field.owned:
             assert value.oid is None
@@ -175,31 +455,98 @@ class ContainerFieldWriter(ContainerWriter):
             value = value.handle()
         ContainerWriter.append(self, hcont, value, score)
 
+    @operation('ContainerFieldWriter.remove')
     def remove(self, hcont, value):
         assert (not self.field.owned) or isinstance(value, Model)
+        if self.field.owned:
+            self.element_writer._check_loaded(value)
+        in_session = current_batch() is not None
+        if self.field.owned and in_session:
+            # removal is deferred, so check membership now
+            if not self.raw_contains(self.conn, hcont, value.oid):
+                raise NotFoundError('{0} in {1}'.format(value.handle(), hcont))
         removed = ContainerWriter.remove(self, hcont, value)
         if self.field.owned:
-            if not removed:
+            if not in_session and not removed:
                 raise NotFoundError('{0} in {1}'.format(value.handle(), hcont))
             assert value.oid is not None
             self.element_writer.delete(value)
             assert value.oid is None
 
+    @operation('ContainerFieldWriter.extend')
+    def extend(self, hcont, values, scores = None):
+        """ Appends many values, see ContainerWriter.extend. For owned
+            fields, values are new objects, which are created in the same
+            atomic step (nothing is written if a unique value of them
+            already exists, or is repeated). """
+        if not self.field.owned:
+            return ContainerWriter.extend(self, hcont, values, scores)
+        values = list(values)
+        if scores is not None:
+            scores = list(scores)
+            assert len(scores) == len(values)
+        if len(values) == 0:
+            return
+        batch = new_batch()
+        self.element_writer._record_create_many(batch, values)
+        raw = [self._raw_value(hcont, v.handle()) for v in values]
+        self._record_extend(batch, hcont, raw, scores)
+        batch.execute(self.conn)
+
+    @operation('ContainerFieldWriter.remove_many')
+    def remove_many(self, hcont, values):
+        """ Removes many values, see ContainerWriter.remove_many. For owned
+            fields, values are objects, which are deleted in the same atomic
+            step (NotFoundError is raised before writing anything if some of
+            them are not in the container). Membership is checked with
+            SISMEMBER or ZSCORE in one round trip (redis lists are read). """
+        if not self.field.owned:
+            return ContainerWriter.remove_many(self, hcont, values)
+        values = list(values)
+        for v in values:
+            assert isinstance(v, Model) and v.oid is not None
+            self.element_writer._check_loaded(v)
+        f = self.field
+        if isinstance(f, ListField) and f.backend == 'list':
+            members = set(_read_container(self.conn, f, hcont.key))
+            found = [v.oid in members for v in values]
+        else:
+            pl = self.conn.pipeline(False)
+            for v in values:
+                if isinstance(f, SetField):
+                    pl.sismember(hcont.key, v.oid)
+                else:
+                    pl.zscore(hcont.key, v.oid)
+            found = [bool(r) if isinstance(f, SetField) else r is not None for r in pl.execute()]
+        for v, ok in zip(values, found):
+            if not ok:
+                raise NotFoundError('{0} in {1}'.format(v.handle(), hcont))
+        if len(values) == 0:
+            return 0
+        batch = new_batch()
+        self._record_remove_many(batch, hcont, [v.oid for v in values])
+        for v in values:
+            self.element_writer._record_delete(batch, v)
+        if batch.execute(self.conn) is None:
+            return None
+        return len(values)
+
 class ListFieldWriter(ContainerFieldWriter, ListWriter):
-    def __init__(self, field, element_writer = None):
+    def __init__(self, field, element_writer = None, conn = None):
         assert type(field) is ListField
-        ContainerFieldWriter.__init__(self, field, element_writer)
+        ContainerFieldWriter.__init__(self, field, element_writer, conn)
 
 class SetFieldWriter(ContainerFieldWriter, SetWriter):
-    def __init__(self, field, element_writer = None):
+    def __init__(self, field, element_writer = None, conn = None):
         assert type(field) is SetField
-        ContainerFieldWriter.__init__(self, field, element_writer)
+        ContainerFieldWriter.__init__(self, field, element_writer, conn)
 
 class SortedSetFieldWriter(ContainerFieldWriter, SortedSetWriter):
-    def __init__(self, field, element_writer = None):
+    def __init__(self, field, element_writer = None, conn = None):
         assert type(field) is SortedSetField
-        ContainerFieldWriter.__init__(self, field, element_writer)
+        ContainerFieldWriter.__init__(self, field, element_writer, conn)
 
+    @operation('SortedSetFieldWriter.append')
     def append(self, hcont, value, score = None):
         """ If sort_field is specified, score must be None.
             If sort_field is not specified, score is mandatory. """
@@ -208,24 +555,36 @@ class SortedSetFieldWriter(ContainerFieldWriter, SortedSetWriter):
             score = getattr(value, self.field.sort_field.name)
         ContainerFieldWriter.append(self, hcont, value, score)
 
+    @operation('SortedSetFieldWriter.extend')
+    def extend(self, hcont, values, scores = None):
+        """ As append, scores must be None if and only if sort_field is
+            specified. """
+        assert (scores is None) != (self.field.sort_field is None)
+        if scores is None:
+            values = list(values)
+            scores = [getattr(v, self.field.sort_field.name) for v in values]
+        ContainerFieldWriter.extend(self, hcont, values, scores)
+
+    @operation('SortedSetFieldWriter.update')
     def update(self, hcont, obj, **kwargs):
         assert self.field.owned
+        self.element_writer._check_loaded(obj, kwargs.keys() + [self.field.sort_field.name])
         data = self.element_writer._get_update_data(obj, **kwargs)
-        self.element_writer._check_unique_for_update(obj, data)
-        pl = ds.pipeline(True)
-        SortedSetWriter.raw_remove(self, pl, hcont, obj.oid)
-        self.element_writer._do_update_attrs(pl, obj, data)
-        score = getattr(obj, self.field.sort_field.name)
-        SortedSetWriter.raw_append(self, pl, hcont, obj.oid, score)
-        pl.execute()
+        self.__update_sorted(hcont, obj, data)
 
+    @operation('SortedSetFieldWriter.update_all')
     def update_all(self, hcont, obj):
         assert self.field.owned
+        self.element_writer._check_loaded(obj)
         data = obj.make_dict()
-        self.element_writer._check_unique_for_update(obj, data)
-        pl = ds.pipeline(True)
-        SortedSetWriter.raw_remove(self, pl, hcont, obj.oid)
-        self.element_writer._do_update_attrs(pl, obj, data)
+        self.__update_sorted(hcont, obj, data)
+
+    def __update_sorted(self, hcont, obj, data):
+        batch = new_batch()
+        self.element_writer._check_unique_for_update(batch, obj, data)
+        SortedSetWriter.raw_remove(self, batch, hcont, obj.oid)
+        self.element_writer._do_update_attrs(batch, obj, data)
         score = getattr(obj, self.field.sort_field.name)
-        SortedSetWriter.raw_append(self, pl, hcont, obj.oid, score)
-        pl.execute()
+        SortedSetWriter.raw_append(self, batch, hcont, obj.oid, score)
+        batch.after(self.element_writer._set_indexed_values, obj, data)
+        batch.execute(self.conn)
@@ -24,6 +24,7 @@ setup(name='redmodel',
       keywords=['Redis', 'model', 'container'],
       license='GPL',
       packages=['redmodel', 'redmodel.models'],
+      extras_require={'cluster': ['redis-py-cluster']},
       #test_suite='test.models.all_tests',
       classifiers=[
         'Development Status :: 4 - Beta',
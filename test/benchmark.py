@@ -0,0 +1,281 @@
+"""
+    Copyright (C) 2011 Maximiliano Pin
+
+    Redmodel is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Lesser General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Redmodel is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public License
+    along with Redmodel.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+""" Benchmarks of the basic operations, using the example models.
+
+    A throwaway redis-server is started on a free port (it must be in the
+    PATH, or given with --redis-server). For every dataset size, the
+    database is filled with fighters, cities and gangs, and every operation
+    is run --ops times, reporting ops/sec, p50/p99 latency and round trips
+    per operation. Results can be saved as JSON, and compared with a
+    previous run:
+
+        python -m test.benchmark --sizes 1000,10000 --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+import timeit
+from datetime import datetime
+import redis
+import redmodel
+from redmodel import connection as ds
+from redmodel.models import ModelWriter, ListFieldWriter, SetFieldWriter, SortedSetFieldWriter
+from test.example_models import City, Weapon, Fighter, Gang
+
+class CountingConnection(redis.Connection):
+    """ Connection which counts round trips (commands or pipelines sent). """
+    round_trips = 0
+
+    def send_packed_command(self, command):
+        CountingConnection.round_trips += 1
+        redis.Connection.send_packed_command(self, command)
+
+class RedisServer(object):
+    """ redis-server process without persistence, on a free port. """
+    def __init__(self, executable = 'redis-server'):
+        self.executable = executable
+        self.port = self.__free_port()
+        self.process = None
+
+    def __free_port(self):
+        s = socket.socket()
+        s.bind(('localhost', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def start(self):
+        self.process = subprocess.Popen([self.executable, '--port', str(self.port),
+                                         '--save', '', '--appendonly', 'no'],
+                                        stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        conn = redis.Redis(port = self.port)
+        for i in range(100):
+            try:
+                conn.ping()
+                return
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        self.stop()
+        raise RuntimeError('redis-server did not start')
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+def populate(size):
+    """ Fills the database with size fighters, size / 10 cities (so every
+        city index has about 10 fighters) and size / 10 gangs. """
+    ds.flushdb()
+    ncities = max(size // 10, 1)
+    cities = [City(name = 'city{0}'.format(i), coast = i % 2 == 0) for i in range(ncities)]
+    ModelWriter(City).create_many(cities)
+    fighters = [Fighter(name = 'fighter{0}'.format(i), age = 18 + i % 50, weight = 50.0 + i % 60,
+                        joined = datetime.utcfromtimestamp(1300000000 + i), city = cities[i % ncities])
+                for i in range(size)]
+    ModelWriter(Fighter).create_many(fighters)
+    gangs = [Gang(name = 'gang{0}'.format(i), leader = fighters[i], hqcity = cities[i % ncities])
+             for i in range(ncities)]
+    ModelWriter(Gang).create_many(gangs)
+
+class Benchmarks(object):
+    """ Every operation is a (name, prepare) pair, where prepare(count)
+        returns the list of callables to time (prepare is not timed).
+        Operations run in order, on the data left by the previous ones. """
+    def __init__(self, size, rnd):
+        self.size = size
+        self.ncities = max(size // 10, 1)
+        self.rnd = rnd
+        self.created = []
+        self.weapons = []
+        self.operations = [
+            ('create', self.prepare_create),
+            ('update', self.prepare_update),
+            ('load', self.prepare_load),
+            ('find', self.prepare_find),
+            ('multifind', self.prepare_multifind),
+            ('zfind', self.prepare_zfind),
+            ('list_append', self.prepare_list_append),
+            ('list_remove', self.prepare_list_remove),
+            ('set_append', self.prepare_set_append),
+            ('set_remove', self.prepare_set_remove),
+            ('sorted_set_append', self.prepare_sorted_set_append),
+            ('sorted_set_remove', self.prepare_sorted_set_remove),
+            ('delete', self.prepare_delete)]
+
+    def fighter_ids(self, count):
+        return [self.rnd.randint(1, self.size) for i in range(count)]
+
+    def city_ids(self, count):
+        return [self.rnd.randint(1, self.ncities) for i in range(count)]
+
+    def prepare_create(self, count):
+        writer = ModelWriter(Fighter)
+        hcity = City.by_id(1)
+        self.created = [Fighter(name = 'new{0}'.format(i), age = 30, weight = 80.0,
+                                joined = None, city = hcity) for i in range(count)]
+        return [lambda f = f: writer.create(f) for f in self.created]
+
+    def prepare_update(self, count):
+        writer = ModelWriter(Fighter)
+        fighters = Fighter.load_many(map(Fighter.by_id, self.fighter_ids(count)))
+        return [lambda f = f: writer.update(f, age = f.age + 1, city = City.by_id(2)) for f in fighters]
+
+    def prepare_load(self, count):
+        return [h.load for h in map(Fighter.by_id, self.fighter_ids(count))]
+
+    def prepare_find(self, count):
+        return [lambda i = i: Fighter.find(name = 'fighter{0}'.format(i - 1)) for i in self.fighter_ids(count)]
+
+    def prepare_multifind(self, count):
+        return [lambda h = h: Fighter.multifind(city = h) for h in map(City.by_id, self.city_ids(count))]
+
+    def prepare_zfind(self, count):
+        return [lambda a = a: Fighter.zfind(age__in = (a, a + 1)) for a in [self.rnd.randint(18, 66) for i in range(count)]]
+
+    def prepare_list_append(self, count):
+        writer = ListFieldWriter(City.connections)
+        self.connections = [(City.by_id(i).load().connections, City.by_id(j))
+                            for i, j in zip(self.city_ids(count), self.city_ids(count))]
+        return [lambda c = c: writer.append(*c) for c in self.connections]
+
+    def prepare_list_remove(self, count):
+        writer = ListFieldWriter(City.connections)
+        return [lambda c = c: writer.remove(*c) for c in self.connections]
+
+    def prepare_set_append(self, count):
+        writer = SetFieldWriter(Gang.cities)
+        gangs = Gang.load_many(map(Gang.by_id, self.city_ids(count)))
+        self.gang_cities = [(g.cities, City.by_id(i)) for g, i in zip(gangs, self.city_ids(count))]
+        return [lambda c = c: writer.append(*c) for c in self.gang_cities]
+
+    def prepare_set_remove(self, count):
+        writer = SetFieldWriter(Gang.cities)
+        return [lambda c = c: writer.remove(*c) for c in self.gang_cities]
+
+    def prepare_sorted_set_append(self, count):
+        writer = SortedSetFieldWriter(Fighter.weapons, ModelWriter(Weapon))
+        fighters = Fighter.load_many(map(Fighter.by_id, self.fighter_ids(count)))
+        self.weapons = [(f.weapons, Weapon(description = 'w{0}'.format(i), power = self.rnd.random() * 100))
+                        for i, f in enumerate(fighters)]
+        return [lambda w = w: writer.append(*w) for w in self.weapons]
+
+    def prepare_sorted_set_remove(self, count):
+        writer = SortedSetFieldWriter(Fighter.weapons, ModelWriter(Weapon))
+        return [lambda w = w: writer.remove(*w) for w in self.weapons]
+
+    def prepare_delete(self, count):
+        writer = ModelWriter(Fighter)
+        return [lambda f = f: writer.delete(f) for f in self.created]
+
+def percentile(sorted_values, p):
+    i = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[i]
+
+def measure(calls):
+    latencies = []
+    trips = CountingConnection.round_trips
+    timer = timeit.default_timer
+    for call in calls:
+        t = timer()
+        call()
+        latencies.append(timer() - t)
+    trips = CountingConnection.round_trips - trips
+    total = sum(latencies)
+    latencies.sort()
+    return {'ops': len(calls),
+            'ops_per_sec': len(calls) / total if total else None,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'round_trips': float(trips) / len(calls)}
+
+def run(sizes, ops, seed = 0):
+    results = {}
+    for size in sizes:
+        sys.stderr.write('size {0}: populating...\n'.format(size))
+        populate(size)
+        bench = Benchmarks(size, random.Random(seed))
+        results[str(size)] = res = {}
+        for name, prepare in bench.operations:
+            calls = prepare(min(ops, size))
+            res[name] = measure(calls)
+            sys.stderr.write('  {0:<18} {1[ops_per_sec]:>10.0f} ops/s  p50 {1[p50_ms]:.3f} ms  '
+                             'p99 {1[p99_ms]:.3f} ms  {1[round_trips]:.2f} rt/op\n'.format(name, res[name]))
+    return results
+
+def compare(old, new):
+    """ Prints the ops/sec ratio (new / old) of the operations in both
+        result sets. """
+    for size in sorted(new['results'], key = int):
+        old_res = old['results'].get(size)
+        if old_res is None:
+            continue
+        print('size {0}'.format(size))
+        for name, r in sorted(new['results'][size].iteritems()):
+            o = old_res.get(name)
+            if o is None or not o['ops_per_sec'] or not r['ops_per_sec']:
+                continue
+            print('  {0:<18} {1:>6.2f}x ops/s  round trips {2:.2f} -> {3:.2f}'.format(
+                  name, r['ops_per_sec'] / o['ops_per_sec'], o['round_trips'], r['round_trips']))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Redmodel benchmarks.')
+    parser.add_argument('--sizes', default = '100,1000,10000',
+                        help = 'comma separated dataset sizes (number of fighters)')
+    parser.add_argument('--ops', type = int, default = 1000,
+                        help = 'operations per benchmark (at most the dataset size)')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--redis-server', default = 'redis-server')
+    parser.add_argument('--output', help = 'JSON file to save the results')
+    parser.add_argument('--compare', help = 'JSON file of a previous run')
+    args = parser.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    server = RedisServer(args.redis_server)
+    server.start()
+    try:
+        redmodel.connection_setup(host = 'localhost', port = server.port, db = 0)
+        redmodel.get_client().connection_pool.connection_class = CountingConnection
+        info = ds.info()
+        results = run(sizes, args.ops, args.seed)
+    finally:
+        server.stop()
+
+    data = {'timestamp': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'redis_py': redis.__version__,
+            'redis_server': info['redis_version'],
+            'ops': args.ops,
+            'seed': args.seed,
+            'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent = 2, sort_keys = True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), data)
+
+if __name__ == '__main__':
+    main()
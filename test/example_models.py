@@ -52,7 +52,9 @@ class Fighter(Model):
 #   exist containing gangs with their headquarters in each city. This is
 #   similar to indexed, but a list is used instead of a set. This is great
 #   to keep the elements sorted by creation time, but it's bad for removing
-#   or searching.
+#   or searching. With listed = 'zset', a sorted set scored by insertion
+#   sequence is used instead, which keeps the order and is fast to search
+#   and remove.
 class Gang(Model):
     name = Attribute()
     leader = ReferenceField(Fighter, unique = True)
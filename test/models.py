@@ -17,18 +17,72 @@
 
 import unittest
 import sys
+import time
+import warnings
 from datetime import datetime
 from test import example_data
 from test.example_models import City, Weapon, Fighter, Gang, Skill, SkillInstance, FighterSkillList
-from redmodel.models import SetField, ModelWriter, ListFieldWriter, SetFieldWriter, SortedSetFieldWriter, NotFoundError, UniqueError, BadArgsError
-from redmodel.containers import List, Set, SortedSet, ListHandle, SetHandle, SortedSetHandle, ListWriter, SetWriter, SortedSetWriter
+from redmodel.models import Model, Attribute, IntegerField, FloatField, BooleanField, UTCDateTimeField, ReferenceField, ListField, Recursive
+from redmodel.models import SetField, ModelWriter, ListFieldWriter, SetFieldWriter, SortedSetFieldWriter, NotFoundError, UniqueError, BadArgsError, SchemaError
+from redmodel.models import packing
+from redmodel.containers import List, Set, SortedSet, HandleArray, ListHandle, ZListHandle, SetHandle, SortedSetHandle, ListWriter, SetWriter, SortedSetWriter
 import redmodel
 from redmodel import connection as ds
+from redmodel.batch import Session, CommandBatch
+from redmodel.cluster import key_slot, rekey
+from redmodel import cache
+from redmodel import instrument
+from redmodel.models.base import _scan_containers
 
 
 class ModelTestCase(unittest.TestCase):
     pass
 
+class PackedFighter(Model):
+    storage = 'packed'
+    name = Attribute(unique = True)
+    age = IntegerField(zindexed = True)
+    weight = FloatField()
+    active = BooleanField()
+    joined = UTCDateTimeField()
+    city = ReferenceField(City, indexed = True)
+
+class SlottedCity(Model):
+    slots = True
+    name = Attribute(unique = True)
+    population = IntegerField(zindexed = True)
+    coast = BooleanField()
+    founded = UTCDateTimeField()
+    twin = ReferenceField(City)
+    connections = ListField(Recursive)
+
+class OrderedGang(Model):
+    name = Attribute()
+    hqcity = ReferenceField(City, listed = 'zset')
+
+class Route(Model):
+    name = Attribute()
+    stops = ListField(City, indexed = True, backend = 'zset')
+    skills = ListField(SkillInstance, owned = True, backend = 'zset')
+
+class Depot(Model):
+    hash_tag = 'model'
+    name = Attribute(unique = True)
+    zone = Attribute(indexed = True)
+    stock = SetField(str)
+
+class Truck(Model):
+    hash_tag = 'object'
+    plate = Attribute(unique = True)
+    cargo = ListField(str)
+    depots = SetField(Depot, indexed = True)
+
+class Badge(Model):
+    code = Attribute(unique = True)
+
+class Team(Model):
+    badges = SetField(Badge, owned = True)
+
 class ContainersTestCase(ModelTestCase):
 
     def setUp(self):
@@ -116,6 +170,40 @@ class ContainersTestCase(ModelTestCase):
         self.assertEqual(ds.hgetall('myindex'),
                 {'1': '1', '2': '1', '3': '1', '4': '2', '5': '2', '6': '2'})
 
+    def test_iter(self):
+        writer = ListWriter(int)
+        hlist = ListHandle('mylist', int)
+        for i in range(10):
+            writer.append(hlist, i)
+        self.assertEqual(list(hlist.iter(batch = 3)), range(10))
+        self.assertEqual(list(hlist.iter(batch = 5)), range(10))
+        self.assertEqual(list(ListHandle('nolist', int).iter()), [])
+
+        writer = SetWriter(int)
+        hset = SetHandle('myset', int)
+        for i in range(50):
+            writer.append(hset, i)
+        self.assertEqual(set(hset.iter(batch = 7)), set(range(50)))
+
+        writer = SortedSetWriter(str)
+        hzset = SortedSetHandle('myzset', str)
+        for i in range(10):
+            writer.append(hzset, 'e{0}'.format(i), -i)
+        self.assertEqual(list(hzset.iter(batch = 4)), ['e{0}'.format(i) for i in range(9, -1, -1)])
+
+        # model elements
+        city_writer = ModelWriter(City)
+        cities = [City(name = 'City{0}'.format(i), coast = False) for i in range(10)]
+        city_writer.create_many(cities)
+        writer = ListWriter(City)
+        hlist = ListHandle('mycities', City)
+        for c in cities:
+            writer.append(hlist, c)
+        writer.append(hlist, City.by_id(99))
+        self.assertEqual(list(hlist.iter(batch = 4)), [c.handle() for c in cities] + [City.by_id(99)])
+        names = [c.name for c in hlist.iter(batch = 4, load = True)]
+        self.assertEqual(names, ['City{0}'.format(i) for i in range(10)])
+
 class ModelWriteTestCase(ModelTestCase):
 
     def setUp(self):
@@ -257,6 +345,44 @@ class ModelWriteTestCase(ModelTestCase):
         self.assertEqual(ds.hgetall('Weapon:2'), {'description': 'third', 'power': '34.2'})
         self.assertEqual(ds.hgetall('Weapon:3'), {'description': 'first', 'power': '50.7'})
 
+    def test_create_many(self):
+        city_writer = ModelWriter(City)
+        cities = [City(name = 'City{0}'.format(i), coast = i % 2 == 0) for i in range(5)]
+        city_writer.create_many(cities, chunk_size = 2)
+        self.assertEqual([c.oid for c in cities], ['1', '2', '3', '4', '5'])
+        self.assertEqual(ds.get('City:id'), '5')
+        self.assertEqual(ds.hgetall('City:4'), {'name': 'City3', 'coast': '0'})
+        self.assertEqual(cities[0].connections.key, 'City:1:connections')
+        c6 = City(name = 'Single', coast = False)
+        city_writer.create(c6)
+        self.assertEqual(c6.oid, '6')
+
+        fighter_writer = ModelWriter(Fighter)
+        dtime = datetime.utcfromtimestamp(1400000000)
+        f1 = Fighter(name = 'Alice', age = 20, weight = 60, joined = dtime, city = 1)
+        f2 = Fighter(name = 'Bob', age = 30, weight = 70, joined = dtime, city = 2)
+        f3 = Fighter(name = 'Carol', age = 25, weight = 50, joined = dtime, city = 1)
+        fighter_writer.create_many([f1, f2, f3])
+        self.assertEqual(ds.hgetall('u:Fighter:name'), {'Alice': '1', 'Bob': '2', 'Carol': '3'})
+        self.assertEqual(ds.smembers('i:Fighter:city:1'), set(['1', '3']))
+        self.assertEqual(ds.zrange('z:Fighter:age', 0, -1), ['1', '3', '2'])
+
+        # unique values are checked before writing anything
+        f4 = Fighter(name = 'Dave', age = 20, weight = 60, joined = dtime, city = 1)
+        f5 = Fighter(name = 'Bob', age = 20, weight = 60, joined = dtime, city = 1)
+        self.assertRaises(UniqueError, fighter_writer.create_many, [f4, f5])
+        f5 = Fighter(name = 'Dave', age = 20, weight = 60, joined = dtime, city = 1)
+        self.assertRaises(UniqueError, fighter_writer.create_many, [f4, f5])
+        self.assertTrue(f4.oid is None)
+        self.assertEqual(ds.get('Fighter:id'), '3')
+        self.assertEqual(ds.hlen('u:Fighter:name'), 3)
+
+        gang_writer = ModelWriter(Gang)
+        g1 = Gang(name = 'Ghetto Warriors', leader = f1, hqcity = cities[2])
+        g2 = Gang(name = 'Midnight Club', leader = f2, hqcity = cities[2])
+        gang_writer.create_many([g1, g2])
+        self.assertEqual(ds.lrange('l:Gang:hqcity:3', 0, -1), ['1', '2'])
+
     def test_update(self):
         example_data.load()
         fighter_writer = ModelWriter(Fighter)
@@ -329,6 +455,378 @@ class ModelWriteTestCase(ModelTestCase):
         self.assertEqual(ds.zrange('Fighter:1:weapons', 0, -1), ['2', '1', '3'])
         self.assertEqual(ds.hgetall('Weapon:2'), {'description': 'degraded', 'power': '10'})
 
+    def test_atomic_unique(self):
+        example_data.load()
+        fighter_writer = ModelWriter(Fighter)
+
+        # failed unique check writes nothing and keeps old index values
+        fighter2 = Fighter(Fighter.by_id(2))
+        self.assertRaises(UniqueError, fighter_writer.update, fighter2, name = 'Alice', age = 50)
+        self.assertEqual(ds.hgetall('u:Fighter:name'), {'Alice': '1', 'Bob': '2'})
+        self.assertEqual(ds.hget('Fighter:2', 'age'), '23')
+        fighter_writer.update(fighter2, name = 'Robert', age = 24)
+        self.assertEqual(ds.hgetall('u:Fighter:name'), {'Alice': '1', 'Robert': '2'})
+        self.assertEqual(ds.zscore('z:Fighter:age', '2'), 24)
+
+        # the script is loaded again if redis forgets it
+        ds.script_flush()
+        fighter_writer.update(fighter2, name = 'Bob')
+        self.assertEqual(ds.hgetall('u:Fighter:name'), {'Alice': '1', 'Bob': '2'})
+        ds.script_flush()
+        gang_members_writer = SetFieldWriter(Gang.members)
+        gang2 = Gang(Gang.by_id(2))
+        self.assertRaises(UniqueError, gang_members_writer.append, gang2.members, fighter2)
+        self.assertEqual(ds.smembers('Gang:2:members'), set())
+
+    def test_session(self):
+        example_data.load()
+        fighter_writer = ModelWriter(Fighter)
+        gang_writer = ModelWriter(Gang)
+        gang_members_writer = SetFieldWriter(Gang.members)
+        gang_cities_writer = SetFieldWriter(Gang.cities)
+        skill_instance_writer = ModelWriter(SkillInstance)
+        fighter_skills_writer = ListFieldWriter(FighterSkillList.skills, element_writer = skill_instance_writer)
+
+        fighter1 = Fighter(Fighter.by_id(1))
+        gang2 = Gang(Gang.by_id(2))
+        fsl = FighterSkillList(FighterSkillList.by_owner(fighter1))
+        with Session():
+            fighter_writer.update(fighter1, name = 'Alicia', city = City.by_id(2))
+            fighter_writer.update(fighter1, name = 'Ali')
+            gang_writer.update(gang2, leader = Fighter.by_id(2))
+            gang_cities_writer.append(gang2.cities, City.by_id(2))
+            fighter_skills_writer.remove(fsl.skills, SkillInstance(SkillInstance.by_id(1)))
+            # nothing is written until the end of the block
+            self.assertEqual(ds.hget('Fighter:1', 'name'), 'Alice')
+            self.assertEqual(ds.smembers('Gang:2:cities'), set())
+            self.assertTrue(ds.exists('SkillInstance:1'))
+        self.assertEqual(ds.hgetall('u:Fighter:name'), {'Ali': '1', 'Bob': '2'})
+        self.assertEqual(ds.smembers('i:Fighter:city:2'), set(['1']))
+        self.assertEqual(ds.hgetall('u:Gang:leader'), {'1': '1', '2': '2'})
+        self.assertEqual(ds.smembers('i:Gang:cities:2'), set(['2']))
+        self.assertEqual(ds.lrange('FighterSkillList:1:skills', 0, -1), ['2'])
+        self.assertFalse(ds.exists('SkillInstance:1'))
+
+        # owned element must be in the container
+        with Session():
+            self.assertRaises(NotFoundError, fighter_skills_writer.remove, fsl.skills, SkillInstance(SkillInstance.by_id(3)))
+
+        # all or nothing
+        fighter2 = Fighter(Fighter.by_id(2))
+        try:
+            with Session():
+                fighter_writer.update(fighter2, age = 50)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(ds.hget('Fighter:2', 'age'), '23')
+        fighter2 = Fighter(Fighter.by_id(2))
+        def failing_session():
+            with Session():
+                fighter_writer.update(fighter2, age = 50)
+                gang_members_writer.append(gang2.members, Fighter.by_id(1))
+        self.assertRaises(UniqueError, failing_session)
+        self.assertEqual(ds.hget('Fighter:2', 'age'), '23')
+        self.assertEqual(ds.smembers('Gang:2:members'), set())
+
+        # unique values taken twice in the session
+        def repeated_name():
+            with Session():
+                fighter_writer.create(Fighter(name = 'X', age = 20, weight = 70.0, joined = None, city = City.by_id(1)))
+                fighter_writer.create(Fighter(name = 'X', age = 21, weight = 71.0, joined = None, city = City.by_id(1)))
+        self.assertRaises(UniqueError, repeated_name)
+        self.assertEqual(ds.hget('u:Fighter:name', 'X'), None)
+        self.assertEqual(ds.keys('Fighter:[3-9]'), [])
+        fighter3 = Fighter(name = 'Y', age = 20, weight = 70.0, joined = None, city = City.by_id(1))
+        fighter_writer.create(fighter3)
+        def repeated_member():
+            with Session():
+                gang_members_writer.append(Gang(Gang.by_id(1)).members, fighter3)
+                gang_members_writer.append(gang2.members, fighter3)
+        self.assertRaises(UniqueError, repeated_member)
+        self.assertEqual(ds.hget('u:Gang:members', fighter3.oid), None)
+        self.assertFalse(ds.sismember('Gang:1:members', fighter3.oid))
+        self.assertEqual(ds.smembers('Gang:2:members'), set())
+
+    def test_explicit_client(self):
+        client = redmodel.Client(host = 'localhost', port = 6379, db = 1,
+                                 max_connections = 2, blocking = True,
+                                 blocking_timeout = 1, socket_keepalive = True)
+        conn = client.redis()
+        self.assertEqual(conn.connection_pool.max_connections, 2)
+        conn.flushdb()
+        try:
+            city_writer = ModelWriter(City, conn)
+            city_connections_writer = ListFieldWriter(City.connections, conn = conn)
+            c1 = City(name = 'Reixte', coast = True)
+            c2 = City(name = 'Damtoo', coast = True)
+            city_writer.create_many([c1, c2])
+            city_connections_writer.append(c1.connections, c2)
+            self.assertFalse(ds.exists('City:1'))
+            self.assertEqual(conn.hgetall('City:1'), {'name': 'Reixte', 'coast': '1'})
+
+            city = City.by_id(1).load(conn = conn)
+            self.assertEqual(city.name, 'Reixte')
+            self.assertEqual(List(city.connections), (City.by_id(2),))
+            cities = City.load_many([City.by_id(1), City.by_id(2)], conn = conn)
+            self.assertEqual([c.name for c in cities], ['Reixte', 'Damtoo'])
+            self.assertRaises(NotFoundError, City.by_id(1).load)
+            ds.hmset('City:3', {'name': 'Ghost', 'coast': '0'})
+            self.assertRaises(NotFoundError, City.by_id(3).load, conn = conn)
+
+            # sessions are written with their own client
+            def other_client_session():
+                with Session():
+                    city_writer.create(City(name = 'Aldor', coast = False))
+            self.assertRaises(BadArgsError, other_client_session)
+            self.assertEqual(ds.keys('City:*'), ['City:3'])
+            with Session(conn):
+                city_writer.create(City(name = 'Aldor', coast = False))
+            self.assertEqual(conn.hget('City:4', 'name'), 'Aldor')
+        finally:
+            conn.flushdb()
+
+        # idle connections are checked with a PING, and reconnected
+        hc = redmodel.Client(host = 'localhost', port = 6379, db = 1, health_check_interval = 0.05).redis()
+        hc.client_setname('checked')
+        pings = ds.info('commandstats').get('cmdstat_ping', {}).get('calls', 0)
+        hc.get('x')
+        self.assertEqual(ds.info('commandstats').get('cmdstat_ping', {}).get('calls', 0), pings)
+        time.sleep(0.1)
+        hc.get('x')
+        self.assertEqual(ds.info('commandstats')['cmdstat_ping']['calls'], pings + 1)
+        addr = [c['addr'] for c in ds.client_list() if c['name'] == 'checked'][0]
+        ds.client_kill(addr)
+        time.sleep(0.1)
+        self.assertEqual(hc.pipeline(True).get('x').execute(), [None])
+
+    def test_packed(self):
+        example_data.load()
+        writer = ModelWriter(PackedFighter)
+        joined = datetime(2011, 5, 3, 10, 20, 30)
+        f1 = PackedFighter(name = u'N\xfaria', age = -3, weight = 61.5,
+                           active = True, joined = joined, city = City.by_id(1))
+        f2 = PackedFighter(name = 'Lok', age = 40, weight = 98,
+                           active = False, joined = None, city = City.by_id(2))
+        writer.create(f1)
+        writer.create_many([f2])
+        self.assertEqual(ds.type('PackedFighter:1'), 'string')
+        self.assertEqual(len(ds.get('PackedFighter:1')), 34)
+        self.assertEqual(ds.hgetall('u:PackedFighter:name'), {'N\xc3\xbaria': '1', 'Lok': '2'})
+        self.assertEqual(ds.smembers('i:PackedFighter:city:1'), set(['1']))
+
+        f = PackedFighter.by_id(1).load()
+        self.assertEqual(f.name, 'N\xc3\xbaria')
+        self.assertEqual(f.age, -3)
+        self.assertEqual(f.weight, 61.5)
+        self.assertEqual(f.active, True)
+        self.assertEqual(f.joined, joined)
+        self.assertEqual(f.city, City.by_id(1))
+        f = PackedFighter.find(name = 'Lok').load()
+        self.assertEqual((f.weight, f.active, f.joined), (98.0, False, None))
+        self.assertEqual([o.name for o in PackedFighter.zrangebyscore_load('age', 0, 50)], ['Lok'])
+        self.assertEqual([o and o.age for o in PackedFighter.load_many([PackedFighter.by_id(2), PackedFighter.by_id(3)])], [40, None])
+        self.assertEqual(PackedFighter.by_id(2).load(['age']).make_dict(), {'age': 40})
+
+        writer.update(f, age = 41, city = City.by_id(1))
+        self.assertEqual(PackedFighter.by_id(2).load().age, 41)
+        self.assertEqual(PackedFighter.by_id(2).load().name, 'Lok')
+        self.assertEqual(ds.smembers('i:PackedFighter:city:1'), set(['1', '2']))
+        self.assertEqual(ds.zscore('z:PackedFighter:age', '2'), 41)
+        partial = PackedFighter.by_id(2).load(['age'])
+        self.assertRaises(BadArgsError, writer.update, partial, age = 42)
+
+        writer.delete(f)
+        self.assertFalse(ds.exists('PackedFighter:2'))
+        self.assertRaises(NotFoundError, PackedFighter.by_id(2).load)
+
+        # objects packed with other attributes are not misread
+        packed = ds.get('PackedFighter:1')
+        attributes = PackedFighter._packed
+        self.assertEqual(packing.unpack(attributes, packed)['name'], 'N\xc3\xbaria')
+        self.assertRaises(SchemaError, packing.unpack, [a for a in attributes if a.name != 'city'], packed)
+        extra = Attribute()
+        extra.name = 'zeta'
+        self.assertRaises(SchemaError, packing.unpack, attributes + [extra], packed)
+
+    def test_slots(self):
+        example_data.load()
+        self.assertTrue(isinstance(SlottedCity.name, Attribute))
+        self.assertTrue(SlottedCity.connections.target_type is SlottedCity)
+        writer = ModelWriter(SlottedCity)
+        connections_writer = ListFieldWriter(SlottedCity.connections)
+        c1 = SlottedCity(name = 'Reixte', population = 1200, coast = True,
+                         founded = datetime(1900, 1, 1), twin = City.by_id(1))
+        c2 = SlottedCity(name = 'Damtoo', population = 300, coast = False,
+                         founded = None, twin = City.by_id(2))
+        self.assertFalse(hasattr(c1, '__dict__'))
+        self.assertEqual(c1.oid, None)
+        writer.create(c1)
+        writer.create(c2)
+        connections_writer.append(c1.connections, c2)
+        self.assertEqual(ds.hgetall('SlottedCity:1'), {'name': 'Reixte', 'population': '1200', 'coast': '1', 'founded': '-2208988800', 'twin': '1'})
+
+        c = SlottedCity.find(name = 'Reixte').load()
+        self.assertEqual((c.oid, c.name, c.population, c.coast, c.founded, c.twin),
+                         ('1', 'Reixte', 1200, True, datetime(1900, 1, 1), City.by_id(1)))
+        self.assertEqual(List(c.connections), (SlottedCity.by_id(2),))
+        self.assertEqual(c.make_dict(), c1.make_dict())
+        self.assertFalse(c.is_partial())
+        self.assertEqual(SlottedCity.zrange('population'), [SlottedCity.by_id(2), SlottedCity.by_id(1)])
+
+        p = SlottedCity.by_id(2).load(['population'])
+        self.assertEqual(p.make_dict(), {'population': 300})
+        self.assertRaises(AttributeError, getattr, p, 'name')
+        writer.update(p, population = 350)
+        self.assertEqual(SlottedCity.by_id(2).load().population, 350)
+        writer.update(c, coast = False)
+        self.assertEqual(ds.hget('SlottedCity:1', 'coast'), '0')
+        writer.delete(c)
+        self.assertEqual(SlottedCity.zrange('population'), [SlottedCity.by_id(2)])
+
+        # generated codecs build the same objects as the generic code
+        f = Fighter.by_id(1).load()
+        self.assertEqual(f.make_dict(), Fighter.by_id(1).load([a.name for a in Fighter._attributes]).make_dict())
+        self.assertEqual(f._indexed_values, {'name': 'Alice', 'age': '20', 'weight': '107.44', 'joined': '1400000002', 'city': '1'})
+
+    def test_instrument(self):
+        example_data.load()
+        ops = []
+        agg = instrument.Aggregator()
+        instrument.enable()
+        instrument.add_listener(ops.append)
+        instrument.add_listener(agg)
+        try:
+            writer = ModelWriter(Fighter)
+            f = Fighter(name = 'Carol', age = 30, weight = 60.5, joined = None, city = City.by_id(2))
+            writer.create(f)
+            self.assertEqual([(op.name, op.model, op.depth) for op in ops], [('ModelWriter.create', 'Fighter', 0)])
+            create = ops[0]
+            self.assertEqual((create.commands, create.round_trips, create.pipelines, create.error), (2, 2, 0, None))  # INCR, EVALSHA
+            self.assertTrue(create.bytes_sent > 100 and create.bytes_received > 0 and create.elapsed > 0)
+
+            del ops[:]
+            Fighter.by_id(3).load()
+            self.assertRaises(NotFoundError, Fighter.by_id(4).load)
+            self.assertEqual([(op.name, op.commands, op.round_trips, op.error) for op in ops],
+                             [('Handle.load', 1, 1, None), ('Handle.load', 2, 2, 'NotFoundError')])
+
+            del ops[:]
+            SetFieldWriter(Gang.cities).append(Gang.by_id(2).load().cities, City.by_id(1))
+            self.assertEqual([(op.name, op.model, op.depth) for op in ops],
+                             [('Handle.load', 'Gang', 0), ('ContainerWriter.append', 'Gang', 1), ('ContainerFieldWriter.append', 'Gang', 0)])
+            self.assertEqual((ops[2].commands, ops[2].round_trips, ops[2].pipelines), (4, 1, 1))  # MULTI, SADD, SADD, EXEC
+
+            stats = agg.snapshot()
+            self.assertEqual(sorted(stats), ['ContainerFieldWriter.append Gang', 'Handle.load Fighter', 'Handle.load Gang', 'ModelWriter.create Fighter'])
+            load = stats['Handle.load Fighter']
+            self.assertEqual((load['calls'], load['errors'], load['round_trips']), (2, 1, 3))
+            self.assertEqual(load['time']['total'], 2)
+            self.assertTrue(load['p50'] <= load['p99'])
+            self.assertEqual(stats['ContainerFieldWriter.append Gang']['pipelines'], 1)
+        finally:
+            instrument.remove_listener(ops.append)
+            instrument.remove_listener(agg)
+            instrument.disable()
+        Fighter.by_id(3).load()
+        self.assertEqual(len(ops), 3)
+
+    def test_nplusone(self):
+        example_data.load()
+        handles = [Fighter.by_id(1), Fighter.by_id(2)] * 2
+        with instrument.NPlusOneDetector(threshold = 3, action = 'raise') as detector:
+            Fighter.load_many(handles)
+            for h in handles[:3]:
+                h.load()
+        self.assertEqual(detector.reports, [])
+        try:
+            with instrument.NPlusOneDetector(threshold = 3, action = 'raise'):
+                for h in handles:
+                    h.load()
+            self.fail('NPlusOneError not raised')
+        except instrument.NPlusOneError, e:
+            self.assertTrue('Handle.load on Fighter called more than 3 times' in str(e))
+            self.assertTrue('models.py' in str(e) and 'test_nplusone' in str(e))
+            self.assertTrue('load_many' in str(e))
+        with warnings.catch_warnings(record = True) as w:
+            warnings.simplefilter('always')
+            with instrument.NPlusOneDetector(threshold = 1) as detector:
+                for i in range(3):
+                    Gang.by_id(1).load().members.sismember(Fighter.by_id(1))
+        self.assertEqual([x.category for x in w], [instrument.NPlusOneWarning] * 2)
+        self.assertEqual(len(detector.reports), 2)
+        self.assertTrue('SetHandle.sismember on Gang' in detector.reports[1])
+        self.assertEqual(instrument._listeners, [])
+
+    def test_extend(self):
+        # plain containers, longer than a chunk
+        writer = ListWriter(int)
+        hlist = ListHandle('mylist', int)
+        writer.extend(hlist, range(2500))
+        writer.extend(hlist, [1])
+        self.assertEqual(List(hlist), tuple(range(2500) + [1]))
+        self.assertEqual(writer.remove_many(hlist, [1, 2, 1, 3000]), 3)
+        self.assertEqual(ds.llen('mylist'), 2498)
+        writer = SetWriter(int, index_key = 'myindex', unique_index = True)
+        hset1 = SetHandle('myset:1', int)
+        hset2 = SetHandle('myset:2', int)
+        writer.extend(hset1, range(2000))
+        self.assertEqual(ds.hlen('myindex'), 2000)
+        self.assertRaises(UniqueError, writer.extend, hset2, [3000, 1999])
+        self.assertRaises(UniqueError, writer.extend, hset2, [3000, 3000])
+        self.assertEqual(Set(hset2), set())
+        self.assertEqual(writer.remove_many(hset1, range(1000)), 1000)
+        writer.extend(hset2, [5, 3000])
+        self.assertEqual(ds.hmget('myindex', ['5', '1500', '3000']), ['2', '1', '2'])
+        writer = SortedSetWriter(str)
+        hzset = SortedSetHandle('myzset', str)
+        writer.extend(hzset, ['a', 'b', 'c'], [3, 1, 2])
+        self.assertEqual(SortedSet(hzset), ('b', 'c', 'a'))
+        self.assertEqual(writer.remove_many(hzset, ['a', 'x']), 1)
+
+        # model fields, indexed and owned
+        example_data.load()
+        g1, g2 = Gang(Gang.by_id(1)), Gang(Gang.by_id(2))
+        members_writer = SetFieldWriter(Gang.members)
+        self.assertEqual(members_writer.remove_many(g1.members, [Fighter.by_id(1), Fighter.by_id(2)]), 2)
+        self.assertEqual(ds.hgetall('u:Gang:members'), {})
+        members_writer.extend(g2.members, [Fighter.by_id(1), Fighter.by_id(2)])
+        self.assertEqual(ds.hgetall('u:Gang:members'), {'1': '2', '2': '2'})
+        self.assertRaises(UniqueError, members_writer.extend, g1.members, [Fighter.by_id(2)])
+        cities_writer = SetFieldWriter(Gang.cities)
+        cities_writer.extend(g2.cities, [City.by_id(1), City.by_id(2)])
+        self.assertEqual(ds.smembers('i:Gang:cities:1'), set(['1', '2']))
+        self.assertEqual(ds.smembers('i:Gang:cities:2'), set(['2']))
+
+        fighter2 = Fighter(Fighter.by_id(2))
+        weapons_writer = SortedSetFieldWriter(Fighter.weapons, ModelWriter(Weapon))
+        weapons = [Weapon(description = 'w{0}'.format(i), power = 10.0 - i) for i in range(3)]
+        weapons_writer.extend(fighter2.weapons, weapons)
+        self.assertEqual(SortedSet(fighter2.weapons), tuple(w.handle() for w in reversed(weapons)))
+        alien = Weapon(Weapon.by_id(1))
+        self.assertRaises(NotFoundError, weapons_writer.remove_many, fighter2.weapons, [weapons[0], alien])
+        self.assertEqual(ds.zcard('Fighter:2:weapons'), 3)
+        keys = [w.key for w in weapons[:2]]
+        self.assertEqual(weapons_writer.remove_many(fighter2.weapons, weapons[:2]), 2)
+        self.assertEqual(SortedSet(fighter2.weapons), (weapons[2].handle(),))
+        self.assertEqual([ds.exists(k) for k in keys], [False, False])
+        self.assertTrue(weapons[0].oid is None)
+
+        # owned elements are created with the container update, or not at all
+        team = Team()
+        ModelWriter(Team).create(team)
+        badges_writer = SetFieldWriter(Team.badges, ModelWriter(Badge))
+        badges_writer.extend(team.badges, [Badge(code = 'a')])
+        self.assertRaises(UniqueError, badges_writer.extend, team.badges, [Badge(code = 'b'), Badge(code = 'a')])
+        self.assertRaises(UniqueError, badges_writer.extend, team.badges, [Badge(code = 'c'), Badge(code = 'c')])
+        self.assertEqual(ds.keys('Badge:[0-9]*'), ['Badge:1'])
+        self.assertEqual(ds.hgetall('u:Badge:code'), {'a': '1'})
+        self.assertEqual(Set(team.badges), set([Badge.by_id(1)]))
+        badges = [Badge(code = 'b'), Badge(code = 'c')]
+        badges_writer.extend(team.badges, badges)
+        self.assertEqual(Set(team.badges), set([Badge.by_id(1)] + [b.handle() for b in badges]))
+        self.assertEqual(Badge.find(code = 'c'), badges[1].handle())
+
     def test_delete(self):
         example_data.load()
 
@@ -395,6 +893,225 @@ class ModelWriteTestCase(ModelTestCase):
         self.assertRaises(NotFoundError, fighter_skills_writer.remove, fsl.skills, ski)
         self.assertTrue(ds.exists('SkillInstance:1'))
 
+    def test_cascade_delete(self):
+        example_data.load()
+        gang = Gang(Gang.by_id(1))
+        ModelWriter(Gang).delete(gang, cascade = True)
+        self.assertTrue(gang.oid is None)
+        self.assertFalse(ds.exists('Gang:1'))
+        self.assertFalse(ds.exists('Gang:1:members'))
+        self.assertFalse(ds.exists('Gang:1:cities'))
+        self.assertEqual(ds.hgetall('u:Gang:members'), {})
+        self.assertEqual(ds.smembers('i:Gang:cities:1'), set())
+        self.assertEqual(ds.smembers('i:Gang:cities:3'), set())
+        self.assertEqual(ds.hgetall('u:Gang:leader'), {'0': '2'})
+
+        # owned elements, in a session
+        weapons = SortedSetFieldWriter(Fighter.weapons, ModelWriter(Weapon))
+        fighter2 = Fighter(Fighter.by_id(2))
+        weapons.append(fighter2.weapons, Weapon(description = 'w', power = 1.0))
+        fighter = Fighter(Fighter.by_id(1))
+        with Session():
+            ModelWriter(Fighter).delete(fighter, cascade = True)
+            self.assertTrue(ds.exists('Fighter:1:weapons'))
+        self.assertFalse(ds.exists('Fighter:1'))
+        self.assertFalse(ds.exists('Fighter:1:weapons'))
+        self.assertEqual([ds.exists('Weapon:{0}'.format(i)) for i in range(1, 5)], [False, False, False, True])
+        self.assertEqual(ds.hgetall('u:Fighter:name'), {'Bob': '2'})
+
+        # without cascade, containers are left behind
+        ModelWriter(Fighter).delete(fighter2)
+        self.assertTrue(ds.exists('Fighter:2:weapons'))
+        self.assertTrue(ds.exists('Weapon:4'))
+
+        # containers neither indexed nor owned are not read
+        city = City(City.by_id(1))
+        ListWriter(City).extend(city.connections, [City.by_id(2)] * 5000)
+        ops = []
+        instrument.enable()
+        instrument.add_listener(ops.append)
+        try:
+            ModelWriter(City).delete(city, cascade = True)
+        finally:
+            instrument.remove_listener(ops.append)
+            instrument.disable()
+        self.assertFalse(ds.exists('City:1:connections'))
+        self.assertTrue(ops[-1].bytes_received < 1000)
+
+        # indexed and owned containers are read in pages
+        ds.rpush('l', *range(5))
+        ds.sadd('s', *range(5))
+        ds.zadd('z', **dict((str(i), i) for i in range(5)))
+        members = _scan_containers(ds, [(City.connections, 'l'), (Gang.cities, 's'),
+                                        (Fighter.weapons, 'z'), (Gang.members, 'none')], 2)
+        self.assertEqual(members[0], [str(i) for i in range(5)])
+        self.assertEqual(set(members[1]), set(str(i) for i in range(5)))
+        self.assertEqual(members[2], [str(i) for i in range(5)])
+        self.assertEqual(members[3], [])
+
+    def test_listed_zset(self):
+        writer = ModelWriter(OrderedGang)
+        c1, c2 = City.by_id(1), City.by_id(2)
+        gangs = [OrderedGang(name = 'g{0}'.format(i), hqcity = c1) for i in range(3)]
+        for g in gangs:
+            writer.create(g)
+        writer.create(OrderedGang(name = 'g3', hqcity = c2))
+        self.assertEqual(ds.type('l:OrderedGang:hqcity:1'), 'zset')
+        self.assertEqual(OrderedGang.getlist(hqcity = c1), [g.handle() for g in gangs])
+        self.assertEqual(OrderedGang.getlist(1, 1, hqcity = c1), [gangs[1].handle()])
+        self.assertEqual(OrderedGang.getlist_rank(gangs[2].handle(), hqcity = c1), 2)
+        writer.update(gangs[0], hqcity = c2)
+        self.assertEqual(OrderedGang.getlist(hqcity = c2), [OrderedGang.by_id(4), gangs[0].handle()])
+        self.assertEqual(OrderedGang.getlist_rank(gangs[0].handle(), hqcity = c1), None)
+        writer.delete(gangs[1])
+        writer.update(gangs[0], hqcity = c1)
+        self.assertEqual(OrderedGang.getlist(hqcity = c1), [OrderedGang.by_id(3), OrderedGang.by_id(1)])
+        self.assertRaises(BadArgsError, Gang.getlist_rank, Gang.by_id(1), hqcity = City.by_id(3))
+
+        # migration of lists written with listed = True
+        ds.rpush('l:OrderedGang:hqcity:5', '3', '1', '2')
+        self.assertEqual(writer.migrate_listed('hqcity', batch_size = 2), 1)
+        self.assertEqual(OrderedGang.getlist(hqcity = City.by_id(5)),
+                         [OrderedGang.by_id(3), OrderedGang.by_id(1), OrderedGang.by_id(2)])
+        self.assertFalse(ds.exists('l:OrderedGang:hqcity:5:migrating'))
+        self.assertEqual(writer.migrate_listed('hqcity'), 0)
+        self.assertRaises(BadArgsError, ModelWriter(Gang).migrate_listed, 'hqcity')
+
+    def test_zset_list(self):
+        example_data.load()
+        route = Route(name = 'coast')
+        ModelWriter(Route).create(route)
+        self.assertEqual(type(route.stops), ZListHandle)
+        stops_writer = ListFieldWriter(Route.stops)
+        for i in 3, 1:
+            stops_writer.append(route.stops, City.by_id(i))
+        stops_writer.extend(route.stops, [City.by_id(2), City.by_id(4)])
+        self.assertEqual(ds.type('Route:1:stops'), 'zset')
+        self.assertEqual(List(route.stops), tuple(City.by_id(i) for i in (3, 1, 2, 4)))
+        self.assertEqual(Route.multifind(stops__contains = City.by_id(2)), set([Route.by_id(1)]))
+        self.assertEqual(route.stops.index(City.by_id(2)), 2)
+        self.assertEqual(route.stops.index(City.by_id(9)), None)
+        self.assertTrue(route.stops.contains(City.by_id(4)))
+        self.assertEqual(route.stops.range(1, 2), [City.by_id(1), City.by_id(2)])
+        self.assertEqual(list(route.stops.iter(batch = 3)), list(List(route.stops)))
+        stops_writer.remove(route.stops, City.by_id(1))
+        self.assertEqual(stops_writer.remove_many(route.stops, [City.by_id(3), City.by_id(7)]), 1)
+        stops_writer.append(route.stops, City.by_id(5))
+        self.assertEqual(List(route.stops), (City.by_id(2), City.by_id(4), City.by_id(5)))
+        self.assertEqual(route.stops.count(), 3)
+        self.assertEqual(ds.smembers('i:Route:stops:1'), set())
+
+        # owned elements, and loading with prefetch
+        skills_writer = ListFieldWriter(Route.skills, ModelWriter(SkillInstance))
+        skills = [SkillInstance(skill = Skill.by_id(1), value = i) for i in range(3)]
+        skills_writer.append(route.skills, skills[0])
+        skills_writer.extend(route.skills, skills[1:])
+        key = skills[1].key
+        with Session():
+            skills_writer.remove(route.skills, skills[1])
+        self.assertFalse(ds.exists(key))
+        self.assertRaises(NotFoundError, skills_writer.remove, route.skills, SkillInstance(SkillInstance.by_id(1)))
+        route = Route.by_id(1).load(prefetch = ['skills', 'stops'])
+        self.assertEqual(type(route.skills), ZListHandle)
+        self.assertEqual([s.value for s in route.skills.prefetched], [0, 2])
+        self.assertEqual(route.stops.prefetched[0].name, 'Damtoo')
+
+    def test_truncate(self):
+        example_data.load()
+        fighter_writer = ModelWriter(Fighter)
+        fighters = [Fighter(name = 'f{0}'.format(i), age = 20, weight = 70.0, joined = None,
+                            city = City.by_id(1 + i % 2)) for i in range(20)]
+        fighter_writer.create_many(fighters)
+        self.assertEqual(ds.scard('i:Fighter:city:1'), 12)
+        counts = []
+        self.assertEqual(fighter_writer.delete_where(city = City.by_id(1), batch_size = 5, progress = counts.append), 12)
+        self.assertEqual(counts[-1], 12)
+        self.assertFalse(ds.exists('i:Fighter:city:1'))
+        self.assertFalse(ds.exists('Fighter:1'))
+        self.assertFalse(ds.exists('Fighter:3'))
+        self.assertEqual(ds.zcard('z:Fighter:age'), 10)
+        self.assertEqual(ds.hlen('u:Fighter:name'), 10)
+        self.assertRaises(BadArgsError, fighter_writer.delete_where, name = 'f1')
+        self.assertRaises(BadArgsError, fighter_writer.delete_where, age = 20)
+
+        counts = []
+        n = fighter_writer.truncate(batch_size = 3, progress = counts.append)
+        self.assertEqual(counts[-1], n)
+        self.assertEqual(ds.keys('Fighter:*'), ['Fighter:id'])
+        self.assertEqual([k for k in ds.keys('?:Fighter:*')], [])
+        self.assertEqual(ds.get('Fighter:id'), '22')
+        self.assertTrue(ds.exists('Gang:1'))
+        self.assertTrue(ds.exists('u:Gang:members'))
+        self.assertTrue(ds.exists('Weapon:1'))
+        self.assertEqual(fighter_writer.truncate(), 0)
+
+    def test_cluster_keys(self):
+        self.assertEqual(key_slot('foo'), 12182)
+        self.assertEqual(key_slot('{user1000}.following'), key_slot('user1000'))
+        self.assertEqual(key_slot('{}foo'), key_slot('{}foo'))
+        self.assertNotEqual(key_slot('{}foo'), key_slot('foo'))
+
+        # hash_tag = 'model': all the keys of the model in one hash slot
+        depot_writer = ModelWriter(Depot)
+        depot = Depot(name = 'docks', zone = 'north')
+        depot_writer.create(depot)
+        SetWriter(str).append(depot.stock, 'rope')
+        keys = ['{Depot}:id', '{Depot}:1', '{Depot}:1:stock', 'u:{Depot}:name', 'i:{Depot}:zone:north']
+        for k in keys:
+            self.assertTrue(ds.exists(k), k)
+            self.assertEqual(key_slot(k), key_slot('Depot'))
+        self.assertEqual(Depot.find(name = 'docks'), Depot.by_id(1))
+        self.assertEqual(Depot.multifind(zone = 'north'), set([Depot.by_id(1)]))
+        self.assertEqual(Set(Depot.by_id(1).load().stock), set(['rope']))
+        self.assertEqual(key_slot(Depot._tmp_key('query')), key_slot('Depot'))
+        self.assertEqual(Depot.query(zone = 'north', name = 'docks'), [Depot.by_id(1)])
+        batch = CommandBatch()
+        batch.scripted = True
+        batch.rename('{Depot}:1:stock', '{Depot}:1:moved')
+        batch.rename('{Depot}:1:moved', '{Depot}:1:stock')
+        batch.execute()
+        self.assertEqual(ds.smembers('{Depot}:1:stock'), set(['rope']))
+
+        # hash_tag = 'object': not indexed containers in the slot of their owner
+        truck_writer = ModelWriter(Truck)
+        truck = Truck(plate = 'T-1')
+        truck_writer.create(truck)
+        self.assertEqual(truck.cargo.key, '{Truck:1}:cargo')
+        self.assertEqual(truck.depots.key, '{Truck}:1:depots')
+        ListWriter(str).extend(truck.cargo, ['fish', 'salt'])
+        SetFieldWriter(Truck.depots).append(truck.depots, depot)
+        self.assertEqual(Truck.multifind(depots__contains = depot), set([Truck.by_id(1)]))
+        truck = Truck.by_id(1).load(prefetch = ['cargo'])
+        self.assertEqual(truck.cargo.prefetched, ['fish', 'salt'])
+        self.assertEqual(List(truck.cargo), ('fish', 'salt'))
+        self.assertEqual(truck_writer.truncate(), 5)
+        self.assertEqual(ds.keys('*Truck*'), ['{Truck}:id'])
+
+        # moving keys written without hash tags
+        ds.flushdb()
+        ds.set('Depot:id', 5)
+        ds.hmset('Depot:5', {'name': 'old', 'zone': 'south'})
+        ds.hset('u:Depot:name', 'old', 5)
+        ds.sadd('i:Depot:zone:south', 5)
+        ds.sadd('Depot:5:stock', 'tar')
+        ds.hmset('Truck:7', {'plate': 'T-7'})
+        ds.rpush('Truck:7:cargo', 'wool')
+        ds.sadd('Truck:7:depots', 5)
+        ds.sadd('i:Truck:depots:5', 7)
+        counts = []
+        self.assertEqual(rekey([Depot, Truck, City], ds, batch_size = 2, progress = counts.append), 9)
+        self.assertEqual(counts[-1], 9)
+        self.assertEqual(sorted(ds.keys('*')), sorted(['{Depot}:id', '{Depot}:5', 'u:{Depot}:name',
+                         'i:{Depot}:zone:south', '{Depot}:5:stock', '{Truck}:7',
+                         '{Truck:7}:cargo', '{Truck}:7:depots', 'i:{Truck}:depots:5']))
+        depot = Depot.find(name = 'old').load()
+        self.assertEqual(depot.zone, 'south')
+        self.assertEqual(Set(depot.stock), set(['tar']))
+        self.assertEqual(List(Truck.by_id(7).load().cargo), ('wool',))
+        self.assertEqual(Truck.multifind(depots__contains = depot), set([Truck.by_id(7)]))
+        depot_writer.create(Depot(name = 'new', zone = 'east'))
+        self.assertEqual(Depot.find(name = 'new').oid, '6')
+
 class ModelReadTestCase(ModelTestCase):
 
     def setUp(self):
@@ -576,12 +1293,321 @@ class ModelReadTestCase(ModelTestCase):
         first_gang_by_hqcity = Gang.getlist(0, 0, hqcity = city3)
         self.assertEqual(first_gang_by_hqcity, [Gang.by_id(1)])
 
+    def test_load_many(self):
+        hfighter1 = Fighter.by_id(1)
+        hfighter2 = Fighter.by_id(2)
+        fighters = Fighter.load_many([hfighter2, Fighter.by_id(3), hfighter1])
+        self.assertEqual(len(fighters), 3)
+        self.assertEqual(fighters[0].name, 'Bob')
+        self.assertEqual(fighters[0].joined, datetime.utcfromtimestamp(1400000001))
+        self.assertTrue(fighters[1] is None)
+        self.assertEqual(fighters[2].name, 'Alice')
+        self.assertEqual(fighters[2].city, City.by_id(1))
+        self.assertEqual(fighters[2].handle(), hfighter1)
+        self.assertEqual(Fighter.load_many([]), [])
+
+        # query results and container contents
+        city_fighters = Fighter.multifind(city = City.by_id(1)).load_many()
+        self.assertEqual(sorted([f.name for f in city_fighters]), ['Alice', 'Bob'])
+        by_age = Fighter.zrange('age').load_many()
+        self.assertEqual([f.name for f in by_age], ['Alice', 'Bob'])
+        self.assertEqual(Fighter.zfind(age__gt = 99).load_many(), [])
+        gangs = Gang.getlist(hqcity = City.by_id(3)).load_many()
+        self.assertEqual([g.name for g in gangs], ['Ghetto Warriors', 'Midnight Club'])
+        gang = Gang(Gang.by_id(1))
+        members = gang.members.load().load_many()
+        self.assertEqual(sorted([f.name for f in members]), ['Alice', 'Bob'])
+        weapons = fighters[2].weapons.zrange().load_many()
+        self.assertEqual([w.description for w in weapons], ['third', 'second', 'first'])
+
+    def test_partial_load(self):
+        hfighter1 = Fighter.by_id(1)
+        fighter = hfighter1.load(fields = ['name', 'city'])
+        self.assertTrue(fighter.is_partial())
+        self.assertEqual(fighter.name, 'Alice')
+        self.assertEqual(fighter.city, City.by_id(1))
+        self.assertFalse('age' in fighter.__dict__)
+        self.assertFalse(Fighter(hfighter1).is_partial())
+        self.assertRaises(NotFoundError, Fighter.by_id(3).load, ['name'])
+        self.assertRaises(BadArgsError, hfighter1.load, ['nosuchfield'])
+        self.assertRaises(BadArgsError, hfighter1.load, [])
+        self.assertRaises(BadArgsError, Fighter.load_many, [hfighter1], [])
+
+        fighters = Fighter.load_many([Fighter.by_id(2), Fighter.by_id(3), hfighter1], fields = ['age'])
+        self.assertEqual(fighters[0].age, 23)
+        self.assertTrue(fighters[1] is None)
+        self.assertEqual(fighters[2].age, 20)
+        self.assertEqual(fighters[2].make_dict(), {'age': 20})
+
+        # partial objects cannot be written back by mistake
+        fighter_writer = ModelWriter(Fighter)
+        self.assertRaises(BadArgsError, fighter_writer.update_all, fighter)
+        self.assertRaises(BadArgsError, fighter_writer.update, fighter, age = 30)
+        self.assertRaises(BadArgsError, fighter_writer.delete, fighter)
+        self.assertEqual(ds.hget('Fighter:1', 'age'), '20')
+
+        # but loaded attributes can be updated
+        fighter_writer.update(fighter, name = 'Alicia', city = City.by_id(2))
+        self.assertEqual(ds.hgetall('u:Fighter:name'), {'Alicia': '1', 'Bob': '2'})
+        self.assertEqual(ds.smembers('i:Fighter:city:2'), set(['1']))
+        self.assertEqual(Fighter(hfighter1).age, 20)
+        self.assertRaises(AttributeError, getattr, fighter, 'age')
+        self.assertTrue(isinstance(Fighter.age, IntegerField))
+
+        # partial elements of owned containers
+        weapon = Weapon.by_id(1).load(fields = ['description'])
+        weapons_writer = SortedSetFieldWriter(Fighter.weapons, ModelWriter(Weapon))
+        self.assertRaises(BadArgsError, weapons_writer.update, Fighter(hfighter1).weapons, weapon, description = 'x')
+        self.assertTrue(ds.zscore('Fighter:1:weapons', '1') is not None)
+        self.assertNotEqual(ds.hget('Weapon:1', 'description'), 'x')
+        skill = SkillInstance.by_id(1).load(fields = ['value'])
+        skills_writer = ListFieldWriter(FighterSkillList.skills, ModelWriter(SkillInstance))
+        fsl = FighterSkillList(FighterSkillList.by_owner(Fighter(hfighter1)))
+        self.assertRaises(BadArgsError, skills_writer.remove, fsl.skills, skill)
+        self.assertEqual(ds.lrange('FighterSkillList:1:skills', 0, -1), ['1', '2'])
+
+    def test_iter_multifind(self):
+        fighter_writer = ModelWriter(Fighter)
+        dtime = datetime.utcfromtimestamp(1400000000)
+        fighters = [Fighter(name = 'F{0}'.format(i), age = i, weight = 70, joined = dtime, city = 2) for i in range(40)]
+        fighter_writer.create_many(fighters)
+        hcity2 = City.by_id(2)
+        handles = list(Fighter.iter_multifind(count_ = 7, city = hcity2))
+        self.assertEqual(set(handles), Fighter.multifind(city = hcity2))
+        self.assertEqual(len(set(handles)), 40)
+        names = set(f.name for f in Fighter.iter_multifind(count_ = 7, load_ = True, city = hcity2))
+        self.assertEqual(names, set('F{0}'.format(i) for i in range(40)))
+        self.assertEqual(list(Fighter.iter_multifind(city = City.by_id(3))), [])
+        gangs = list(Gang.iter_multifind(cities__contains = City.by_id(3)))
+        self.assertEqual(gangs, [Gang.by_id(1)])
+        self.assertRaises(BadArgsError, Fighter.multifind, city__bad = hcity2)
+
+    def test_query(self):
+        hfighter1 = Fighter.by_id(1)
+        hfighter2 = Fighter.by_id(2)
+        hcity1 = City.by_id(1)
+        hcity2 = City.by_id(2)
+        self.assertEqual(set(Fighter.query(city = hcity1)), set([hfighter1, hfighter2]))
+        self.assertEqual(Fighter.query(city = hcity2), [])
+        self.assertEqual(Fighter.query(city = hcity1, age__lt = 22), [hfighter1])
+        self.assertEqual(Fighter.query(city = hcity1, age__gte = 0), [hfighter1, hfighter2])
+        self.assertEqual(Fighter.query(city = hcity1, age__gte = 0, limit_ = 1), [hfighter1])
+        self.assertEqual(Fighter.query(age__in = (20, 30), weight__lt = 105), [hfighter2])
+        self.assertEqual(Fighter.query(age__gte = 0, weight__gte = 0), [hfighter1, hfighter2])
+        self.assertEqual(Fighter.query(age__gte = 0, weight__gte = 0, order_ = 'weight'), [hfighter2, hfighter1])
+        self.assertEqual(Fighter.query(age__gt = 20), [hfighter2])
+        self.assertEqual(Fighter.query(age = 23), [hfighter2])
+        self.assertEqual(Fighter.query(joined__lt = datetime(2020, 1, 1), city = hcity1), [hfighter2, hfighter1])
+
+        # unique indexes
+        self.assertEqual(Fighter.query(name = 'Bob', city = hcity1), [hfighter2])
+        self.assertEqual(Fighter.query(name = 'Bob', city = hcity2), [])
+        self.assertEqual(Fighter.query(name = 'Bob', age__gt = 23), [])
+        self.assertEqual(Fighter.query(name = 'Bob', age__gte = 23), [hfighter2])
+        self.assertEqual(Fighter.query(name = 'Nobody'), [])
+        self.assertEqual(Gang.query(members__contains = hfighter2, cities__contains = City.by_id(3)), [Gang.by_id(1)])
+        self.assertEqual(Gang.query(leader = hfighter1, cities__contains = hcity2), [])
+
+        self.assertFalse(ds.keys('tmp:*'))
+        self.assertRaises(BadArgsError, City.query, name = 'Reixte')
+        self.assertRaises(BadArgsError, Fighter.query)
+        self.assertRaises(BadArgsError, Fighter.query, age__gte = 0, order_ = 'weight')
+        self.assertRaises(BadArgsError, Fighter.query, city = City.by_id(1), order_ = 'age')
+
+    def test_prefetch(self):
+        gang = Gang.by_id(1).load(prefetch = ['leader__city', 'members', 'cities__connections', 'hqcity'])
+        self.assertTrue(isinstance(gang.leader, Fighter))
+        self.assertEqual(gang.leader.name, 'Alice')
+        self.assertEqual(gang.leader, Fighter.by_id(1))
+        self.assertTrue(isinstance(gang.leader.city, City))
+        self.assertEqual(gang.leader.city.name, 'Reixte')
+        self.assertEqual(gang.hqcity.name, 'Toynbe')
+        self.assertEqual(sorted(f.name for f in gang.members.prefetched), ['Alice', 'Bob'])
+        cities = dict((c.name, c) for c in gang.cities.prefetched)
+        self.assertEqual(sorted(cities), ['Reixte', 'Toynbe'])
+        self.assertEqual([c.name for c in cities['Reixte'].connections.prefetched], ['Damtoo', 'Toynbe'])
+        self.assertEqual(gang.leader.weapons.prefetched, None)
+
+        # writers accept prefetched references
+        ModelWriter(Gang).update(gang, name = 'Warriors')
+        self.assertEqual(ds.hgetall('Gang:1'), {'name': 'Warriors', 'leader': '1', 'hqcity': '3'})
+
+        gangs = Gang.load_many([Gang.by_id(2), Gang.by_id(1), Gang.by_id(3)], prefetch = ['leader', 'members'])
+        self.assertEqual(gangs[0].leader, Fighter.by_id(0))
+        self.assertEqual(gangs[0].members.prefetched, [])
+        self.assertEqual(gangs[1].leader.name, 'Alice')
+        self.assertEqual(gangs[2], None)
+        fighters = Fighter.multifind(city = City.by_id(1)).load_many(fields = ['name', 'city'], prefetch = ['city', 'weapons'])
+        self.assertEqual([f.city.name for f in fighters], ['Reixte', 'Reixte'])
+        self.assertTrue(fighters[0].city is fighters[1].city)
+        weapons = dict((f.name, [w.description for w in f.weapons.prefetched]) for f in fighters)
+        self.assertEqual(weapons, {'Alice': ['third', 'second', 'first'], 'Bob': []})
+        skills = FighterSkillList.by_id(1).load(prefetch = ['skills__skill'])
+        self.assertEqual([(s.skill.name, s.value) for s in skills.skills.prefetched], [('Strength', 21), ('Karate', 15)])
+
+        self.assertRaises(NotFoundError, Gang.by_id(3).load, prefetch = ['leader'])
+        self.assertRaises(BadArgsError, Gang.by_id(1).load, prefetch = ['name'])
+        self.assertRaises(BadArgsError, Gang.by_id(1).load, fields = ['name'], prefetch = ['leader'])
+        self.assertRaises(BadArgsError, Gang.by_id(1).load, prefetch = ['members__city__connections__connections'])
+
+    def test_handle_array(self):
+        h = Fighter.by_id(2)
+        self.assertFalse(hasattr(h, '__dict__'))
+        self.assertEqual(h.key, 'Fighter:2')
+        a = Fighter.multifind(city = City.by_id(1), array_ = True)
+        self.assertTrue(isinstance(a, HandleArray))
+        self.assertEqual(a, set([Fighter.by_id(1), Fighter.by_id(2)]))
+        self.assertEqual(Fighter.multifind(city = City.by_id(2), array_ = True), set())
+        q = Fighter.query(age__gte = 0, weight__gte = 0, order_ = 'weight', array_ = True)
+        self.assertEqual(list(q), [Fighter.by_id(2), Fighter.by_id(1)])
+        self.assertEqual(q[0], Fighter.by_id(2))
+        self.assertEqual(list(q[1:]), [Fighter.by_id(1)])
+        self.assertTrue(Fighter.by_id(1) in q)
+        self.assertFalse(Fighter.by_id(3) in q)
+        self.assertEqual([f.name for f in q.load_many()], ['Bob', 'Alice'])
+
+        a = HandleArray(Fighter, ['1', 2, '3', '1'])
+        b = HandleArray(Fighter, [5, 3, 4])
+        self.assertEqual(len(a), 3)
+        self.assertEqual(list((a | b).oids), [1, 2, 3, 5, 4])
+        self.assertEqual(list((a & b).oids), [3])
+        self.assertEqual(list((a - b).oids), [1, 2])
+        self.assertEqual(list((a ^ b).oids), [1, 2, 5, 4])
+        self.assertEqual(a & b, HandleArray(Fighter, [3]))
+        self.assertRaises(AssertionError, a.__and__, HandleArray(City, [3]))
+        self.assertTrue(2 in a and '3' in a and Fighter.by_id(1) in a)
+        self.assertFalse(4 in a)
+        a.oids.append(4)
+        self.assertTrue(4 in a)
+
+    def test_zrange_load(self):
+        fighters = Fighter.zrangebyscore_load('age', '-inf', '+inf')
+        self.assertEqual([f.name for f in fighters], ['Alice', 'Bob'])
+        self.assertEqual(fighters[1].joined, datetime.utcfromtimestamp(1400000001))
+        self.assertEqual(fighters[1].oid, '2')
+        self.assertEqual(fighters[0].weapons.key, 'Fighter:1:weapons')
+        fighters = Fighter.zrevrangebyscore_load('weight', '+inf', 0, 0, 1)
+        self.assertEqual([f.name for f in fighters], ['Alice'])
+        fighters = Fighter.zrangebyscore_load('age', '(20', 30)
+        self.assertEqual([f.name for f in fighters], ['Bob'])
+        self.assertEqual(Fighter.zrangebyscore_load('age', 30, 40), [])
+        ds.delete('Fighter:1')
+        self.assertEqual(Fighter.zrangebyscore_load('age', 0, 100)[0], None)
+
+
+class CacheTestCase(ModelTestCase):
+
+    def setUp(self):
+        example_data.load()
+        self.cache = cache.cache_setup(maxsize = 3)
+        self.cache.add_model(Fighter)
+
+    def tearDown(self):
+        cache.cache_disable()
+
+    def test_cache(self):
+        hfighter1 = Fighter.by_id(1)
+        self.assertEqual(Fighter(hfighter1).name, 'Alice')
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        ds.hset('Fighter:1', 'name', 'Changed behind our back')
+        self.assertEqual(Fighter(hfighter1).name, 'Alice')
+        self.assertEqual(Fighter.load_many([hfighter1])[0].name, 'Alice')
+        self.assertEqual(hfighter1.load(fields = ['age']).age, 20)
+        self.assertEqual(self.cache.stats()['hits'], 3)
+
+        # uncached models are not affected
+        self.assertEqual(City(City.by_id(1)).name, 'Reixte')
+        self.assertEqual(self.cache.stats()['size'], 1)
+
+        # local writers invalidate entries
+        fighter = Fighter(hfighter1)
+        fighter_writer = ModelWriter(Fighter)
+        fighter_writer.update(fighter, name = 'Alicia')
+        self.assertEqual(Fighter(hfighter1).name, 'Alicia')
+
+        # unique index lookups
+        self.assertEqual(Fighter.find(name = 'Bob'), Fighter.by_id(2))
+        self.assertEqual(Fighter.find(name = 'Bob'), Fighter.by_id(2))
+        self.assertFalse(Fighter.find(name = 'Alice'))
+        fighter2 = Fighter(Fighter.by_id(2))
+        fighter_writer.update(fighter2, name = 'Robert')
+        self.assertFalse(Fighter.find(name = 'Bob'))
+
+        # LRU eviction
+        self.cache.clear()
+        Fighter.load_many([hfighter1, Fighter.by_id(2)])
+        Fighter(hfighter1)
+        Fighter.find(name = 'Alicia')
+        stats = self.cache.stats()
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['evictions'], 0)
+        Fighter.find(name = 'Robert')
+        stats = self.cache.stats()
+        self.assertEqual(stats['size'], 3)
+        self.assertEqual(stats['evictions'], 1)
+        misses = stats['misses']
+        Fighter(hfighter1)
+        self.assertEqual(self.cache.stats()['misses'], misses)
+        Fighter(Fighter.by_id(2))
+        self.assertEqual(self.cache.stats()['misses'], misses + 1)
+
+        # data read before an invalidation is not stored after it
+        self.cache.clear()
+        token = self.cache.token()
+        stale = ds.hgetall('Fighter:1')
+        fighter_writer.update(Fighter(hfighter1), name = 'Ali')
+        Fighter._cache_put('Fighter:1', stale, None, token)
+        self.assertEqual(Fighter(hfighter1).name, 'Ali')
+        token = self.cache.token()
+        self.cache.put(Fighter, 'u:Fighter:name', '2', 'Robert', token)
+        self.assertEqual(self.cache.get(Fighter, 'u:Fighter:name', 'Robert'), '2')
+
+        # loads through other clients are not cached
+        conn = redmodel.Client(host = 'localhost', port = 6379, db = 1).redis()
+        try:
+            conn.hmset('Fighter:1', dict(ds.hgetall('Fighter:1'), name = 'OtherDB'))
+            self.cache.clear()
+            self.assertEqual(hfighter1.load(conn = conn).name, 'OtherDB')
+            self.assertEqual(Fighter.load_many([hfighter1], conn = conn)[0].name, 'OtherDB')
+            self.assertEqual(Fighter(hfighter1).name, 'Ali')
+            self.assertEqual(hfighter1.load(conn = conn).name, 'OtherDB')
+        finally:
+            conn.flushdb()
+
+    def test_ttl(self):
+        self.cache.add_model(Fighter, ttl = 0.05)
+        hfighter1 = Fighter.by_id(1)
+        Fighter(hfighter1)
+        ds.hset('Fighter:1', 'name', 'Changed')
+        self.assertEqual(Fighter(hfighter1).name, 'Alice')
+        time.sleep(0.1)
+        self.assertEqual(Fighter(hfighter1).name, 'Changed')
+
+    def test_invalidator(self):
+        invalidator = cache.CacheInvalidator(self.cache, configure_server = True)
+        invalidator.start()
+        try:
+            invalidator.ready.wait(1)
+            hfighter1 = Fighter.by_id(1)
+            Fighter(hfighter1)
+            ds.hset('Fighter:1', 'name', 'Changed')
+            for i in range(100):
+                if self.cache.stats()['size'] == 0:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(Fighter(hfighter1).name, 'Changed')
+            self.assertEqual(self.cache.stats()['invalidations'], 1)
+        finally:
+            invalidator.stop()
+            ds.config_set('notify-keyspace-events', '')
+
 
 def all_tests():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ContainersTestCase))
     suite.addTest(unittest.makeSuite(ModelWriteTestCase))
     suite.addTest(unittest.makeSuite(ModelReadTestCase))
+    suite.addTest(unittest.makeSuite(CacheTestCase))
     return suite
 
 